@@ -0,0 +1,429 @@
+"""
+Benchmarks the Python tools on data generated by synthetic_data.py and saves the results as JSON, so a change can be
+compared against an earlier run:
+    python3 synthetic_data.py --output-dir /tmp/snowplow-bench --events-per-hour 200000
+    python3 run_benchmarks.py --data-dir /tmp/snowplow-bench --output before.json
+    ... change something ...
+    python3 run_benchmarks.py --data-dir /tmp/snowplow-bench --output after.json --compare before.json
+
+The benchmarks:
+    verify_snowplow       verify_snowplow.extract() of the enriched hours to CSV and Parquet.
+    error_events_to_json  error_events_to_json.py of the bad rows to JSON lines and to a summary.
+    replicator            lambda_stream_replicator.handler() on the enriched events in batches of 500 Kinesis
+                          records, which are put on an in-process stand-in for Kinesis or on --endpoint-url.
+    move_to_dfp           move_to_dfp.run() of each hour with each engine. Needs an S3 compatible server at
+                          --endpoint-url, e.g. moto_server or MinIO. The Parquet partitions are uploaded to it first.
+
+Each benchmark runs --repeat times, each time in a new process, so the peak RSS it reports is its own. The result of a
+benchmark is the run with the median wall time: its wall and CPU time, the peak RSS of the process and of its worker
+processes, the input rows (page views for move_to_dfp) and bytes per second and the time spent in each stage. The
+stages are the ones the tools measure with instrumentation.Metrics, e.g. the read, combine and process stages of
+move_to_dfp.py, and functions of the tools that are wrapped with Metrics.timed() here, e.g. the Parquet uploads. Stages
+that run in worker processes are not timed.
+
+Prerequisites: the requirements of the tools that are benchmarked and boto3 (pip install boto3) for --endpoint-url.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from glob import glob
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT_DIR, 'scripts')
+REPLICATOR_DIR = os.path.join(ROOT_DIR, 'stream-replicator')
+MOVE_TO_DFP_DIR = os.path.join(ROOT_DIR, 'snowplow_tsv_to_parquet', 'move_to_dfp', 'src')
+
+# The tools import scripts/instrumentation.py from here, so their stages reach the listener of Stages.
+sys.path.insert(0, SCRIPTS_DIR)
+import instrumentation  # noqa: E402
+
+# Records per invocation of the replicator, the default batch size of a Kinesis trigger.
+KINESIS_BATCH_SIZE = 500
+
+# Times the functions of the tools that are wrapped with wrap().
+METRICS = instrumentation.Metrics('benchmark')
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Stages(object):
+    """
+    Adds up the wall time, calls and output rows of the stages measured with instrumentation.Metrics in this process.
+    Nested stages are measured separately, so the time of an outer stage includes that of the stages it calls.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.rows_out = {}
+        instrumentation.LISTENERS.append(self.add)
+
+    def add(self, tool, stage):
+        self.seconds[stage.name] = self.seconds.get(stage.name, 0.0) + stage.get_metrics()['WallSeconds'][0]
+        self.calls[stage.name] = self.calls.get(stage.name, 0) + 1
+        if stage.rows_out is not None:
+            self.rows_out[stage.name] = self.rows_out.get(stage.name, 0) + stage.rows_out
+
+    def to_dict(self):
+        return {stage: dict({'seconds': round(seconds, 4), 'calls': self.calls[stage]},
+                            **({'rows_out': self.rows_out[stage]} if stage in self.rows_out else {}))
+                for stage, seconds in sorted(self.seconds.items(), key=lambda item: -item[1])}
+
+
+def wrap(owner, attribute, stage):
+    """
+    Measures the calls of a function or method of a tool as a stage by replacing it with a wrapper, e.g.
+        wrap(output.HourWriter, 'finish_part', 'upload')
+    """
+    setattr(owner, attribute, METRICS.timed(stage)(getattr(owner, attribute)))
+
+
+def get_hours(data_dir):
+    with open(os.path.join(data_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    start = datetime.fromisoformat(manifest['start'])
+    hours = [start + timedelta(hours=i) for i in range(manifest['hours'])]
+    return [(hour.date(), hour.hour) for hour in hours], manifest
+
+
+def get_size(file_names):
+    return sum(os.path.getsize(file_name) for file_name in file_names)
+
+
+def setup_verify_snowplow(config):
+    sys.path.insert(0, SCRIPTS_DIR)
+    import verify_snowplow
+
+    hour_dirs = sorted(glob(os.path.join(config['data_dir'], 'enriched', '*', '*', '*', '*')))
+    output_format = config['output_format']
+    output = os.path.join(config['work_dir'], 'extract.' + output_format)
+
+    # Functions that run in worker processes cannot be wrapped, as they are pickled by name.
+    if config['jobs'] == 1:
+        wrap(verify_snowplow, 'extract_csv_rows', 'parse')
+        wrap(verify_snowplow, 'extract_record_batches', 'parse')
+    wrap(verify_snowplow.CsvWriter, 'write', 'write')
+    wrap(verify_snowplow.ArrowWriter, 'write', 'write')
+
+    def run():
+        verify_snowplow.extract(hour_dirs, config['jobs'], output_format, output)
+        return get_hours(config['data_dir'])[1]['enriched_events']
+
+    return run, get_size(verify_snowplow.get_file_names(hour_dirs))
+
+
+def setup_error_events_to_json(config):
+    sys.path.insert(0, SCRIPTS_DIR)
+    import error_events_to_json
+
+    file_names = sorted(glob(os.path.join(config['data_dir'], 'bad_rows', '*.gz')))
+    args = ['error_events_to_json.py', '--jobs', str(config['jobs'])]
+    if config['summary']:
+        args += ['--summary', '--distinct-params', 'duid']
+
+    if config['jobs'] == 1:
+        wrap(error_events_to_json, 'run_task', 'decode_file')
+
+    def run():
+        sys.argv = args + file_names
+        with open(os.path.join(config['work_dir'], 'out'), 'w') as out, redirect_stdout(out):
+            error_events_to_json.main()
+        return get_hours(config['data_dir'])[1]['bad_rows']
+
+    return run, get_size(file_names)
+
+
+class LocalKinesis(object):
+    """
+    Stands in for a Kinesis client. Accepts all records without sending them anywhere.
+    """
+
+    def __init__(self):
+        self.num_records = 0
+
+    def put_records(self, Records, StreamName):
+        self.num_records += len(Records)
+        return {'FailedRecordCount': 0,
+                'Records': [{'SequenceNumber': str(self.num_records + i), 'ShardId': 'shardId-000000000000'}
+                            for i in range(len(Records))]}
+
+
+def get_endpoint_client(service, endpoint_url):
+    import boto3
+    return boto3.client(service, endpoint_url=endpoint_url, region_name='eu-west-1')
+
+
+def setup_replicator(config):
+    import base64
+    import gzip
+
+    stream_name = 'bench-replicated'
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+    os.environ['ENV_OUTPUT_STREAM_NAME'] = stream_name
+    os.environ['ENV_ASSUME_ROLE_ARN'] = 'arn:aws:iam::123456789012:role/bench'
+    os.environ['ENV_KEEP_ONE_IN_X_EVENTS'] = str(config['keep_one_in_x_events'])
+    os.environ['ENV_SAMPLE_KEY'] = config['sample_key']
+    sys.path.insert(0, REPLICATOR_DIR)
+    import lambda_stream_replicator
+
+    if config['endpoint_url']:
+        kinesis = get_endpoint_client('kinesis', config['endpoint_url'])
+        if stream_name not in kinesis.list_streams()['StreamNames']:
+            kinesis.create_stream(StreamName=stream_name, ShardCount=4)
+            kinesis.get_waiter('stream_exists').wait(StreamName=stream_name)
+    else:
+        kinesis = LocalKinesis()
+    lambda_stream_replicator.get_kinesis_client = lambda role_arn: kinesis
+
+    records = []
+    file_names = sorted(glob(os.path.join(config['data_dir'], 'enriched', '*', '*', '*', '*', '*.gz')))
+    for file_name in file_names:
+        with gzip.open(file_name) as f:
+            for line in f:
+                records.append({'kinesis': {'sequenceNumber': str(len(records)),
+                                            'data': base64.b64encode(line.rstrip(b'\n')).decode('ascii')}})
+    events = [{'Records': records[i:i + KINESIS_BATCH_SIZE]} for i in range(0, len(records), KINESIS_BATCH_SIZE)]
+
+    # The replicator measures its sample and send stages itself.
+    wrap(lambda_stream_replicator, 'handler', 'handler')
+
+    def run():
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for event in events:
+                lambda_stream_replicator.handler(event, None)
+        return len(records)
+
+    return run, sum(len(record['kinesis']['data']) for record in records)
+
+
+def setup_move_to_dfp(config):
+    if not config['endpoint_url']:
+        raise SkipBenchmark('needs an S3 compatible server at --endpoint-url')
+
+    input_bucket, output_bucket = 'bench-input', 'bench-output'
+    os.environ.update({'S3_INPUT_BUCKET': input_bucket, 'S3_OUTPUT_BUCKET': output_bucket,
+                       'S3_OUTPUT_PREFIX': 'snowplow_pageviews', 'ENGINE': config['engine']})
+    sys.path.insert(0, MOVE_TO_DFP_DIR)
+    import move_to_dfp
+    import output
+    import streaming
+    from s3fs import S3FileSystem
+
+    s3 = get_endpoint_client('s3', config['endpoint_url'])
+    for bucket in (input_bucket, output_bucket):
+        try:
+            s3.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+        except (s3.exceptions.BucketAlreadyExists, s3.exceptions.BucketAlreadyOwnedByYou):
+            pass
+
+    parquet_dir = os.path.join(config['data_dir'], 'parquet')
+    file_names = sorted(glob(os.path.join(parquet_dir, 'snowplow', '*', '*', '*', '*.pq')))
+    for file_name in file_names:
+        s3.upload_file(file_name, input_bucket, os.path.relpath(file_name, parquet_dir).replace(os.sep, '/'))
+
+    fs = S3FileSystem(client_kwargs={'endpoint_url': config['endpoint_url']})
+    hours, manifest = get_hours(config['data_dir'])
+
+    # move_to_dfp.py measures its read, read_table, combine or transform, process and run stages itself.
+    wrap(streaming.SpillBuckets, 'add', 'spill')
+    wrap(streaming.SpillBuckets, 'read', 'unspill')
+    wrap(move_to_dfp, 'write_dataset', 'write')
+    wrap(move_to_dfp, 'write_table', 'write')
+    wrap(output.HourWriter, 'finish_part', 'upload')
+
+    def run():
+        for date_to_process, hour_to_process in hours:
+            move_to_dfp.run(date_to_process, hour_to_process, fs, config['threads'])
+        return manifest['page_views']
+
+    return run, get_size(file_names)
+
+
+SETUPS = {
+    'verify_snowplow': setup_verify_snowplow,
+    'error_events_to_json': setup_error_events_to_json,
+    'replicator': setup_replicator,
+    'move_to_dfp': setup_move_to_dfp,
+}
+
+
+def get_benchmarks(jobs):
+    """
+    Returns (benchmark, variant, settings) of the benchmarks to run.
+    """
+    return [
+        ('verify_snowplow', 'csv', {'output_format': 'csv', 'jobs': 1}),
+        ('verify_snowplow', 'parquet-jobs{}'.format(jobs), {'output_format': 'parquet', 'jobs': jobs}),
+        ('error_events_to_json', 'json', {'summary': False, 'jobs': 1}),
+        ('error_events_to_json', 'summary-jobs{}'.format(jobs), {'summary': True, 'jobs': jobs}),
+        ('replicator', 'sequence_number', {'sample_key': 'sequence_number', 'keep_one_in_x_events': 10}),
+        ('replicator', 'domain_sessionid', {'sample_key': 'domain_sessionid', 'keep_one_in_x_events': 10}),
+        ('move_to_dfp', 'pandas', {'engine': 'pandas', 'threads': 8}),
+        ('move_to_dfp', 'arrow', {'engine': 'arrow', 'threads': 8}),
+        ('move_to_dfp', 'streaming', {'engine': 'streaming', 'threads': 8}),
+    ]
+
+
+def run_child(name, config, result_file):
+    """
+    Runs a single benchmark in this process and writes its measurements to result_file.
+    """
+    stages = Stages()
+    try:
+        run, input_bytes = SETUPS[name](config)
+    except SkipBenchmark as e:
+        result = {'skipped': str(e)}
+    else:
+        # Measured like a stage, but not added to the stages.
+        run_stage = instrumentation.Stage(name, {})
+        rows = run()
+        metrics = {metric: value for metric, (value, _) in run_stage.get_metrics().items()}
+
+        wall_seconds = metrics['WallSeconds']
+        result = {
+            'wall_seconds': round(wall_seconds, 4),
+            'cpu_seconds': round(metrics['CpuSeconds'], 4),
+            'rows': rows,
+            'input_bytes': input_bytes,
+            'rows_per_second': round(rows / wall_seconds, 1),
+            'input_mb_per_second': round(input_bytes / 1024 / 1024 / wall_seconds, 2),
+            'peak_rss_mb': round(metrics['PeakRSS'], 1),
+            'children_peak_rss_mb': round(metrics['WorkersPeakRSS'], 1),
+            'stages': stages.to_dict(),
+        }
+
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def run_benchmark(name, variant, config, repeat, verbose):
+    runs = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as work_dir:
+            result_file = os.path.join(work_dir, 'result.json')
+            command = [sys.executable, os.path.abspath(__file__), '--child', name, '--result-file', result_file,
+                       '--config', json.dumps(dict(config, work_dir=work_dir))]
+            process = subprocess.run(command, stdout=None if verbose else subprocess.DEVNULL,
+                                     stderr=None if verbose else subprocess.PIPE)
+            if process.returncode != 0:
+                stderr = process.stderr.decode('utf-8', errors='replace') if process.stderr else ''
+                return {'name': name, 'variant': variant, 'failed': stderr[-2000:]}
+
+            with open(result_file) as f:
+                result = json.load(f)
+        if 'skipped' in result:
+            return dict(result, name=name, variant=variant)
+        runs.append(result)
+
+    median_run = sorted(runs, key=lambda run: run['wall_seconds'])[len(runs) // 2]
+    return dict(median_run, name=name, variant=variant,
+                wall_seconds_runs=[run['wall_seconds'] for run in runs],
+                wall_seconds_stdev=round(statistics.stdev([run['wall_seconds'] for run in runs]), 4)
+                if len(runs) > 1 else 0.0)
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_result(result):
+    if 'skipped' in result:
+        return 'skipped: {}'.format(result['skipped'])
+    if 'failed' in result:
+        return 'FAILED:\n{}'.format(result['failed'])
+
+    stages = ', '.join('{} {:.2f}s'.format(stage, timing['seconds']) for stage, timing in result['stages'].items())
+    return '{wall_seconds:.2f}s wall, {cpu_seconds:.2f}s CPU, {rows_per_second:.0f} rows/s, ' \
+           '{input_mb_per_second:.1f} MB/s, peak RSS {peak_rss_mb:.0f} MB ({children_peak_rss_mb:.0f} MB in ' \
+           'workers)'.format(**result) + ('\n    stages: ' + stages if stages else '')
+
+
+def compare(results, previous):
+    """
+    Prints the change in wall time and peak RSS of each benchmark that both runs have results for.
+    """
+    previous_results = {(result['name'], result['variant']): result for result in previous['benchmarks']
+                        if 'wall_seconds' in result}
+    print('Compared to {} ({}):'.format(previous.get('git_commit'), previous.get('created_at')))
+    for result in results:
+        old = previous_results.get((result['name'], result['variant']))
+        if old is None or 'wall_seconds' not in result:
+            continue
+        print('  {name}/{variant}: {old:.2f}s -> {new:.2f}s ({change:+.1f}%), peak RSS {old_rss:.0f} -> '
+              '{new_rss:.0f} MB'.format(name=result['name'], variant=result['variant'], old=old['wall_seconds'],
+                                        new=result['wall_seconds'],
+                                        change=(result['wall_seconds'] / old['wall_seconds'] - 1) * 100,
+                                        old_rss=old['peak_rss_mb'], new_rss=result['peak_rss_mb']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the Python tools on synthetic data.')
+    parser.add_argument('--data-dir', help='Output directory of synthetic_data.py.')
+    parser.add_argument('-o', '--output', help='File to save the results to as JSON.')
+    parser.add_argument('--compare', help='Results of an earlier run to compare with.')
+    parser.add_argument('--only', help='Comma separated benchmarks or benchmark/variant to run, e.g. '
+                                       'move_to_dfp,verify_snowplow/csv. Default: all.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='Number of worker processes of the parallel variants. Default: one per CPU.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark. Default: 3.')
+    parser.add_argument('--endpoint-url', help='Endpoint of a local S3 and Kinesis compatible server.')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show the output of the tools.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, json.loads(args.config), args.result_file)
+        return
+    if not args.data_dir:
+        parser.error('--data-dir is required')
+
+    only = set(args.only.split(',')) if args.only else None
+    _, manifest = get_hours(args.data_dir)
+    results = []
+    for name, variant, settings in get_benchmarks(args.jobs):
+        if only is not None and name not in only and '{}/{}'.format(name, variant) not in only:
+            continue
+
+        config = dict(settings, data_dir=os.path.abspath(args.data_dir), endpoint_url=args.endpoint_url)
+        print('{}/{}...'.format(name, variant), file=sys.stderr)
+        result = run_benchmark(name, variant, config, args.repeat, args.verbose)
+        print('  ' + format_result(result), file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'repeat': args.repeat,
+        'data': manifest,
+        'benchmarks': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
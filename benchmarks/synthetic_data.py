@@ -0,0 +1,402 @@
+"""
+Generates synthetic Snowplow data for the benchmarks in run_benchmarks.py: enriched events as TSV, bad rows with Thrift
+payloads and hourly Parquet partitions like the ones snowplow_tsv_to_parquet writes. The contexts of the events are
+built from the example-*.json files of the dk.jyllands-posten schemas, so they have the size and shape of real contexts.
+
+The same seed always gives the same data. Example:
+    python3 synthetic_data.py --output-dir /tmp/snowplow-bench --hours 2 --events-per-hour 200000 --bad-rows 100000
+
+Layout of the output directory:
+    enriched/YYYY/MM/DD/HH/part-NNNNN.gz    Enriched events as read by verify_snowplow.py extract.
+    bad_rows/part-NNNNN.gz                  Bad rows as read by error_events_to_json.py and bad_rows_index.py.
+    parquet/snowplow/event=EVENT/date=YYYY-MM-DD/hour=HH/YYYY-MM-DD_HH.pq
+                                            Page views, page pings and struct events as read by move_to_dfp.py.
+    manifest.json                           The settings used and the number of rows and bytes of each kind.
+
+Prerequisites: thriftpy (pip install thriftpy) for bad rows and pyarrow (pip install pyarrow) for Parquet.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import os
+import random
+import re
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+from glob import glob
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPTS_DIR = os.path.join(ROOT_DIR, 'scripts')
+SCHEMAS_DIR = os.path.join(ROOT_DIR, 'schemas', 'schemas', 'dk.jyllands-posten')
+
+sys.path.insert(0, SCRIPTS_DIR)
+from enriched_event import COLUMNS  # noqa: E402
+
+# The columns move_to_dfp.py reads, which are a subset of the columns the Scala job writes, and the event and event_id.
+# Keep them in sync with the column lists in snowplow_tsv_to_parquet/move_to_dfp/src/input.py, which can not be
+# imported here because it needs s3fs.
+PARQUET_COLUMNS = ['anon_id', 'app_id', 'br_family', 'br_name', 'br_version', 'collector_tstamp', 'content_id',
+                   'contexts', 'derived_tstamp', 'domain_sessionid', 'dvce_type', 'event', 'event_id', 'event_type',
+                   'geo_city', 'geo_country', 'geo_region_name', 'geo_zipcode', 'grp_authenticated', 'grp_authorized',
+                   'mkt_campaign', 'mkt_clickid', 'mkt_content', 'mkt_medium', 'mkt_network', 'mkt_source', 'mkt_term',
+                   'network_id', 'os_family', 'os_name', 'page_referrer', 'page_restricted', 'page_title', 'page_url',
+                   'page_urlfragment', 'page_urlhost', 'page_urlpath', 'page_urlquery', 'page_urlscheme', 'refr_medium',
+                   'refr_source', 'refr_term', 'refr_urlfragment', 'refr_urlhost', 'refr_urlpath', 'refr_urlquery',
+                   'refr_urlscheme', 'se_action', 'se_category', 'se_value', 'section_id', 'section_name',
+                   'section_path_id', 'site', 'user_authenticated', 'user_authorized', 'user_id', 'user_ipaddress',
+                   'useragent', 'web_page_id']
+
+CONTEXTS_SCHEMA = 'iglu:com.snowplowanalytics.snowplow/contexts/jsonschema/1-0-0'
+WEB_PAGE_SCHEMA = 'iglu:com.snowplowanalytics.snowplow/web_page/jsonschema/1-0-0'
+GA_COOKIES_SCHEMA = 'iglu:com.google.analytics/cookies/jsonschema/1-0-0'
+
+APP_IDS = ['jyllands-posten.dk', 'finans.dk', 'watchmedier.dk', 'ing.dk', 'm.jyllands-posten.dk']
+USERAGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.169 Safari/537.36',  # nopep8
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 12_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1 Mobile/15E148 Safari/604.1',  # nopep8
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_5) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/12.1.1 Safari/605.1.15',  # nopep8
+    'Mozilla/5.0 (Linux; Android 9; SM-G960F) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/74.0.3729.157 Mobile Safari/537.36',  # nopep8
+]
+BOT_USERAGENTS = ['Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+                  'Mozilla/5.0 (compatible; SemrushBot/3~bl; +http://www.semrush.com/bot.html)',
+                  'facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php) crawler']
+SECTIONS = ['Forside', 'Indland', 'Udland', 'Sport', 'Erhverv', 'Kultur', 'Debat']
+BAD_ROW_ERRORS = ['Field [dtm]: [{n}] is not a valid timestamp',
+                  'Field [tv]: [{word}] is not a valid tracker version',
+                  'Querystring is empty: no raw event to process',
+                  'Payload with vendor com.snowplowanalytics.snowplow and version tp2 not supported by this version of '
+                  'Scala Common Enrich',
+                  'error: instance type (string) does not match any allowed primitive type (allowed: ["integer"])\n'
+                  '    level: "error"\n    schema: {{"loadingURI":"#","pointer":"/properties/section_id"}}']
+
+# Share of page views with the heartbeat context and so with page pings, and of events with a bot user agent.
+HEARTBEAT_SHARE = 0.6
+BOT_SHARE = 0.03
+# Share of page views that repeat the web page id of an earlier page view, which move_to_dfp.py drops.
+DUPLICATE_PAGE_VIEW_SHARE = 0.01
+
+
+def parse_example(text):
+    """
+    Returns the objects in an example file. The examples are not always valid JSON: some hold several comma separated
+    objects or trailing commas.
+    """
+    text = re.sub(r',\s*([\]}])', r'\1', text.strip())
+    for candidate in (text, '[' + text + ']'):
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        return value if isinstance(value, list) else [value]
+    return []
+
+
+def load_example_contexts(schemas_dir=SCHEMAS_DIR):
+    """
+    Returns a dict of schema name, e.g. "user", to a list of (Iglu schema URI, data) examples.
+    """
+    examples = {}
+    for file_name in sorted(glob(os.path.join(schemas_dir, '*', 'jsonschema', 'example-*.json'))):
+        name = file_name.split(os.sep)[-3]
+        version = os.path.basename(file_name)[len('example-'):-len('.json')]
+        schema = 'iglu:dk.jyllands-posten/{}/jsonschema/{}'.format(name, version)
+        with open(file_name) as f:
+            for data in parse_example(f.read()):
+                if isinstance(data, dict):
+                    examples.setdefault(name, []).append((schema, data))
+    return examples
+
+
+class EventGenerator(object):
+    """
+    Generates the enriched events of an hour as dicts of column name to string value. Each page view is followed by its
+    page pings, if it has the heartbeat context, and by its scroll reach struct events.
+    """
+
+    def __init__(self, seed, examples):
+        self.random = random.Random(seed)
+        self.examples = examples
+        self.other_contexts = [name for name in sorted(examples) if name not in ('user', 'page_view', 'heartbeat')]
+        self.web_page_ids = []
+
+    def uuid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128), version=4))
+
+    def context(self, name, **overrides):
+        schema, data = self.random.choice(self.examples[name])
+        data = dict(data, **overrides)
+        return {'schema': schema, 'data': data}
+
+    def page_view_contexts(self, web_page_id, user_id, heartbeat):
+        contexts = [
+            {'schema': WEB_PAGE_SCHEMA, 'data': {'id': web_page_id}},
+            {'schema': GA_COOKIES_SCHEMA, 'data': {'_ga': 'GA1.2.{}.{}'.format(self.random.getrandbits(31),
+                                                                              self.random.getrandbits(31))}},
+            self.context('user', anon_id=self.uuid(), user_id=user_id),
+            self.context('page_view', section_id=self.random.randint(1, 2000),
+                         section_name=self.random.choice(SECTIONS), content_id=self.random.randint(10 ** 6, 10 ** 7)),
+        ]
+        if heartbeat:
+            contexts.append(self.context('heartbeat'))
+        if self.other_contexts and self.random.random() < 0.3:
+            contexts.append(self.context(self.random.choice(self.other_contexts)))
+        return contexts
+
+    def base_event(self, event, tstamp, session):
+        app_id, useragent, domain_userid, domain_sessionid, user_id, ip = session
+        return {
+            'app_id': app_id,
+            'platform': 'web',
+            'collector_tstamp': tstamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+            'derived_tstamp': tstamp.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+            'etl_tstamp': (tstamp + timedelta(seconds=2)).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+            'event': event,
+            'event_id': self.uuid(),
+            'name_tracker': 'cf',
+            'v_tracker': 'js-2.10.2',
+            'v_collector': 'ssc-0.15.0-kinesis',
+            'v_etl': 'stream-enrich-0.21.0-common-0.37.0',
+            'user_id': user_id,
+            'user_ipaddress': ip,
+            'domain_userid': domain_userid,
+            'domain_sessionidx': str(self.random.randint(1, 50)),
+            'network_userid': domain_userid,
+            'domain_sessionid': domain_sessionid,
+            'geo_country': 'DK',
+            'geo_city': self.random.choice(['Aarhus', 'Copenhagen', 'Odense', 'Aalborg']),
+            'geo_region_name': 'Region Midtjylland',
+            'geo_zipcode': str(self.random.randint(1000, 9990)),
+            'useragent': useragent,
+            'br_name': 'Chrome 74',
+            'br_family': 'Chrome',
+            'br_version': '74.0.3729.169',
+            'os_name': 'Windows 10',
+            'os_family': 'Windows',
+            'dvce_type': self.random.choice(['Computer', 'Mobile', 'Tablet']),
+        }
+
+    def new_session(self):
+        useragent = self.random.choice(BOT_USERAGENTS if self.random.random() < BOT_SHARE else USERAGENTS)
+        user_id = self.uuid() if self.random.random() < 0.4 else ''
+        ip = '{}.{}.{}.x'.format(self.random.randint(1, 223), self.random.randint(0, 255), self.random.randint(0, 255))
+        return self.random.choice(APP_IDS), useragent, self.uuid(), self.uuid(), user_id, ip
+
+    def page_view(self, tstamp, session):
+        if self.web_page_ids and self.random.random() < DUPLICATE_PAGE_VIEW_SHARE:
+            web_page_id = self.random.choice(self.web_page_ids)
+        else:
+            web_page_id = self.uuid()
+            self.web_page_ids.append(web_page_id)
+        heartbeat = self.random.random() < HEARTBEAT_SHARE
+
+        event = self.base_event('page_view', tstamp, session)
+        path = '/{}/ECE{}/article-{}/'.format(self.random.choice(SECTIONS).lower(),
+                                               self.random.randint(10 ** 6, 10 ** 7), self.random.getrandbits(24))
+        event.update({
+            'page_url': 'https://{}{}'.format(session[0], path),
+            'page_title': 'Article {}'.format(self.random.getrandbits(32)),
+            'page_referrer': self.random.choice(['', 'https://www.google.com/', 'https://www.facebook.com/']),
+            'page_urlscheme': 'https',
+            'page_urlhost': session[0],
+            'page_urlport': '443',
+            'page_urlpath': path,
+            'refr_medium': self.random.choice(['', 'search', 'social', 'internal']),
+            'contexts': json.dumps({'schema': CONTEXTS_SCHEMA,
+                                    'data': self.page_view_contexts(web_page_id, session[4], heartbeat)}),
+        })
+        return event, web_page_id, heartbeat
+
+    def follow_up_event(self, event_name, tstamp, session, web_page_id):
+        event = self.base_event(event_name, tstamp, session)
+        event['contexts'] = json.dumps({'schema': CONTEXTS_SCHEMA,
+                                        'data': [{'schema': WEB_PAGE_SCHEMA, 'data': {'id': web_page_id}}]})
+        if event_name == 'page_ping':
+            event.update({'pp_xoffset_min': '0', 'pp_xoffset_max': '0',
+                          'pp_yoffset_min': str(self.random.randint(0, 4000)),
+                          'pp_yoffset_max': str(self.random.randint(0, 8000))})
+        else:
+            event.update({'se_category': 'user_activity', 'se_action': 'article_scroll_reach',
+                          'se_label': web_page_id, 'se_value': str(self.random.choice([10, 25, 50, 75, 90, 100]))})
+        return event
+
+    def hour_events(self, hour_start, num_events):
+        """
+        Yields (event dict, web page id) of about num_events events in the hour starting at hour_start.
+        """
+        emitted = 0
+        while emitted < num_events:
+            session = self.new_session()
+            tstamp = hour_start + timedelta(seconds=self.random.uniform(0, 3599))
+            event, web_page_id, heartbeat = self.page_view(tstamp, session)
+            yield event, web_page_id
+            emitted += 1
+
+            for _ in range(self.random.randint(1, 8) if heartbeat else 0):
+                yield self.follow_up_event('page_ping', tstamp, session, web_page_id), web_page_id
+                emitted += 1
+            for _ in range(self.random.randint(0, 3)):
+                yield self.follow_up_event('struct', tstamp, session, web_page_id), web_page_id
+                emitted += 1
+
+
+def to_tsv(event):
+    return '\t'.join(event.get(column, '') for column in COLUMNS)
+
+
+def write_gzip_parts(directory, lines, lines_per_file):
+    """
+    Writes lines of bytes to gzip files of lines_per_file lines each. Returns the number of lines and bytes written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    num_lines = 0
+    part = None
+    for line in lines:
+        if num_lines % lines_per_file == 0:
+            if part is not None:
+                part.close()
+            part = gzip.open(os.path.join(directory, 'part-{:05d}.gz'.format(num_lines // lines_per_file)), 'wb',
+                             compresslevel=6)
+        part.write(line)
+        part.write(b'\n')
+        num_lines += 1
+    if part is not None:
+        part.close()
+    return num_lines, sum(os.path.getsize(f) for f in glob(os.path.join(directory, '*.gz')))
+
+
+def to_parquet_row(event, web_page_id, columns):
+    # The Scala job explodes the contexts of page views into columns.
+    row = {column: event.get(column) or None for column in columns}
+    row['web_page_id'] = web_page_id
+    row['event_type'] = event['event']
+    for context in json.loads(event['contexts'])['data']:
+        if context['schema'].startswith('iglu:dk.jyllands-posten/'):
+            for key, value in context['data'].items():
+                if key in row and row[key] is None and not isinstance(value, (list, dict)):
+                    row[key] = str(value)
+    return row
+
+
+def write_parquet_hour(output_dir, hour_start, rows_by_event, columns, row_group_size):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    num_bytes = 0
+    schema = pa.schema([pa.field(column, pa.string()) for column in columns])
+    for event, rows in rows_by_event.items():
+        directory = os.path.join(output_dir, 'snowplow', 'event=' + event, 'date={:%Y-%m-%d}'.format(hour_start),
+                                 'hour={:%H}'.format(hour_start))
+        os.makedirs(directory, exist_ok=True)
+        file_name = os.path.join(directory, '{:%Y-%m-%d_%H}.pq'.format(hour_start))
+        table = pa.Table.from_arrays([pa.array([row[c] for row in rows], type=pa.string()) for c in columns],
+                                     schema=schema)
+        pq.write_table(table, file_name, row_group_size=row_group_size)
+        num_bytes += os.path.getsize(file_name)
+    return num_bytes
+
+
+def generate_enriched(output_dir, start, hours, events_per_hour, lines_per_file, seed, parquet, row_group_size):
+    generator = EventGenerator(seed, load_example_contexts())
+    columns = PARQUET_COLUMNS if parquet else None
+    stats = {'enriched_events': 0, 'enriched_bytes': 0, 'parquet_rows': 0, 'parquet_bytes': 0, 'page_views': 0}
+
+    for hour in range(hours):
+        hour_start = start + timedelta(hours=hour)
+        rows_by_event = {'page_view': [], 'page_ping': [], 'struct': []}
+
+        def lines():
+            for event, web_page_id in generator.hour_events(hour_start, events_per_hour):
+                if columns is not None:
+                    rows_by_event[event['event']].append(to_parquet_row(event, web_page_id, columns))
+                yield to_tsv(event).encode('utf-8')
+
+        hour_dir = os.path.join(output_dir, 'enriched', '{:%Y/%m/%d/%H}'.format(hour_start))
+        num_lines, num_bytes = write_gzip_parts(hour_dir, lines(), lines_per_file)
+        stats['enriched_events'] += num_lines
+        stats['enriched_bytes'] += num_bytes
+        stats['page_views'] += len(rows_by_event['page_view'])
+
+        if columns is not None:
+            stats['parquet_bytes'] += write_parquet_hour(os.path.join(output_dir, 'parquet'), hour_start,
+                                                         rows_by_event, columns, row_group_size)
+            stats['parquet_rows'] += sum(len(rows) for rows in rows_by_event.values())
+    return stats
+
+
+def generate_bad_rows(output_dir, start, num_bad_rows, lines_per_file, seed):
+    import thriftpy
+    from thriftpy.protocol import TCyBinaryProtocolFactory
+    from thriftpy.utils import serialize
+
+    collector = thriftpy.load(os.path.join(SCRIPTS_DIR, 'collector-payload.thrift'))
+    generator = EventGenerator(seed + 1, load_example_contexts())
+    rand = generator.random
+
+    def lines():
+        for _ in range(num_bad_rows):
+            app_id, useragent, domain_userid, _, _, ip = generator.new_session()
+            tstamp = start + timedelta(seconds=rand.uniform(0, 3599))
+            timestamp = int(tstamp.timestamp() * 1000)
+            querystring = 'e={}&url=https%3A%2F%2F{}%2Farticle%2F{}&aid={}&duid={}&tv=js-2.10.2&dtm={}&cx={}'.format(
+                rand.choice(['pv', 'pp', 'se']), app_id, rand.getrandbits(24), app_id, domain_userid,
+                rand.choice([timestamp, rand.getrandbits(12)]),
+                base64.urlsafe_b64encode(json.dumps(generator.page_view_contexts(generator.uuid(), '', False))
+                                         .encode('utf-8')).decode('ascii'))
+            payload = collector.CollectorPayload(
+                schema='iglu:com.snowplowanalytics.snowplow/CollectorPayload/thrift/1-0-0', ipAddress=ip,
+                timestamp=timestamp, encoding='UTF-8', collector='ssc-0.15.0-kinesis', userAgent=useragent,
+                path='/i', querystring=querystring, headers=['Host: collector.jp.dk', 'User-Agent: ' + useragent],
+                hostname='collector.jp.dk', networkUserId=domain_userid)
+            errors = [{'level': 'error', 'message': rand.choice(BAD_ROW_ERRORS).format(n=rand.getrandbits(20),
+                                                                                        word=generator.uuid()[:8])}]
+            line = {'line': base64.b64encode(serialize(payload, TCyBinaryProtocolFactory())).decode('ascii'),
+                    'errors': errors, 'failure_tstamp': tstamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+            yield json.dumps(line).encode('utf-8')
+
+    num_lines, num_bytes = write_gzip_parts(os.path.join(output_dir, 'bad_rows'), lines(), lines_per_file)
+    return {'bad_rows': num_lines, 'bad_row_bytes': num_bytes}
+
+
+def generate(output_dir, start, hours=1, events_per_hour=100000, bad_rows=50000, lines_per_file=20000, seed=1,
+             parquet=True, row_group_size=50000):
+    """
+    Generates the data and writes manifest.json. Returns the manifest.
+    """
+    manifest = {'start': start.isoformat(), 'hours': hours, 'events_per_hour': events_per_hour, 'bad_rows': bad_rows,
+                'lines_per_file': lines_per_file, 'seed': seed, 'row_group_size': row_group_size}
+    manifest.update(generate_enriched(output_dir, start, hours, events_per_hour, lines_per_file, seed, parquet,
+                                      row_group_size))
+    if bad_rows:
+        manifest.update(generate_bad_rows(output_dir, start, bad_rows, lines_per_file, seed))
+
+    with open(os.path.join(output_dir, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates synthetic Snowplow data for the benchmarks.')
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument('--start', type=lambda s: datetime.strptime(s, '%Y%m%d%H').replace(tzinfo=timezone.utc),
+                        default=datetime(2019, 5, 1, 10, tzinfo=timezone.utc),
+                        help='First UTC hour as YYYYmmddHH. Default: 2019050110.')
+    parser.add_argument('--hours', type=int, default=1, help='Default: 1.')
+    parser.add_argument('--events-per-hour', type=int, default=100000, help='Default: 100000.')
+    parser.add_argument('--bad-rows', type=int, default=50000, help='Default: 50000.')
+    parser.add_argument('--lines-per-file', type=int, default=20000, help='Default: 20000.')
+    parser.add_argument('--row-group-size', type=int, default=50000, help='Rows per Parquet row group. Default: 50000.')
+    parser.add_argument('--no-parquet', dest='parquet', action='store_false', help='Skip the Parquet partitions.')
+    parser.add_argument('--seed', type=int, default=1, help='Default: 1.')
+    args = parser.parse_args()
+
+    manifest = generate(args.output_dir, args.start, args.hours, args.events_per_hour, args.bad_rows,
+                        args.lines_per_file, args.seed, args.parquet, args.row_group_size)
+    json.dump(manifest, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Decodes gzipped error events from Snowplow's enricher once into a local SQLite database that can be queried without
+decoding the archive again.
+
+Ingesting is incremental: files that have already been ingested with the same modification time are skipped and files
+that have changed are ingested again.
+
+Example:
+    python3 bad_rows_index.py ingest bad_rows.db enriched_bad/2019/05/*/*/*.gz
+    python3 bad_rows_index.py query bad_rows.db --url-contains IAtrackingPlugin --since 2019-05-13 --until 2019-05-20
+    python3 bad_rows_index.py query bad_rows.db --since 2019-05-20 --group-by error
+This finds the number of error events with "IAtrackingPlugin" in the URL query parameter in the given week and the
+number of error events per normalized error message since the 20th.
+
+Prerequisites: thriftpy (pip install thriftpy)
+"""
+
+import argparse
+import gzip
+import os
+import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from bad_rows_summary import normalize_error_message
+from error_events_to_json import decode_event, load_payload_class
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, name TEXT UNIQUE, mtime REAL, size INTEGER, '
+    'rows INTEGER, error TEXT, ingested_at TEXT)',
+    'CREATE TABLE IF NOT EXISTS bad_rows (row_id INTEGER PRIMARY KEY, file_id INTEGER, timestamp INTEGER, '
+    'error_message TEXT, normalized_error TEXT, tracker_version TEXT, app_id TEXT, event TEXT, url TEXT, '
+    'querystring TEXT)',
+    'CREATE TABLE IF NOT EXISTS qs_keys (row_id INTEGER, key TEXT)',
+    'CREATE INDEX IF NOT EXISTS bad_rows_file_id ON bad_rows (file_id)',
+    'CREATE INDEX IF NOT EXISTS bad_rows_timestamp ON bad_rows (timestamp)',
+    'CREATE INDEX IF NOT EXISTS bad_rows_normalized_error ON bad_rows (normalized_error, timestamp)',
+    'CREATE INDEX IF NOT EXISTS bad_rows_tracker_version ON bad_rows (tracker_version, timestamp)',
+    'CREATE INDEX IF NOT EXISTS bad_rows_app_id ON bad_rows (app_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS qs_keys_key ON qs_keys (key, row_id)',
+    'CREATE INDEX IF NOT EXISTS qs_keys_row_id ON qs_keys (row_id)',
+]
+
+GROUP_BY_COLUMNS = {
+    'error': 'normalized_error',
+    'tracker_version': 'tracker_version',
+    'app_id': 'app_id',
+    'event': 'event',
+    'hour': "strftime('%Y-%m-%dT%H', timestamp / 1000, 'unixepoch')",
+    'day': "strftime('%Y-%m-%d', timestamp / 1000, 'unixepoch')",
+}
+
+
+def connect(db_path):
+    connection = sqlite3.connect(db_path)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    return connection
+
+
+def first_value(qs, key):
+    return qs[key][0] if key in qs else None
+
+
+def init_worker():
+    global worker_payload_class
+    # Load the Thrift spec once per worker rather than once per file.
+    worker_payload_class = load_payload_class({'querystring', 'timestamp'})
+
+
+def decode_file(file_name):
+    """
+    Decodes a file into rows for the bad_rows table, each with the list of query string keys of the row. Returns the
+    rows and the error that stopped decoding, if any.
+    """
+    rows = []
+    try:
+        with gzip.open(file_name) as in_file:
+            for line in in_file:
+                event = decode_event(line, worker_payload_class, ('querystring', 'timestamp'))
+                messages = [error['message'] if isinstance(error, dict) else str(error) for error in event['errors']]
+                qs = event['qs']
+                rows.append(((event['timestamp'], ' | '.join(messages),
+                              ' | '.join(normalize_error_message(message) for message in messages),
+                              first_value(qs, 'tv'), first_value(qs, 'aid'), first_value(qs, 'e'),
+                              first_value(qs, 'url'), event['querystring']), list(qs)))
+        return rows, None
+    except Exception as e:
+        return rows, str(e)
+
+
+def map_in_order(executor, fn, items, max_pending):
+    """
+    Like executor.map() but with at most max_pending items in flight, so decoded files never pile up faster than they
+    are inserted.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def ingest(db_path, file_names, jobs):
+    connection = connect(db_path)
+    ingested = {name: mtime for name, mtime in connection.execute('SELECT name, mtime FROM files')}
+
+    to_ingest = []
+    for file_name in file_names:
+        name = os.path.abspath(file_name)
+        mtime = os.path.getmtime(file_name)
+        if ingested.get(name) == mtime:
+            continue
+        to_ingest.append((name, mtime, os.path.getsize(file_name)))
+
+    print(f'Ingesting {len(to_ingest)} of {len(file_names)} files.', file=sys.stderr)
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as executor:
+        decoded_files = map_in_order(executor, decode_file, [name for name, _, _ in to_ingest], jobs * 2)
+
+        for (name, mtime, size), (rows, error) in zip(to_ingest, decoded_files):
+            with connection:
+                # Replace the rows of files that have changed since they were ingested.
+                previous = connection.execute('SELECT file_id FROM files WHERE name = ?', (name,)).fetchone()
+                if previous is not None:
+                    connection.execute('DELETE FROM qs_keys WHERE row_id IN '
+                                       '(SELECT row_id FROM bad_rows WHERE file_id = ?)', previous)
+                    connection.execute('DELETE FROM bad_rows WHERE file_id = ?', previous)
+                    connection.execute('DELETE FROM files WHERE file_id = ?', previous)
+
+                file_id = connection.execute(
+                    'INSERT INTO files (name, mtime, size, rows, error, ingested_at) VALUES (?, ?, ?, ?, ?, ?)',
+                    (name, mtime, size, len(rows), error, datetime.now(timezone.utc).isoformat())).lastrowid
+
+                # Number the rows up front so both tables can be filled with one executemany() each. This is safe
+                # as the transaction holds the write lock.
+                first_row_id = connection.execute('SELECT COALESCE(MAX(row_id), 0) + 1 FROM bad_rows').fetchone()[0]
+                connection.executemany(
+                    'INSERT INTO bad_rows (row_id, file_id, timestamp, error_message, normalized_error, '
+                    'tracker_version, app_id, event, url, querystring) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((first_row_id + i, file_id) + columns for i, (columns, _) in enumerate(rows)))
+                connection.executemany('INSERT INTO qs_keys (row_id, key) VALUES (?, ?)',
+                                       ((first_row_id + i, key) for i, (_, keys) in enumerate(rows) for key in keys))
+
+            if error is not None:
+                print(f'Could not parse file {name}: {error}', file=sys.stderr)
+
+    connection.close()
+
+
+def parse_date(value):
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return int(timestamp.timestamp() * 1000)
+
+
+def contains_pattern(value):
+    """
+    Returns a LIKE pattern that matches value anywhere, with % and _ in value matched literally.
+    """
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+
+def query(db_path, args):
+    conditions = []
+    params = []
+    if args.since is not None:
+        conditions.append('timestamp >= ?')
+        params.append(args.since)
+    if args.until is not None:
+        conditions.append('timestamp < ?')
+        params.append(args.until)
+    if args.error_contains is not None:
+        conditions.append("error_message LIKE ? ESCAPE '\\'")
+        params.append(contains_pattern(args.error_contains))
+    if args.url_contains is not None:
+        conditions.append("url LIKE ? ESCAPE '\\'")
+        params.append(contains_pattern(args.url_contains))
+    for column in ('app_id', 'tracker_version', 'event'):
+        if getattr(args, column) is not None:
+            conditions.append(f'{column} = ?')
+            params.append(getattr(args, column))
+    for key in args.has_param:
+        conditions.append('row_id IN (SELECT row_id FROM qs_keys WHERE key = ?)')
+        params.append(key)
+
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    connection = connect(db_path)
+
+    if args.group_by is None:
+        count, = connection.execute(f'SELECT COUNT(*) FROM bad_rows{where}', params).fetchone()
+        print(count)
+    else:
+        group_column = GROUP_BY_COLUMNS[args.group_by]
+        order = 'grp' if args.group_by in ('hour', 'day') else 'cnt DESC'
+        rows = connection.execute(f'SELECT {group_column} AS grp, COUNT(*) AS cnt FROM bad_rows{where} '
+                                  f'GROUP BY grp ORDER BY {order} LIMIT ?', params + [args.top])
+        for group, count in rows:
+            print(f'{count:>10}  {group}')
+
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Indexes Snowplow error events in a SQLite database.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest_parser = subparsers.add_parser('ingest', help='Decode gzipped error event files into the database.')
+    ingest_parser.add_argument('db')
+    ingest_parser.add_argument('file_names', nargs='+', metavar='FILE')
+    ingest_parser.add_argument('-j', '--jobs', type=int, default=0,
+                               help='Number of worker processes. Default: one per CPU.')
+
+    query_parser = subparsers.add_parser('query', help='Count the error events matching all the given filters.')
+    query_parser.add_argument('db')
+    query_parser.add_argument('--since', type=parse_date, help='Inclusive ISO 8601 date or time, UTC by default.')
+    query_parser.add_argument('--until', type=parse_date, help='Exclusive ISO 8601 date or time, UTC by default.')
+    query_parser.add_argument('--error-contains')
+    query_parser.add_argument('--url-contains')
+    query_parser.add_argument('--app-id')
+    query_parser.add_argument('--tracker-version')
+    query_parser.add_argument('--event')
+    query_parser.add_argument('--has-param', action='append', default=[], metavar='KEY',
+                              help='Only count rows with this query string parameter. Can be repeated.')
+    query_parser.add_argument('--group-by', choices=sorted(GROUP_BY_COLUMNS))
+    query_parser.add_argument('--top', type=int, default=50, help='Number of groups to output. Default: 50.')
+
+    args = parser.parse_args()
+    if args.command == 'ingest':
+        ingest(args.db, args.file_names, args.jobs or os.cpu_count())
+    else:
+        query(args.db, args)
+
+
+if __name__ == '__main__':
+    main()
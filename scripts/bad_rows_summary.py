@@ -0,0 +1,185 @@
+"""
+Summarizes decoded bad rows in bounded memory: top-K counts of normalized error messages, query string parameters and
+hours, and approximate distinct counts of query string parameters.
+
+Used by error_events_to_json.py's --summary mode. Summaries are built per file or chunk and merged, so they can be
+built in several processes.
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import re
+from datetime import datetime, timezone
+
+# Replacements applied in order to turn error messages into groups, e.g. "Field [dtm]: [1558] is not a valid timestamp"
+# becomes "Field [dtm]: [<v>] is not a valid timestamp". Elsewhere, whole tokens with a digit are replaced, so ids like
+# 3fc1 or js-2.10.0 become a single <n> rather than a different group per value.
+ERROR_MESSAGE_NORMALIZERS = [
+    (re.compile(r'(Field \[[^\]]*\]: )\[[^\]]*\]'), r'\1[<v>]'),
+    (re.compile(r'https?://\S+'), '<url>'),
+    (re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'), '<uuid>'),
+    (re.compile(r'"[^"]*"'), '"<s>"'),
+    (re.compile(r"'[^']*'"), "'<s>'"),
+    (re.compile(r'(?<![\w.-])[\w.-]*\d([\w.-]*\w)?'), '<n>'),
+]
+
+
+def normalize_error_message(message):
+    for pattern, replacement in ERROR_MESSAGE_NORMALIZERS:
+        message = pattern.sub(replacement, message)
+    return message
+
+
+class TopK(object):
+    """
+    Approximate counts of the most frequent keys using the Space-Saving algorithm. At most capacity keys are tracked.
+    A key that replaces an evicted key inherits its count, so counts are upper bounds that are exact for keys that were
+    never evicted.
+
+    The keys are kept in a min-heap of (count, insertion number, key) so the key to evict is found in O(log capacity).
+    Counts only grow, so the count of a heap entry is a lower bound. Entries are updated when they reach the top.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.heap = []
+        self.num_pushed = 0
+
+    def push(self, key):
+        heapq.heappush(self.heap, (self.counts[key], self.num_pushed, key))
+        self.num_pushed += 1
+
+    def pop_min_key(self):
+        while True:
+            count, _, key = heapq.heappop(self.heap)
+            if self.counts[key] == count:
+                return key
+            self.push(key)
+
+    def add(self, key, count=1):
+        if key in self.counts:
+            self.counts[key] += count
+            return
+
+        if len(self.counts) < self.capacity:
+            self.counts[key] = count
+        else:
+            self.counts[key] = self.counts.pop(self.pop_min_key()) + count
+        self.push(key)
+
+    def merge(self, other):
+        for key, count in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + count
+        if len(self.counts) > self.capacity:
+            self.counts = dict(self.most_common(self.capacity))
+
+        self.heap = [(count, i, key) for i, (key, count) in enumerate(self.counts.items())]
+        heapq.heapify(self.heap)
+        self.num_pushed = len(self.heap)
+
+    def most_common(self, k):
+        return sorted(self.counts.items(), key=lambda item: (-item[1], str(item[0])))[:k]
+
+
+class HyperLogLog(object):
+    """
+    Approximate distinct count with a standard error of about 1.04 / sqrt(2 ** precision), i.e. 1.6% by default.
+    """
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        register = hashed >> (64 - self.precision)
+        remaining = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remaining.bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.num_registers)
+        estimate = alpha * self.num_registers ** 2 / sum(2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.num_registers and zeros > 0:
+            # Use linear counting for small cardinalities.
+            estimate = self.num_registers * math.log(self.num_registers / zeros)
+        return int(round(estimate))
+
+
+class BadRowSummary(object):
+    def __init__(self, group_params=('e', 'aid', 'tv'), distinct_params=(), capacity=1000):
+        self.rows = 0
+        self.errors = TopK(capacity)
+        self.hours = TopK(capacity)
+        self.params = {param: TopK(capacity) for param in group_params}
+        self.distinct = {param: HyperLogLog() for param in distinct_params}
+
+    def add(self, event):
+        """
+        Adds an event as returned by error_events_to_json.decode_event() with the timestamp field decoded.
+        """
+        self.rows += 1
+
+        for error in event['errors']:
+            message = error['message'] if isinstance(error, dict) else str(error)
+            self.errors.add(normalize_error_message(message))
+
+        if event.get('timestamp') is not None:
+            hour = datetime.fromtimestamp(event['timestamp'] / 1000, timezone.utc).strftime('%Y-%m-%dT%H')
+            self.hours.add(hour)
+
+        qs = event['qs']
+        for param, counter in self.params.items():
+            counter.add(qs[param][0] if param in qs else '<missing>')
+        for param, hll in self.distinct.items():
+            if param in qs:
+                hll.add(qs[param][0])
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.errors.merge(other.errors)
+        self.hours.merge(other.hours)
+        for param, counter in self.params.items():
+            counter.merge(other.params[param])
+        for param, hll in self.distinct.items():
+            hll.merge(other.distinct[param])
+
+    def to_dict(self, top):
+        return {
+            'rows': self.rows,
+            'errors': self.errors.most_common(top),
+            'params': {param: counter.most_common(top) for param, counter in self.params.items()},
+            'hours': sorted(self.hours.counts.items()),
+            'distinct': {param: hll.count() for param, hll in self.distinct.items()},
+        }
+
+    def format_report(self, top):
+        lines = [f'Bad rows: {self.rows}', '']
+
+        def add_section(title, counts):
+            lines.append(title)
+            for key, count in counts:
+                share = count / self.rows if self.rows else 0
+                lines.append(f'{count:>10} {share:>6.1%}  {key}')
+            lines.append('')
+
+        add_section('Top errors:', self.errors.most_common(top))
+        for param, counter in self.params.items():
+            add_section(f'Top {param}:', counter.most_common(top))
+        add_section('By hour (UTC):', sorted(self.hours.counts.items()))
+        for param, hll in self.distinct.items():
+            lines.append(f'Distinct {param}: ~{hll.count()}')
+
+        return '\n'.join(lines).rstrip() + '\n'
+
+    def format_json(self, top):
+        return json.dumps(self.to_dict(top)) + '\n'
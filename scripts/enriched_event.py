@@ -0,0 +1,118 @@
+"""
+Parses Snowplow enriched events, i.e. the tab separated lines written by the enricher, reading only the columns that are
+asked for.
+
+A parser works on the raw bytes of a line, e.g. as read from a gzip stream. It first finds and checks the filter
+columns, so rows that do not pass the filters cost a handful of bytes.find() calls. Only rows that pass are split, only
+the requested columns are decoded and the JSON columns (contexts, derived_contexts and unstruct_event) are only parsed
+for those rows.
+
+Example:
+    parser = EnrichedEventParser(['app_id', 'page_url', 'contexts'], filters={'event': 'page_view'})
+    with gzip.open(file_name, 'rb') as f:
+        for event in parser.parse_lines(f):
+            print(event.app_id, event.page_url, event.contexts)
+"""
+
+import json
+
+COLUMNS = ['app_id', 'platform', 'etl_tstamp', 'collector_tstamp', 'dvce_created_tstamp', 'event', 'event_id', 'txn_id', 'name_tracker', 'v_tracker', 'v_collector', 'v_etl', 'user_id', 'user_ipaddress', 'user_fingerprint', 'domain_userid', 'domain_sessionidx', 'network_userid', 'geo_country', 'geo_region', 'geo_city', 'geo_zipcode', 'geo_latitude', 'geo_longitude', 'geo_region_name', 'ip_isp', 'ip_organization', 'ip_domain', 'ip_netspeed', 'page_url', 'page_title', 'page_referrer', 'page_urlscheme', 'page_urlhost', 'page_urlport', 'page_urlpath', 'page_urlquery', 'page_urlfragment', 'refr_urlscheme', 'refr_urlhost', 'refr_urlport', 'refr_urlpath', 'refr_urlquery', 'refr_urlfragment', 'refr_medium', 'refr_source', 'refr_term', 'mkt_medium', 'mkt_source', 'mkt_term', 'mkt_content', 'mkt_campaign', 'contexts', 'se_category', 'se_action', 'se_label', 'se_property', 'se_value', 'unstruct_event', 'tr_orderid', 'tr_affiliation', 'tr_total', 'tr_tax', 'tr_shipping', 'tr_city', 'tr_state', 'tr_country', 'ti_orderid', 'ti_sku', 'ti_name', 'ti_category', 'ti_price', 'ti_quantity', 'pp_xoffset_min', 'pp_xoffset_max', 'pp_yoffset_min', 'pp_yoffset_max', 'useragent', 'br_name', 'br_family', 'br_version', 'br_type', 'br_renderengine', 'br_lang', 'br_features_pdf', 'br_features_flash', 'br_features_java', 'br_features_director', 'br_features_quicktime', 'br_features_realplayer', 'br_features_windowsmedia', 'br_features_gears', 'br_features_silverlight', 'br_cookies', 'br_colordepth', 'br_viewwidth', 'br_viewheight', 'os_name', 'os_family', 'os_manufacturer', 'os_timezone', 'dvce_type', 'dvce_ismobile', 'dvce_screenwidth', 'dvce_screenheight', 'doc_charset', 'doc_width', 'doc_height', 'tr_currency', 'tr_total_base', 'tr_tax_base', 'tr_shipping_base', 'ti_currency', 'ti_price_base', 'base_currency', 'geo_timezone', 'mkt_clickid', 'mkt_network', 'etl_tags', 'dvce_sent_tstamp', 'refr_domain_userid', 'refr_device_tstamp', 'derived_contexts', 'domain_sessionid', 'derived_tstamp', 'event_vendor', 'event_name', 'event_format', 'event_version', 'event_fingerprint', 'true_tstamp']  # nopep8
+COLUMN_INDEX = {name: idx for idx, name in enumerate(COLUMNS)}
+
+# Columns holding self-describing JSON. They are parsed into Python objects, or None if they are empty.
+JSON_COLUMNS = {'contexts', 'derived_contexts', 'unstruct_event'}
+
+
+class EnrichedEvent(object):
+    """
+    Base class of the records returned by a parser. Each parser makes a subclass with one slot per requested column.
+    """
+    __slots__ = ()
+
+    def __init__(self, values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'EnrichedEvent({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                                    for name in self.__slots__))
+
+
+def check_columns(columns):
+    unknown = [column for column in columns if column not in COLUMN_INDEX]
+    if unknown:
+        raise ValueError('Unknown enriched event columns: {}'.format(', '.join(unknown)))
+
+
+class EnrichedEventParser(object):
+    def __init__(self, columns, filters=None):
+        """
+        columns: Names of the columns to read, in the order they should have in the returned records.
+        filters: Optional dict of column name to the accepted value or a collection of accepted values. Rows where any
+                 of the columns holds another value are skipped.
+        """
+        filters = filters or {}
+        check_columns(columns)
+        check_columns(filters)
+
+        self.columns = list(columns)
+        self.indices = [COLUMN_INDEX[column] for column in self.columns]
+        # Splitting stops after the last requested column, the rest of the line stays in one piece.
+        self.max_split = max(self.indices, default=-1) + 1
+        self.is_json = [column in JSON_COLUMNS for column in self.columns]
+        self.event_class = type('EnrichedEvent', (EnrichedEvent,), {'__slots__': tuple(self.columns)})
+
+        # Check the filters in column order so a row is given up on as early in the line as possible.
+        self.filters = []
+        for column, accepted in sorted(filters.items(), key=lambda item: COLUMN_INDEX[item[0]]):
+            if isinstance(accepted, (str, bytes)):
+                accepted = [accepted]
+            accepted = frozenset(value.encode('utf-8') if isinstance(value, str) else value for value in accepted)
+            self.filters.append((COLUMN_INDEX[column], accepted))
+
+    def passes_filters(self, line):
+        position = 0
+        idx = 0
+        for filter_idx, accepted in self.filters:
+            # Skip ahead to the start of the filter column.
+            while idx < filter_idx:
+                position = line.find(b'\t', position) + 1
+                if position == 0:
+                    return False
+                idx += 1
+
+            end = line.find(b'\t', position)
+            value = line[position:end] if end != -1 else line[position:].rstrip(b'\r\n')
+            if value not in accepted:
+                return False
+        return True
+
+    def parse(self, line):
+        """
+        Returns the record of a line given as bytes, or None if the line does not pass the filters.
+        """
+        if self.filters and not self.passes_filters(line):
+            return None
+
+        # Only strip the line break so empty trailing columns are kept.
+        cols = line.rstrip(b'\r\n').split(b'\t', self.max_split)
+        values = []
+        for idx, is_json in zip(self.indices, self.is_json):
+            value = cols[idx].decode('utf-8') if idx < len(cols) else ''
+            if is_json:
+                value = json.loads(value) if value else None
+            values.append(value)
+        return self.event_class(values)
+
+    def parse_lines(self, lines):
+        """
+        Yields the records of the lines that pass the filters.
+        """
+        parse = self.parse
+        for line in lines:
+            event = parse(line)
+            if event is not None:
+                yield event
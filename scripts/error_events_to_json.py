@@ -7,13 +7,28 @@ Example:
 This command will find the number of error events with "IAtrackingPlugin" in the URL query parameter sent to Snowplow's
 collector.
 
+Use --jobs to decode the files on several cores. Large files are split into chunks of lines that are decoded in
+parallel as well. The lines of each file are output in their original order.
+
+Use --summary to get a compact report of the most common normalized error messages, query string parameter values and
+hours instead of one line per event, e.g.
+    python3 error_events_to_json.py --summary --jobs 0 --distinct-params duid *.gz
+
+Only the querystring field of the Thrift payload is decoded by default. Use --fields to add other fields of the
+CollectorPayload struct to the output, e.g. --fields userAgent,timestamp.
+
 Prerequisites: thriftpy (pip install thriftpy)
 
 Author: Asger Bachmann (asger.g.bachmann@jp.dk)
 """
 
+import argparse
 import base64
 import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from urllib import parse
 import sys
 import gzip
@@ -22,35 +37,208 @@ import thriftpy
 from thriftpy.protocol import TCyBinaryProtocolFactory
 from thriftpy.utils import deserialize
 
+from bad_rows_summary import BadRowSummary
+from instrumentation import Metrics
+
+THRIFT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'collector-payload.thrift')
+
+# Files larger than this are read by the main process and handed to the workers in chunks of lines.
+CHUNK_FILE_SIZE = 16 * 1024 * 1024
+CHUNK_LINES = 20000
+
+METRICS = Metrics('error_events_to_json')
+
+# Set in each worker process by init_worker().
+worker_payload_class = None
+worker_fields = None
+worker_summary_args = None
+
+
+def load_payload_class(fields):
+    """
+    Returns a CollectorPayload struct that only declares the given fields. The Thrift protocol skips the fields a struct
+    does not declare, so the other fields are never decoded into Python objects.
+    """
+    collector = thriftpy.load(THRIFT_FILE)
+    payload_class = collector.CollectorPayload
+    thrift_spec = {field_id: spec for field_id, spec in payload_class.thrift_spec.items() if spec[1] in fields}
+    return type('CollectorPayload', (payload_class,), {'thrift_spec': thrift_spec})
+
 
-def decode_event(data, collector_payload):
+def decode_event(data, payload_class, fields=()):
     json_payload = json.loads(data.decode('utf-8'))
     decoded_thrift_payload = base64.b64decode(json_payload['line'])
-    thrift_payload = deserialize(collector_payload, decoded_thrift_payload, TCyBinaryProtocolFactory())
+    thrift_payload = deserialize(payload_class(), decoded_thrift_payload, TCyBinaryProtocolFactory())
 
     qs = thrift_payload.querystring
     event = {
         'qs': parse.parse_qs(qs),
         'errors': json_payload['errors']
     }
+    for field in fields:
+        event[field] = getattr(thrift_payload, field)
     return event
 
 
-def main():
-    file_names = sys.argv[1:]
+def decode_lines_to_json(lines, payload_class, fields):
+    """
+    Decodes lines and returns them as one string of JSON lines along with the error that stopped decoding, if any.
+    """
+    out_lines = []
+    try:
+        for line in lines:
+            out_lines.append(json.dumps(decode_event(line, payload_class, fields)))
+            out_lines.append('\n')
+        return ''.join(out_lines), None
+    except Exception as e:
+        return ''.join(out_lines), e
+
+
+def summarize_lines(lines, payload_class, summary_args):
+    """
+    Decodes lines into a BadRowSummary and returns it along with the error that stopped decoding, if any.
+    """
+    summary = BadRowSummary(**summary_args)
+    try:
+        for line in lines:
+            summary.add(decode_event(line, payload_class, ('timestamp',)))
+        return summary, None
+    except Exception as e:
+        return summary, e
+
+
+def init_worker(fields, summary_args=None):
+    global worker_payload_class, worker_fields, worker_summary_args
+    # Load the Thrift spec once per worker rather than once per task.
+    if summary_args is not None:
+        fields = ['timestamp']
+    worker_payload_class = load_payload_class({'querystring'} | set(fields))
+    worker_fields = fields
+    worker_summary_args = summary_args
 
-    collector = thriftpy.load('collector-payload.thrift')
-    collector_payload = collector.CollectorPayload()
 
+def process_lines(lines):
+    if worker_summary_args is not None:
+        return summarize_lines(lines, worker_payload_class, worker_summary_args)
+    return decode_lines_to_json(lines, worker_payload_class, worker_fields)
+
+
+def run_task(task):
+    file_name, lines = task
+    if isinstance(lines, Exception):
+        # The main process could not read this part of the file.
+        return None, lines
+    if lines is None:
+        with gzip.open(file_name) as in_file:
+            return process_lines(in_file)
+    return process_lines(lines)
+
+
+def get_tasks(file_names):
+    """
+    Yields (file name, lines) tasks. Small files are read by the worker itself, which is signalled by lines being None.
+    If a large file cannot be read, its last task holds the exception instead.
+    """
     for file_name in file_names:
         try:
-            with gzip.open(file_name) as in_file:
-                for event in in_file:
-                    decoded_event = decode_event(event, collector_payload)
+            if os.path.getsize(file_name) <= CHUNK_FILE_SIZE:
+                yield file_name, None
+                continue
 
-                    print(json.dumps(decoded_event))
+            with gzip.open(file_name) as in_file:
+                while True:
+                    lines = list(islice(in_file, CHUNK_LINES))
+                    if not lines:
+                        break
+                    yield file_name, lines
         except Exception as e:
-            print('Could not parse file {}: {}'.format(file_name, e), file=sys.stderr)
+            yield file_name, e
+
+
+def run_tasks_in_order(executor, tasks, max_pending):
+    """
+    Submits tasks to the executor, keeping at most max_pending in flight, and yields (task, result) in task order.
+    """
+    pending = deque()
+    for task in tasks:
+        pending.append((task, executor.submit(run_task, task)))
+
+        while len(pending) >= max_pending:
+            task, future = pending.popleft()
+            yield task, future.result()
+
+    while pending:
+        task, future = pending.popleft()
+        yield task, future.result()
+
+
+def handle_results(results, handle_output):
+    failed_files = set()
+    for (file_name, _), (output, error) in results:
+        # Like a sequential run, stop using a file's events at the first line that cannot be decoded.
+        if file_name in failed_files:
+            continue
+
+        if output is not None:
+            handle_output(output)
+        if error is not None:
+            failed_files.add(file_name)
+            print('Could not parse file {}: {}'.format(file_name, error), file=sys.stderr)
+
+
+def comma_separated(value):
+    return [item for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Outputs Snowplow error events as JSON lines.')
+    parser.add_argument('file_names', nargs='+', metavar='FILE')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes. Use 0 for one per CPU. Default: 1.')
+    parser.add_argument('--fields', type=comma_separated, default=[],
+                        help='Comma separated CollectorPayload fields to output in addition to qs and errors.')
+    parser.add_argument('--summary', action='store_true', help='Output a summary report instead of the events.')
+    parser.add_argument('--summary-format', choices=['text', 'json'], default='text')
+    parser.add_argument('--group-params', type=comma_separated, default=['e', 'aid', 'tv'],
+                        help='Query string parameters to count the values of. Default: e,aid,tv.')
+    parser.add_argument('--distinct-params', type=comma_separated, default=[],
+                        help='Query string parameters to approximately count the distinct values of, e.g. duid.')
+    parser.add_argument('--top', type=int, default=20, help='Number of values to report per group. Default: 20.')
+    args = parser.parse_args()
+
+    jobs = args.jobs or os.cpu_count()
+
+    summary_args = None
+    summary = None
+    num_events = 0
+
+    def write_events(output):
+        nonlocal num_events
+        num_events += output.count('\n')
+        sys.stdout.write(output)
+
+    handle_output = write_events
+    if args.summary:
+        summary_args = {'group_params': args.group_params, 'distinct_params': args.distinct_params}
+        summary = BadRowSummary(**summary_args)
+        handle_output = summary.merge
+
+    with METRICS.profile(), \
+            METRICS.stage('decode', files=len(args.file_names), jobs=jobs, summary=args.summary) as stage:
+        if jobs == 1:
+            init_worker(args.fields, summary_args)
+            handle_results(((task, run_task(task)) for task in get_tasks(args.file_names)), handle_output)
+        else:
+            with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                                     initargs=(args.fields, summary_args)) as executor:
+                handle_results(run_tasks_in_order(executor, get_tasks(args.file_names), jobs * 2), handle_output)
+        stage.rows_out = summary.rows if summary is not None else num_events
+
+    if summary is not None:
+        if args.summary_format == 'json':
+            sys.stdout.write(summary.format_json(args.top))
+        else:
+            sys.stdout.write(summary.format_report(args.top))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,191 @@
+"""
+Measures the stages of a tool and logs them as CloudWatch Embedded Metric Format (EMF), one JSON object per line on
+stderr. In a log group, e.g. of an AWS Batch job or a Lambda function, CloudWatch turns the lines into metrics in the
+METRICS_NAMESPACE namespace with the dimensions Tool and Stage:
+    metrics = Metrics('move_to_dfp')
+    with metrics.stage('read', date='2018-08-22', hour=10) as stage:
+        df = read()
+        stage.rows_out = len(df)
+
+A stage records its wall time, the CPU time of the process (including finished worker processes), the rows it got and
+produced if it sets them, and the peak RSS of the process and its worker processes so far. The CPU time is that of the
+whole process, so stages that run concurrently each count the CPU time of the others. The keyword arguments of a stage
+are logged along with the metrics but are not dimensions, so they do not create metrics of their own.
+
+Functions in LISTENERS are called with the tool and each finished stage, also when the metrics are not logged. The
+benchmarks use it to add up the stages of a run.
+
+Environment:
+    METRICS=1              Log the metrics. Off by default.
+    METRICS_NAMESPACE      Default: Snowplow.
+    PROFILE=cprofile       Profile the run, see Metrics.profile(). cProfile only sees the thread that started the run.
+    PROFILE=tracemalloc    Trace the allocations of the run and log the lines that allocated the most.
+    PROFILE_DIR            Directory to write the profiles to. Default: the current directory.
+
+This is the only copy of the module. The move_to_dfp Docker image copies it in next to move_to_dfp.py and the stream
+replicator Lambda is deployed with it next to lambda_stream_replicator.py, see their READMEs and docstrings.
+"""
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional
+
+METRICS_ENABLED = os.environ.get('METRICS', '0') == '1'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Snowplow')
+PROFILE = os.environ.get('PROFILE', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '.')
+
+# Frames to keep per allocation with PROFILE=tracemalloc.
+TRACEMALLOC_FRAMES = 25
+
+
+def get_peak_rss_mb(who: int) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    peak_rss = resource.getrusage(who).ru_maxrss
+    return peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def get_cpu_seconds() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class Stage(object):
+    def __init__(self, name: str, properties: dict):
+        self.name = name
+        self.properties = properties
+        self.rows_in: Optional[int] = None
+        self.rows_out: Optional[int] = None
+        self.error: Optional[str] = None
+        self.start_time = time.perf_counter()
+        self.start_cpu_seconds = get_cpu_seconds()
+
+    def get_metrics(self) -> dict:
+        """
+        Returns the metrics of the stage so far as {name: (value, unit)}.
+        """
+        metrics = {
+            'WallSeconds': (time.perf_counter() - self.start_time, 'Seconds'),
+            'CpuSeconds': (get_cpu_seconds() - self.start_cpu_seconds, 'Seconds'),
+            'PeakRSS': (get_peak_rss_mb(resource.RUSAGE_SELF), 'Megabytes'),
+            'WorkersPeakRSS': (get_peak_rss_mb(resource.RUSAGE_CHILDREN), 'Megabytes'),
+        }
+        if self.rows_in is not None:
+            metrics['RowsIn'] = (self.rows_in, 'Count')
+        if self.rows_out is not None:
+            metrics['RowsOut'] = (self.rows_out, 'Count')
+        return metrics
+
+
+# Called with the tool and each finished stage, see the module docstring.
+LISTENERS: List[Callable[[str, Stage], None]] = []
+
+
+class Metrics(object):
+    """
+    Measures the stages of the tool called name. Does nothing unless METRICS=1, apart from profiling with PROFILE.
+    enabled and namespace override METRICS and METRICS_NAMESPACE for tools that are configured otherwise.
+    """
+
+    def __init__(self, tool: str, enabled: bool = None, namespace: str = None):
+        self.tool = tool
+        self.enabled = METRICS_ENABLED if enabled is None else enabled
+        self.namespace = namespace or METRICS_NAMESPACE
+
+    @contextmanager
+    def stage(self, name: str, **properties: Any) -> Iterator[Stage]:
+        """
+        Measures the block as the stage called name. If the block raises, the stage is logged with the error type.
+        """
+        stage = Stage(name, properties)
+        try:
+            yield stage
+        except BaseException as e:
+            stage.error = type(e).__name__
+            raise
+        finally:
+            if self.enabled:
+                self.log(stage)
+            for listener in LISTENERS:
+                listener(self.tool, stage)
+
+    def timed(self, name: str, rows_out: Callable[[Any], int] = None) -> Callable:
+        """
+        Decorates a function to measure its calls as the stage called name. rows_out gets the rows from the result.
+        """
+        def decorator(fn: Callable) -> Callable:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name) as stage:
+                    result = fn(*args, **kwargs)
+                    if rows_out is not None:
+                        stage.rows_out = rows_out(result)
+                    return result
+            return wrapper
+        return decorator
+
+    def log(self, stage: Stage) -> None:
+        metrics = stage.get_metrics()
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Tool', 'Stage']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()],
+                }],
+            },
+            'Tool': self.tool,
+            'Stage': stage.name,
+        }
+        line.update(stage.properties)
+        if stage.error is not None:
+            line['Error'] = stage.error
+        line.update({name: round(value, 3) for name, (value, _) in metrics.items()})
+
+        sys.stderr.write(json.dumps(line, default=str) + '\n')
+        sys.stderr.flush()
+
+    @contextmanager
+    def profile(self, run: str = None) -> Iterator[None]:
+        """
+        Profiles the block with PROFILE=cprofile or PROFILE=tracemalloc. The profile is written to PROFILE_DIR as
+        <tool>-<run>.prof, which can be read with python3 -m pstats, or as <tool>-<run>.tracemalloc, which can be read
+        with tracemalloc.Snapshot.load(). run defaults to the UTC time the block started.
+        """
+        if not PROFILE:
+            yield
+            return
+        if PROFILE not in ('cprofile', 'tracemalloc'):
+            raise ValueError(f'PROFILE must be cprofile or tracemalloc, not {PROFILE}.')
+
+        path = os.path.join(PROFILE_DIR, f'{self.tool}-{run or time.strftime("%Y%m%dT%H%M%S", time.gmtime())}')
+        if PROFILE == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                profiler.dump_stats(path + '.prof')
+                print(f'Wrote the profile of the run to {path}.prof.', file=sys.stderr)
+        else:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            try:
+                yield
+            finally:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak_bytes = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                snapshot.dump(path + '.tracemalloc')
+
+                top_lines = '\n'.join(str(statistic) for statistic in snapshot.statistics('lineno')[:10])
+                print(f'Traced a peak of {peak_bytes / 1024 / 1024:.1f} MB in Python allocations and wrote the '
+                      f'snapshot to {path}.tracemalloc. Largest allocations still held at the end:\n{top_lines}',
+                      file=sys.stderr)
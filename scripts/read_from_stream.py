@@ -1,49 +1,249 @@
+"""
+Reads records from a Kinesis stream and prints them, decoding the Thrift payload of records on *_bad streams.
+
+Positions can be checkpointed to a SQLite file so a long read can be resumed after a crash, e.g.
+    python3 read_from_stream.py Prod-enriched_bad --start-timestamp 2019-05-20T00:00:00 --checkpoint-file prod_bad.db
+    python3 read_from_stream.py Prod-enriched_bad --checkpoint-file prod_bad.db --resume
+
+Records can also be captured to disk and replayed later, e.g. into a local Kinesis stand-in to load test the collector
+and enricher with production traffic:
+    python3 read_from_stream.py Prod-web_good --capture capture_dir
+    python3 read_from_stream.py Dev-web_good --replay capture_dir --speed 4 --endpoint-url http://localhost:4567
+
+Set METRICS=1 to log the time, CPU time, peak RSS and records of the read, capture or replay when it ends, also when it
+is interrupted, see instrumentation.py.
+"""
+
+import argparse
+import queue
+import random
+import sqlite3
+import sys
+import threading
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 
 import boto3
 import botocore
 
+import stream_capture
+from instrumentation import Metrics
+
+# Kinesis allows 5 GetRecords calls per second per shard. Poll as often as that while a shard is behind the tip of the
+# stream and back off to the slower interval once it has caught up.
+MIN_POLL_INTERVAL_SECONDS = 0.2
+MAX_POLL_INTERVAL_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 10.0
+BACKOFF_EXCEPTIONS = ['ProvisionedThroughputExceededException', 'ThrottlingException']
+
+# The number of fetched records the shard readers may get ahead of the consumer.
+MAX_BUFFERED_RECORDS = 10000
+
+# Stored as a shard's checkpoint once the shard has been read to its end.
+SHARD_END = 'SHARD_END'
 
-def get_kinesis_data_iterator(stream_name, iterator_type):
-    client = boto3.client('kinesis')
-    kinesis_stream = client.describe_stream(StreamName=stream_name)
-    shards = kinesis_stream['StreamDescription']['Shards']
-    shard_ids = [shard['ShardId'] for shard in shards]
+METRICS = Metrics('read_from_stream')
 
-    iter_responses = [client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id, ShardIteratorType=iterator_type) for shard_id in shard_ids]
-    shard_iterators = [iter_response['ShardIterator'] for iter_response in iter_responses]
 
-    last_sequences = [None for _ in shard_iterators]
+class CheckpointStore(object):
+    """
+    Stores the sequence number of the last consumed record of each shard in a SQLite database.
+    """
 
+    def __init__(self, path, stream_name):
+        self.stream_name = stream_name
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS checkpoints (stream_name TEXT, shard_id TEXT, '
+                                'sequence_number TEXT, updated_at TEXT, PRIMARY KEY (stream_name, shard_id))')
+
+    def load(self):
+        rows = self.connection.execute('SELECT shard_id, sequence_number FROM checkpoints WHERE stream_name = ?',
+                                       (self.stream_name,))
+        return dict(rows)
+
+    def save(self, positions):
+        updated_at = datetime.now(timezone.utc).isoformat()
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?)',
+                                        [(self.stream_name, shard_id, sequence_number, updated_at)
+                                         for shard_id, sequence_number in positions.items()])
+
+    def close(self):
+        self.connection.close()
+
+
+def list_shards(client, stream_name):
+    shards = []
+    kwargs = {'StreamName': stream_name}
     while True:
-        for i in range(len(shard_iterators)):
-            if shard_iterators[i] is None:
-                continue
+        response = client.list_shards(**kwargs)
+        shards.extend(response['Shards'])
+        if 'NextToken' not in response:
+            return shards
+        kwargs = {'NextToken': response['NextToken']}
 
+
+def get_parent_shard_ids(shard):
+    return [shard[key] for key in ('ParentShardId', 'AdjacentParentShardId') if key in shard]
+
+
+def put_until_stopped(out_queue, item, stop_event):
+    while not stop_event.is_set():
+        try:
+            out_queue.put(item, timeout=1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def read_shard(client, stream_name, shard_id, iterator_args, out_queue, stop_event):
+    """
+    Reads a single shard until it is closed and puts ('record', fetch time, shard id, record) on the output queue,
+    followed by ('closed', None, shard id, None) once the shard has been read to its end.
+    """
+    try:
+        shard_iterator = client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
+                                                   **iterator_args)['ShardIterator']
+        last_sequence = None
+        backoff_seconds = MIN_POLL_INTERVAL_SECONDS
+
+        while shard_iterator is not None and not stop_event.is_set():
             try:
-                record_response = client.get_records(ShardIterator=shard_iterators[i])
-                now = datetime.now()
+                record_response = client.get_records(ShardIterator=shard_iterator)
+            except botocore.exceptions.ClientError as err:
+                error_code = err.response['Error']['Code']
+                if error_code in BACKOFF_EXCEPTIONS:
+                    print(f'Calling Kinesis too often for shard {shard_id}. Backing off {backoff_seconds:.1f}s...')
+                    time.sleep(backoff_seconds * random.uniform(0.5, 1.0))
+                    backoff_seconds = min(MAX_BACKOFF_SECONDS, backoff_seconds * 2)
+                    continue
+                elif error_code == 'ExpiredIteratorException':
+                    # Iterators expire after 5 minutes, e.g. if the consumer has been blocked for a while.
+                    if last_sequence is not None:
+                        iterator_args = {'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER',
+                                         'StartingSequenceNumber': last_sequence}
+                    shard_iterator = client.get_shard_iterator(StreamName=stream_name, ShardId=shard_id,
+                                                               **iterator_args)['ShardIterator']
+                    continue
+                raise err
+
+            backoff_seconds = MIN_POLL_INTERVAL_SECONDS
+            now = datetime.now()
 
-                for record in record_response['Records']:
-                    last_sequences[i] = record['SequenceNumber']
-                    yield now, record['Data']
+            for record in record_response['Records']:
+                if not put_until_stopped(out_queue, ('record', now, shard_id, record), stop_event):
+                    return
+                last_sequence = record['SequenceNumber']
 
-                # Get the next iterator for the current shard from the response.
-                if 'NextShardIterator' in record_response:
-                    shard_iterators[i] = record_response['NextShardIterator']
+            # Get the next iterator for the current shard from the response. It is missing once the shard is closed.
+            shard_iterator = record_response.get('NextShardIterator')
+            if shard_iterator is not None:
+                if record_response.get('MillisBehindLatest', 0) > 0:
+                    time.sleep(MIN_POLL_INTERVAL_SECONDS)
                 else:
-                    print(f'Shard {shard_ids[i]} closed.')
-                    shard_iterators[i] = None
-            except botocore.exceptions.ClientError as err:
-                backoff_exceptions = ['ProvisionedThroughputExceededException', 'ThrottlingException']
-                if err.response['Error']['Code'] in backoff_exceptions:
-                    print('Calling Kinesis too often. Backing off...')
-                    time.sleep(5)
+                    time.sleep(MAX_POLL_INTERVAL_SECONDS)
+
+        if shard_iterator is None:
+            put_until_stopped(out_queue, ('closed', None, shard_id, None), stop_event)
+    except Exception as err:
+        put_until_stopped(out_queue, ('error', None, shard_id, err), stop_event)
+
+
+def get_kinesis_record_iterator(stream_name, iterator_type, client=None, start_timestamp=None,
+                                checkpoint_store=None, checkpoint_interval_seconds=10, resume=False):
+    """
+    Reads all shards of a stream concurrently with one thread per shard and yields (fetch time, shard id, record) tuples.
+
+    Child shards created by splitting or merging shards are read from their start, or from start_timestamp with
+    AT_TIMESTAMP, once all their parents have been read to the end.
+
+    If a checkpoint store is given, the position of each shard is saved every checkpoint_interval_seconds once the
+    consumer has asked for the record after it. With resume=True, shards are read from after their checkpoints and
+    iterator_type only applies to shards without one.
+    """
+    client = client or boto3.client('kinesis')
+    out_queue = queue.Queue(maxsize=MAX_BUFFERED_RECORDS)
+    stop_event = threading.Event()
+
+    if iterator_type == 'AT_TIMESTAMP':
+        default_iterator_args = {'ShardIteratorType': iterator_type, 'Timestamp': start_timestamp}
+        # A parent may have closed before the timestamp, so its children have to start at the timestamp too.
+        child_iterator_args = default_iterator_args
+    else:
+        default_iterator_args = {'ShardIteratorType': iterator_type}
+        # The children of a closed shard are read from their beginning so no records are skipped.
+        child_iterator_args = {'ShardIteratorType': 'TRIM_HORIZON'}
+
+    checkpoints = checkpoint_store.load() if checkpoint_store is not None and resume else {}
+    positions = {}
+    last_checkpoint_time = time.monotonic()
+
+    shards = {shard['ShardId']: shard for shard in list_shards(client, stream_name)}
+    started = set()
+    finished = set(shard_id for shard_id, sequence_number in checkpoints.items() if sequence_number == SHARD_END)
+    if iterator_type == 'LATEST':
+        # Closed shards will never get new records.
+        finished.update(shard_id for shard_id, shard in shards.items()
+                        if 'EndingSequenceNumber' in shard['SequenceNumberRange'] and shard_id not in checkpoints)
+
+    def start_ready_shards(iterator_args):
+        for shard_id, shard in sorted(shards.items()):
+            if shard_id in started or shard_id in finished:
+                continue
+            # Parents that are no longer listed have passed the retention period and cannot be read anyway.
+            if all(parent_id in finished or parent_id not in shards for parent_id in get_parent_shard_ids(shard)):
+                started.add(shard_id)
+                if shard_id in checkpoints:
+                    shard_iterator_args = {'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER',
+                                           'StartingSequenceNumber': checkpoints[shard_id]}
                 else:
-                    raise err
+                    shard_iterator_args = iterator_args
+                thread = threading.Thread(target=read_shard, name=f'read-{shard_id}', daemon=True,
+                                          args=(client, stream_name, shard_id, shard_iterator_args, out_queue,
+                                                stop_event))
+                thread.start()
+
+    start_ready_shards(default_iterator_args)
+
+    try:
+        while len(started - finished) > 0:
+            kind, fetched_at, shard_id, payload = out_queue.get()
+            if kind == 'record':
+                yield fetched_at, shard_id, payload
+                positions[shard_id] = payload['SequenceNumber']
+            elif kind == 'closed':
+                print(f'Shard {shard_id} closed.')
+                finished.add(shard_id)
+                positions[shard_id] = SHARD_END
+                shards.update((shard['ShardId'], shard) for shard in list_shards(client, stream_name))
+                start_ready_shards(child_iterator_args)
+            else:
+                raise payload
+
+            if checkpoint_store is not None and time.monotonic() - last_checkpoint_time >= checkpoint_interval_seconds:
+                checkpoint_store.save(positions)
+                positions = {}
+                last_checkpoint_time = time.monotonic()
+    finally:
+        stop_event.set()
+        if checkpoint_store is not None:
+            checkpoint_store.save(positions)
+
+
+def get_kinesis_data_iterator(stream_name, iterator_type, **kwargs):
+    for fetched_at, _, record in get_kinesis_record_iterator(stream_name, iterator_type, **kwargs):
+        yield fetched_at, record['Data']
 
-        time.sleep(1)
+
+def count_records(records, stage):
+    """
+    Yields the records and counts the ones that have been consumed as the output rows of the stage.
+    """
+    stage.rows_out = 0
+    for record in records:
+        yield record
+        stage.rows_out += 1
 
 
 def print_thrift(timestamp, data):
@@ -53,26 +253,81 @@ def print_thrift(timestamp, data):
     print('{}: {}, {}'.format(timestamp, thrift_payload, json_payload['errors']))
 
 
+def parse_timestamp(value):
+    timestamp = datetime.fromisoformat(value)
+    # Timestamps without an offset are taken to be in UTC.
+    return timestamp if timestamp.tzinfo is not None else timestamp.replace(tzinfo=timezone.utc)
+
+
 if __name__ == '__main__':
-    import sys
+    parser = argparse.ArgumentParser(description='Reads records from a Kinesis stream and prints them.')
+    parser.add_argument('stream_name', nargs='?', default='Dev-enriched_good',
+                        help='The stream to read from or, with --replay, the stream to write to.')
+    parser.add_argument('iterator_type', nargs='?', default='LATEST', choices=['LATEST', 'TRIM_HORIZON'],
+                        help='Where to start reading shards without a checkpoint.')
+    parser.add_argument('--start-timestamp', type=parse_timestamp,
+                        help='Start reading at this ISO 8601 timestamp (UTC unless an offset is given) instead.')
+    parser.add_argument('--checkpoint-file', help='SQLite file to save the position of each shard in.')
+    parser.add_argument('--checkpoint-interval', type=float, default=10,
+                        help='Seconds between saving checkpoints. Default: 10.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue after the positions saved in the checkpoint file.')
+    parser.add_argument('--endpoint-url', help='Use a Kinesis-compatible endpoint, e.g. a local stand-in.')
+    parser.add_argument('--capture', metavar='DIR', help='Write the records to segment files in DIR.')
+    parser.add_argument('--segment-size', type=int, default=64,
+                        help='Start a new capture segment after this many MB of records. Default: 64.')
+    parser.add_argument('--replay', metavar='DIR', help='Put the records captured in DIR on the stream.')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay at this multiple of the captured rate, or as fast as possible if 0. Default: 1.')
+    parser.add_argument('--lanes', type=int, default=8, help='Number of concurrent replay senders. Default: 8.')
+    args = parser.parse_args()
 
-    if len(sys.argv) > 1:
-        stream_name = sys.argv[1]
-    else:
-        stream_name = 'Dev-enriched_good'
+    if args.resume and args.checkpoint_file is None:
+        parser.error('--resume requires --checkpoint-file.')
+    if args.capture and args.replay:
+        parser.error('--capture and --replay cannot be used together.')
 
-    if len(sys.argv) > 2:
-        iterator_type = sys.argv[2]
-    else:
-        iterator_type = 'LATEST'
+    stream_name = args.stream_name
+
+    if args.replay:
+        start_timestamp = args.start_timestamp.timestamp() if args.start_timestamp is not None else None
+        stats = stream_capture.ReplayStats()
+        with METRICS.profile(), \
+                METRICS.stage('replay', stream=stream_name, speed=args.speed, lanes=args.lanes) as stage:
+            try:
+                stream_capture.replay(args.replay, stream_name, speed=args.speed, endpoint_url=args.endpoint_url,
+                                      lanes=args.lanes, start_timestamp=start_timestamp, stats=stats)
+            finally:
+                stage.rows_in, stage.rows_out = stats.read, stats.records
+        sys.exit(0)
+
+    iterator_type = 'AT_TIMESTAMP' if args.start_timestamp is not None else args.iterator_type
 
-    if stream_name.endswith('_bad'):
+    if stream_name.endswith('_bad') and not args.capture:
         decode_thrift = True
     else:
         decode_thrift = False
 
+    client = boto3.client('kinesis', endpoint_url=args.endpoint_url)
+    checkpoint_store = CheckpointStore(args.checkpoint_file, stream_name) if args.checkpoint_file else None
+    reader_args = dict(client=client, start_timestamp=args.start_timestamp, checkpoint_store=checkpoint_store,
+                       checkpoint_interval_seconds=args.checkpoint_interval, resume=args.resume)
+
     print('USING PARAMETERS {}, {} and {}.'.format(stream_name, iterator_type, decode_thrift))
-    kinesis_data = get_kinesis_data_iterator(stream_name, iterator_type)
+
+    if args.capture:
+        kinesis_records = get_kinesis_record_iterator(stream_name, iterator_type, **reader_args)
+        try:
+            with METRICS.profile(), METRICS.stage('capture', stream=stream_name) as stage:
+                stream_capture.capture(count_records(kinesis_records, stage), args.capture,
+                                       max_segment_bytes=args.segment_size * 1024 * 1024)
+        finally:
+            kinesis_records.close()
+            if checkpoint_store is not None:
+                checkpoint_store.close()
+        sys.exit(0)
+
+    kinesis_data = get_kinesis_data_iterator(stream_name, iterator_type, **reader_args)
 
     if decode_thrift:
         import base64
@@ -83,8 +338,14 @@ if __name__ == '__main__':
         collector = thriftpy.load('collector-payload.thrift')
         collector_payload = collector.CollectorPayload()
 
-    for timestamp, data in kinesis_data:
-        if decode_thrift:
-            print_thrift(timestamp, data)
-        else:
-            print('{}: {}'.format(timestamp, data))
+    try:
+        with METRICS.profile(), METRICS.stage('read', stream=stream_name, decode_thrift=decode_thrift) as stage:
+            for timestamp, data in count_records(kinesis_data, stage):
+                if decode_thrift:
+                    print_thrift(timestamp, data)
+                else:
+                    print('{}: {}'.format(timestamp, data))
+    finally:
+        kinesis_data.close()
+        if checkpoint_store is not None:
+            checkpoint_store.close()
@@ -0,0 +1,158 @@
+"""
+Downloads hour prefixes of Snowplow files from S3 concurrently, keeping a local manifest of the objects that have
+already been fetched so only new or changed objects are downloaded again.
+
+The manifest is a SQLite file in the local directory. It records the ETag and size of each fetched object and which
+hours are complete, i.e. fully fetched after the hour had passed by more than COMPLETE_AFTER. Complete hours are not
+listed again.
+
+Used by verify_snowplow.py's sync command and extract --fetch mode.
+"""
+
+import os
+import sqlite3
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+MANIFEST_FILE_NAME = '.sync_manifest.db'
+
+# Snowplow keeps writing files for an hour for a while after it has passed, so only hours older than this are complete.
+COMPLETE_AFTER = timedelta(hours=3)
+
+
+class Manifest(object):
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, etag TEXT, size INTEGER)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS hours (hour TEXT PRIMARY KEY, completed_at TEXT)')
+
+    def is_complete(self, hour):
+        return self.connection.execute('SELECT 1 FROM hours WHERE hour = ?', (hour,)).fetchone() is not None
+
+    def fetched(self, keys):
+        """
+        Returns the (etag, size) of the given keys that have been fetched before.
+        """
+        fetched = {}
+        for key in keys:
+            row = self.connection.execute('SELECT etag, size FROM objects WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                fetched[key] = row
+        return fetched
+
+    def save(self, hour, objects, complete):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO objects (key, etag, size) VALUES (?, ?, ?)',
+                                        [(obj['Key'], obj['ETag'], obj['Size']) for obj in objects])
+            if complete:
+                self.connection.execute('INSERT OR REPLACE INTO hours (hour, completed_at) VALUES (?, ?)',
+                                        (hour, datetime.now(timezone.utc).isoformat()))
+
+    def close(self):
+        self.connection.close()
+
+
+def hour_has_passed(hour):
+    """
+    Returns whether an hour given as "YYYY/MM/DD/HH" in UTC ended more than COMPLETE_AFTER ago.
+    """
+    start = datetime.strptime(hour, '%Y/%m/%d/%H').replace(tzinfo=timezone.utc)
+    return start + timedelta(hours=1) + COMPLETE_AFTER < datetime.now(timezone.utc)
+
+
+class HourSync(object):
+    """
+    Syncs hour prefixes, e.g. "2017/09/06/15", of s3://bucket/prefix to local_dir/hour with a pool of jobs threads.
+    """
+
+    def __init__(self, bucket, prefix, local_dir='.', endpoint_url=None, jobs=16):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.local_dir = local_dir
+        self.jobs = jobs
+        # Clients are thread safe, so one client is shared by all the threads.
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        os.makedirs(local_dir, exist_ok=True)
+        self.manifest = Manifest(os.path.join(local_dir, MANIFEST_FILE_NAME))
+
+    def local_path(self, key):
+        return os.path.join(self.local_dir, key[len(self.prefix):])
+
+    def list_hour(self, hour):
+        objects = []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + hour + '/'):
+            objects.extend(page.get('Contents', []))
+        return objects
+
+    def download(self, obj):
+        path = self.local_path(obj['Key'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Download to a temporary file so an interrupted download never looks like a fetched object.
+        tmp_path = path + '.part'
+        self.client.download_file(self.bucket, obj['Key'], tmp_path)
+        os.replace(tmp_path, path)
+
+    def to_download(self, objects):
+        fetched = self.manifest.fetched(obj['Key'] for obj in objects)
+        to_download = []
+        for obj in objects:
+            path = self.local_path(obj['Key'])
+            if fetched.get(obj['Key']) == (obj['ETag'], obj['Size']) and os.path.exists(path) and \
+                    os.path.getsize(path) == obj['Size']:
+                continue
+            to_download.append(obj)
+        return to_download
+
+    def sync_hours(self, hours, lookahead=4):
+        """
+        Yields the local directory of each hour, in order, once it has been synced. Downloads continue for up to
+        lookahead hours ahead of the hour that was last yielded, so the caller can work on the hours as they arrive.
+        """
+        stats = {'hours': 0, 'skipped_hours': 0, 'objects': 0, 'downloaded': 0, 'bytes': 0}
+        start_time = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            listings = deque()
+            for hour in hours:
+                if self.manifest.is_complete(hour):
+                    listings.append((hour, None))
+                else:
+                    listings.append((hour, executor.submit(self.list_hour, hour)))
+
+            pending = deque()
+            while listings or pending:
+                if listings and len(pending) < lookahead:
+                    hour, listing = listings.popleft()
+                    objects = listing.result() if listing is not None else None
+                    downloads = [(obj, executor.submit(self.download, obj)) for obj in self.to_download(objects or [])]
+                    pending.append((hour, objects, downloads))
+                    continue
+
+                hour, objects, downloads = pending.popleft()
+                for obj, download in downloads:
+                    download.result()
+                    stats['downloaded'] += 1
+                    stats['bytes'] += obj['Size']
+
+                stats['hours'] += 1
+                if objects is None:
+                    stats['skipped_hours'] += 1
+                else:
+                    stats['objects'] += len(objects)
+                    self.manifest.save(hour, objects, hour_has_passed(hour))
+
+                yield os.path.join(self.local_dir, hour)
+
+        elapsed_seconds = max(time.monotonic() - start_time, 1e-9)
+        print('Synced {hours} hours ({skipped_hours} already complete) with {objects} objects. Downloaded {downloaded} '
+              'objects ({mb:.1f} MB) in {seconds:.1f}s.'.format(mb=stats['bytes'] / 1024 / 1024,
+                                                                seconds=elapsed_seconds, **stats), file=sys.stderr)
+
+    def close(self):
+        self.manifest.close()
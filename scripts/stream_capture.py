@@ -0,0 +1,317 @@
+"""
+Captures Kinesis records to rotating gzipped segment files and replays them into a Kinesis-compatible endpoint.
+
+A capture directory contains segment-NNNNNN.bin.gz files and an index.tsv file. Each record in a segment is stored as a
+header (arrival timestamp, partition key length, data length) followed by the partition key and the data.
+
+Records of several shards are interleaved, so arrival timestamps do not increase through a capture. The index splits
+each segment into windows and holds the latest arrival timestamp of each window along with the (segment, uncompressed
+offset) the window starts at. A replay from a start time skips the windows whose records all arrived before it.
+
+Used by read_from_stream.py's --capture and --replay modes.
+"""
+
+import glob
+import gzip
+import os
+import queue
+import random
+import struct
+import threading
+import time
+import zlib
+
+import boto3
+
+RECORD_HEADER = struct.Struct('>dHI')
+INDEX_FILE_NAME = 'index.tsv'
+
+# PutRecords limits, see https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecords.html
+MAX_RECORDS_PER_REQUEST = 500
+MAX_BYTES_PER_REQUEST = 5 * 1024 * 1024
+MAX_PUT_ATTEMPTS = 8
+MAX_BACKOFF_SECONDS = 5.0
+
+
+class SegmentWriter(object):
+    """
+    Writes records to gzipped segment files, starting a new segment once the current one holds max_segment_bytes of
+    uncompressed records. A window of the index is closed once it spans index_interval_seconds of arrival time or its
+    segment ends.
+    """
+
+    def __init__(self, directory, max_segment_bytes=64 * 1024 * 1024, index_interval_seconds=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self.index_interval_seconds = index_interval_seconds
+
+        # Continue numbering after any segments already in the directory so captures can be appended to.
+        self.segment_number = len(glob.glob(os.path.join(directory, 'segment-*.bin.gz')))
+        self.segment = None
+        self.segment_name = None
+        self.segment_bytes = 0
+        # The open window of the index: its offset, the first arrival timestamp and the latest arrival timestamp.
+        self.window = None
+        self.index = open(os.path.join(directory, INDEX_FILE_NAME), 'a')
+
+    def close_window(self):
+        if self.window is not None:
+            offset, _, max_timestamp = self.window
+            self.index.write(f'{max_timestamp}\t{self.segment_name}\t{offset}\n')
+            self.window = None
+
+    def rotate(self):
+        self.close_window()
+        if self.segment is not None:
+            self.segment.close()
+        self.segment_name = f'segment-{self.segment_number:06d}.bin.gz'
+        self.segment = gzip.open(os.path.join(self.directory, self.segment_name), 'wb')
+        self.segment_number += 1
+        self.segment_bytes = 0
+
+    def write(self, arrival_timestamp, partition_key, data):
+        if self.segment is None or self.segment_bytes >= self.max_segment_bytes:
+            self.rotate()
+
+        if self.window is not None and arrival_timestamp - self.window[1] >= self.index_interval_seconds:
+            self.close_window()
+        if self.window is None:
+            self.window = (self.segment_bytes, arrival_timestamp, arrival_timestamp)
+        else:
+            offset, first_timestamp, max_timestamp = self.window
+            self.window = (offset, first_timestamp, max(max_timestamp, arrival_timestamp))
+
+        encoded_key = partition_key.encode('utf-8')
+        self.segment.write(RECORD_HEADER.pack(arrival_timestamp, len(encoded_key), len(data)))
+        self.segment.write(encoded_key)
+        self.segment.write(data)
+        self.segment_bytes += RECORD_HEADER.size + len(encoded_key) + len(data)
+
+    def close(self):
+        self.close_window()
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+
+
+def capture(records, directory, **kwargs):
+    """
+    Writes (fetch time, shard id, record) tuples as returned by get_kinesis_record_iterator to a capture directory.
+    """
+    writer = SegmentWriter(directory, **kwargs)
+    count = 0
+    try:
+        for _, _, record in records:
+            writer.write(record['ApproximateArrivalTimestamp'].timestamp(), record['PartitionKey'], record['Data'])
+            count += 1
+            if count % 10000 == 0:
+                print(f'Captured {count} records to {writer.segment_name}.')
+    finally:
+        writer.close()
+        print(f'Captured {count} records in total.')
+
+
+def find_start(directory, start_timestamp):
+    """
+    Returns the (segment name, offset) of the first window with a record that arrived at or after start_timestamp. All
+    the records before it arrived earlier. If no window has one, returns the last window, as the records after it may
+    not have been indexed if the capture was interrupted.
+    """
+    with open(os.path.join(directory, INDEX_FILE_NAME)) as index:
+        entries = [line.rstrip('\n').split('\t') for line in index]
+
+    if not entries:
+        return None, 0
+    for max_timestamp, segment_name, offset in entries:
+        if float(max_timestamp) >= start_timestamp:
+            return segment_name, int(offset)
+    return entries[-1][1], int(entries[-1][2])
+
+
+def read_capture(directory, start_timestamp=None):
+    """
+    Yields (arrival timestamp, partition key, data) for the captured records in the order they were captured.
+    """
+    segment_names = sorted(os.path.basename(path) for path in glob.glob(os.path.join(directory, 'segment-*.bin.gz')))
+
+    start_segment, start_offset = None, 0
+    if start_timestamp is not None:
+        start_segment, start_offset = find_start(directory, start_timestamp)
+    if start_segment is None:
+        start_segment = segment_names[0] if segment_names else None
+
+    if start_segment is None:
+        return
+
+    for segment_name in segment_names:
+        if segment_name < start_segment:
+            continue
+
+        with gzip.open(os.path.join(directory, segment_name), 'rb') as segment:
+            if segment_name == start_segment:
+                segment.seek(start_offset)
+
+            while True:
+                header = segment.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                arrival_timestamp, key_length, data_length = RECORD_HEADER.unpack(header)
+                partition_key = segment.read(key_length).decode('utf-8')
+                data = segment.read(data_length)
+
+                if start_timestamp is None or arrival_timestamp >= start_timestamp:
+                    yield arrival_timestamp, partition_key, data
+
+
+class ReplayStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Records read from the capture, only counted by replay() itself.
+        self.read = 0
+        self.records = 0
+        self.bytes = 0
+        self.retried = 0
+
+    def add(self, records, num_bytes, retried):
+        with self.lock:
+            self.records += records
+            self.bytes += num_bytes
+            self.retried += retried
+
+
+def put_batch(client, stream_name, batch, stats):
+    """
+    Puts a batch of records, retrying the failed entries until all of them have been written.
+    """
+    records = [{'Data': data, 'PartitionKey': partition_key} for partition_key, data in batch]
+    num_records = len(records)
+    num_bytes = sum(len(record['Data']) for record in records)
+    retried = 0
+
+    for attempt in range(MAX_PUT_ATTEMPTS):
+        response = client.put_records(Records=records, StreamName=stream_name)
+        if response['FailedRecordCount'] == 0:
+            stats.add(num_records, num_bytes, retried)
+            return
+
+        records = [record for record, result in zip(records, response['Records']) if 'ErrorCode' in result]
+        retried += len(records)
+        time.sleep(random.uniform(0, min(MAX_BACKOFF_SECONDS, 0.1 * 2 ** attempt)))
+
+    raise RuntimeError(f'Could not put {len(records)} records on stream {stream_name} after {MAX_PUT_ATTEMPTS} '
+                       f'attempts.')
+
+
+def send_lane(client, stream_name, lane_queue, stats, errors):
+    """
+    Sends the records of one lane in order. A batch never holds two records with the same partition key and a batch is
+    only sent once the previous one has been fully written, so records keep their order within each partition key.
+    """
+    done = False
+    pending = None
+    while not done:
+        batch = []
+        batch_keys = set()
+        batch_bytes = 0
+
+        while len(batch) < MAX_RECORDS_PER_REQUEST:
+            if pending is not None:
+                item = pending
+                pending = None
+            else:
+                try:
+                    # Block for the first record of a batch and only take what is already waiting for the rest.
+                    item = lane_queue.get(timeout=None if not batch else 0.05)
+                except queue.Empty:
+                    break
+
+            if item is None:
+                done = True
+                break
+
+            partition_key, data = item
+            if partition_key in batch_keys or batch_bytes + len(data) + len(partition_key) > MAX_BYTES_PER_REQUEST:
+                pending = item
+                break
+
+            batch.append(item)
+            batch_keys.add(partition_key)
+            batch_bytes += len(data) + len(partition_key)
+
+        if batch:
+            try:
+                put_batch(client, stream_name, batch, stats)
+            except Exception as err:
+                errors.append(err)
+                # Keep draining the lane so the reader never blocks on it while it winds down.
+                while not done and lane_queue.get() is not None:
+                    pass
+                return
+
+
+def replay(directory, stream_name, speed=1.0, endpoint_url=None, lanes=8, start_timestamp=None, stats=None):
+    """
+    Replays a capture directory into a stream at speed times the original rate, or as fast as possible if speed is 0.
+
+    Records are spread over lanes by partition key and each lane sends its records in order. The pace follows the latest
+    arrival timestamp replayed so far, so records that arrived earlier than one before them, e.g. from another shard,
+    are sent right away.
+
+    The records read and sent are counted in stats, a ReplayStats, which can be given to see them also if the replay
+    fails or is interrupted. Returns stats.
+    """
+    client = boto3.client('kinesis', endpoint_url=endpoint_url)
+    stats = stats if stats is not None else ReplayStats()
+    errors = []
+    lane_queues = [queue.Queue(maxsize=MAX_RECORDS_PER_REQUEST * 4) for _ in range(lanes)]
+    threads = [threading.Thread(target=send_lane, args=(client, stream_name, lane_queue, stats, errors), daemon=True)
+               for lane_queue in lane_queues]
+    for thread in threads:
+        thread.start()
+
+    first_arrival_timestamp = None
+    min_arrival_timestamp = None
+    max_arrival_timestamp = None
+    start_time = time.monotonic()
+    last_report_time = start_time
+
+    for arrival_timestamp, partition_key, data in read_capture(directory, start_timestamp):
+        if errors:
+            break
+        stats.read += 1
+
+        if first_arrival_timestamp is None:
+            first_arrival_timestamp = min_arrival_timestamp = max_arrival_timestamp = arrival_timestamp
+        min_arrival_timestamp = min(min_arrival_timestamp, arrival_timestamp)
+
+        if speed > 0 and arrival_timestamp > max_arrival_timestamp:
+            max_arrival_timestamp = arrival_timestamp
+            due_in_seconds = (arrival_timestamp - first_arrival_timestamp) / speed - (time.monotonic() - start_time)
+            if due_in_seconds > 0:
+                time.sleep(due_in_seconds)
+        max_arrival_timestamp = max(max_arrival_timestamp, arrival_timestamp)
+
+        lane = zlib.crc32(partition_key.encode('utf-8')) % lanes
+        lane_queues[lane].put((partition_key, data))
+
+        now = time.monotonic()
+        if now - last_report_time >= 10:
+            print(f'Replayed {stats.records} records ({stats.records / (now - start_time):.0f} records/s).')
+            last_report_time = now
+
+    for lane_queue in lane_queues:
+        lane_queue.put(None)
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    elapsed_seconds = max(time.monotonic() - start_time, 1e-9)
+    captured_seconds = (max_arrival_timestamp - min_arrival_timestamp) if first_arrival_timestamp is not None else 0
+    print(f'Replayed {stats.records} records ({stats.bytes} bytes) into {stream_name} in {elapsed_seconds:.1f}s: '
+          f'{stats.records / elapsed_seconds:.0f} records/s, {stats.bytes / elapsed_seconds / 1024 / 1024:.2f} MB/s. '
+          f'The capture spans {captured_seconds:.1f}s, so the achieved speed-up is '
+          f'{captured_seconds / elapsed_seconds:.2f}x. Retried {stats.retried} records.')
+    return stats
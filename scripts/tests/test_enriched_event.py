@@ -0,0 +1,21 @@
+from enriched_event import COLUMNS, EnrichedEventParser
+
+
+def make_line(**values):
+    return ('\t'.join(values.get(column, '') for column in COLUMNS) + '\n').encode('utf-8')
+
+
+def test_parse_reads_requested_columns():
+    parser = EnrichedEventParser(['page_url', 'app_id', 'contexts'], filters={'event': 'page_view'})
+    line = make_line(app_id='jp', event='page_view', page_url='https://jyllands-posten.dk/', contexts='{"data": []}')
+
+    assert tuple(parser.parse(line)) == ('https://jyllands-posten.dk/', 'jp', {'data': []})
+    assert parser.parse(line.replace(b'page_view', b'page_ping')) is None
+
+
+def test_parse_keeps_empty_trailing_columns():
+    parser = EnrichedEventParser(['event_fingerprint', 'true_tstamp'])
+
+    assert tuple(parser.parse(make_line(event_fingerprint='abc'))) == ('abc', '')
+    assert tuple(parser.parse(make_line(true_tstamp='2019-05-20 10:00:00.000').replace(b'\n', b'\r\n'))) == \
+        ('', '2019-05-20 10:00:00.000')
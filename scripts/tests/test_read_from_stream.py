@@ -0,0 +1,70 @@
+"""
+Checks where read_from_stream starts reading shards, with a stand-in for the Kinesis client.
+"""
+from datetime import datetime, timezone
+
+import read_from_stream
+
+START_TIMESTAMP = datetime(2019, 5, 20, tzinfo=timezone.utc)
+
+
+class FakeKinesisClient(object):
+    """
+    Serves a stream whose parent shard closed before the start timestamp and was split into two children. Every shard
+    is closed after one call to get_records so the reader stops.
+    """
+
+    def __init__(self):
+        self.shards = [
+            {'ShardId': 'shardId-000', 'SequenceNumberRange': {'StartingSequenceNumber': '1',
+                                                               'EndingSequenceNumber': '9'}},
+            {'ShardId': 'shardId-001', 'ParentShardId': 'shardId-000',
+             'SequenceNumberRange': {'StartingSequenceNumber': '10'}},
+            {'ShardId': 'shardId-002', 'ParentShardId': 'shardId-000',
+             'SequenceNumberRange': {'StartingSequenceNumber': '20'}},
+        ]
+        self.iterator_args = {}
+
+    def list_shards(self, **kwargs):
+        return {'Shards': self.shards}
+
+    def get_shard_iterator(self, StreamName, ShardId, **iterator_args):
+        self.iterator_args[ShardId] = iterator_args
+        return {'ShardIterator': ShardId}
+
+    def get_records(self, ShardIterator):
+        records = [] if ShardIterator == 'shardId-000' else [{'SequenceNumber': ShardIterator[-1], 'Data': b''}]
+        return {'Records': records, 'MillisBehindLatest': 0}
+
+
+def read_all(client, iterator_type, **kwargs):
+    return [shard_id for _, shard_id, _ in
+            read_from_stream.get_kinesis_record_iterator('stream', iterator_type, client=client, **kwargs)]
+
+
+def test_children_of_closed_parent_start_at_timestamp():
+    client = FakeKinesisClient()
+
+    assert sorted(read_all(client, 'AT_TIMESTAMP', start_timestamp=START_TIMESTAMP)) == ['shardId-001', 'shardId-002']
+    expected = {'ShardIteratorType': 'AT_TIMESTAMP', 'Timestamp': START_TIMESTAMP}
+    assert client.iterator_args == {'shardId-000': expected, 'shardId-001': expected, 'shardId-002': expected}
+
+
+def test_children_of_closed_parent_start_at_trim_horizon():
+    client = FakeKinesisClient()
+    # Resuming after the end of the parent reads the children from their beginning.
+    checkpoints = {'shardId-000': '9'}
+
+    class Store(object):
+        def load(self):
+            return checkpoints
+
+        def save(self, positions):
+            pass
+
+    assert sorted(read_all(client, 'LATEST', checkpoint_store=Store(), resume=True)) == ['shardId-001', 'shardId-002']
+    assert client.iterator_args == {
+        'shardId-000': {'ShardIteratorType': 'AFTER_SEQUENCE_NUMBER', 'StartingSequenceNumber': '9'},
+        'shardId-001': {'ShardIteratorType': 'TRIM_HORIZON'},
+        'shardId-002': {'ShardIteratorType': 'TRIM_HORIZON'},
+    }
@@ -0,0 +1,24 @@
+from verify_snowplow import Context, ContextExtractor
+
+USER_SCHEMA = "iglu:dk.jyllands-posten/user/jsonschema/2-0-3"
+PAGE_VIEW_SCHEMA = "iglu:dk.jyllands-posten/page_view/jsonschema/1-0-0"
+
+
+def test_extract_nested_properties():
+    extractor = ContextExtractor([
+        Context("dk.jyllands-posten/user/", [("user_id", str), ("group.corp_id", str), ("group.size", int)]),
+        Context("dk.jyllands-posten/page_view/", [("content_id", int), ("site.name", str)]),
+    ])
+    contexts = [
+        {"schema": PAGE_VIEW_SCHEMA, "data": {"content_id": "123", "site": "jyllands-posten.dk"}},
+        {"schema": USER_SCHEMA, "data": {"user_id": "u1", "group": {"corp_id": "c1", "size": "many"}}},
+        # Only the first context of a schema is used.
+        {"schema": USER_SCHEMA, "data": {"user_id": "u2", "group": {"corp_id": "c2", "size": 3}}},
+    ]
+
+    assert extractor.column_names == ["dk.jyllands-posten/user/user_id", "dk.jyllands-posten/user/group.corp_id",
+                                      "dk.jyllands-posten/user/group.size", "dk.jyllands-posten/page_view/content_id",
+                                      "dk.jyllands-posten/page_view/site.name"]
+    # A path through a value that is not an object is missing, and values that cannot be converted get the default.
+    assert extractor.extract(contexts) == ["u1", "c1", 0, 123, None]
+    assert extractor.extract([]) == [None, None, None, None, None]
@@ -1,34 +1,166 @@
 """
 This tool does 2 things:
-1) Make downloading Snowplow files from S3 for given dates in a specific timezone easier.
+1) Print "aws s3 sync" commands that download Snowplow files from S3 for given dates in a specific timezone. With
+   --download the hours are downloaded by the tool itself instead, concurrently and only new or changed files again,
+   see s3_hour_sync.py.
 2) Extract specific columns of the Snowplow events including exploding contexts into columns.
 
+Extraction can be spread over several processes with --jobs. The output is the same as with a single process. Large
+files are split into chunks of lines, so the memory used per process does not grow with the size of the files.
+Extract can sync the hours itself with --fetch and starts on each hour as soon as it has been downloaded.
+
+Extracted events are written as CSV by default. Use --format parquet or --format arrow (an Arrow IPC stream) to get
+typed columns that can be loaded without parsing text, e.g.
+    python verify_snowplow.py extract --jobs 0 --format parquet --output page_views.parquet 20170906 20170909
+
+The CSV header and the Parquet and Arrow schemas have a column per extracted context property. New properties are
+added as the last columns so the columns of older extracts keep their positions.
+
 This tool is intended to be used for verifying Snowplow data against other tracking systems by
 mangling Snowplow events into a format that is more easily comparable to, say, Google Analytics.
 
-Prerequisites: pytz (pip install pytz)
+Prerequisites: pytz (pip install pytz), boto3 (pip install boto3) for --download and --fetch and pyarrow
+(pip install pyarrow) for Parquet and Arrow output.
 
 Author: Asger Bachmann (asger.g.bachmann@jp.dk)
 """
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta, datetime
 from glob import iglob
+from itertools import islice
+import argparse
+import os
 import sys
 import gzip
-import json
 from pytz import timezone
 
+from enriched_event import EnrichedEventParser
+from instrumentation import Metrics
+
 
 class Context(object):
     def __init__(self, schema_name, expected_properties):
+        """
+        schema_name: The "vendor/name/" part of the context's Iglu schema URI, e.g. "dk.jyllands-posten/user/".
+        expected_properties: (property, conv_fn) pairs. A property can be a "."-separated path into nested objects.
+        """
         self.schema_name = schema_name
         self.expected_properties = expected_properties
 
 
-def get_hour_deltas():
-    raw_start_date = sys.argv[2]
-    raw_end_date = sys.argv[3]
+def schema_key(schema):
+    """
+    Returns the "vendor/name" part of an Iglu schema URI, e.g. "dk.jyllands-posten/user" for
+    "iglu:dk.jyllands-posten/user/jsonschema/1-0-0".
+    """
+    if schema.startswith("iglu:"):
+        schema = schema[5:]
+    return "/".join(schema.split("/", 2)[:2])
+
+
+def make_converter(conv_fn):
+    # Ensure the column has the correct type by converting it using the conv_fn. If this fails in any way, e.g. with an
+    # OverflowError for int(float("inf")), use the conv_fn's default value as the property value (e.g. int() == 0).
+    # Values that already have the type are used as they are.
+    default = conv_fn()
+
+    def convert(value):
+        if type(value) is conv_fn:
+            return value
+        try:
+            return conv_fn(value)
+        except Exception:
+            return default
+
+    return convert
+
+
+# Marks properties that are not in their context or whose context is not in the event.
+NOTSET = object()
+
+
+class ContextExtractor(object):
+    """
+    Extracts the expected properties of a list of Contexts from the contexts of events. The Contexts are compiled once
+    into a flat plan of (schema, property path, converter) steps, so each event only needs one pass over its contexts.
+    """
+
+    def __init__(self, contexts_to_extract):
+        self.schema_keys = set()
+        self.plan = []
+        self.column_names = []
+        self.column_types = []
+        for context in contexts_to_extract:
+            key = schema_key(context.schema_name)
+            self.schema_keys.add(key)
+            for (expected_property, conv_fn) in context.expected_properties:
+                self.plan.append((key, expected_property.split("."), make_converter(conv_fn)))
+                self.column_names.append(context.schema_name + expected_property)
+                self.column_types.append(conv_fn)
+
+    def extract(self, contexts):
+        """
+        Returns the converted properties in the order of the plan. Missing properties are None.
+        """
+        data_by_schema = {}
+        for context in contexts:
+            key = schema_key(context["schema"])
+            # Like the Scala ContextExploder, use the first context of each schema.
+            if key in self.schema_keys and key not in data_by_schema:
+                data_by_schema[key] = context["data"]
+
+        res = []
+        for key, path, convert in self.plan:
+            value = data_by_schema.get(key)
+            for name in path:
+                if not isinstance(value, dict) or name not in value:
+                    value = NOTSET
+                    break
+                value = value[name]
+
+            res.append(None if value is NOTSET else convert(value))
+
+        return res
+
+
+TO_EXTRACT = [
+    "app_id", "platform", "collector_tstamp",
+    "domain_userid", "network_userid", "user_ipaddress",
+    "domain_sessionid", "dvce_type",
+    "os_name", "os_family", "page_url", "page_referrer",
+    "br_name", "br_family"
+]
+
+CONTEXTS_TO_EXTRACT = [
+    Context("com.google.analytics/cookies/", [("_ga", str)]),
+    Context("dk.jyllands-posten/user/", [("anon_id", str), ("user_id", str), ("user_authenticated", str), ("user_authorized", str), ("ab_group", int)]),  # nopep8
+    Context("dk.jyllands-posten/page_view/", [("section_id", int), ("section_name", str), ("content_id", int), ("content_type", str), ("page_name", str), ("page_type", str), ("page_restricted", str), ("site", str), ("sub_site", str), ("editorial_category", str)]),  # nopep8
+    # Added after the columns above, so they come last and the earlier columns keep their positions.
+    Context("dk.jyllands-posten/user/", [("grp_authenticated", str), ("grp_authorized", str), ("corp_id", str)]),
+]
+CONTEXT_EXTRACTOR = ContextExtractor(CONTEXTS_TO_EXTRACT)
+CONTEXTS_COLS_NAMES = CONTEXT_EXTRACTOR.column_names
+
+S3_BUCKET = "jpmedier-datalake"
+S3_PREFIX = "snowplow/"
+
+# Maximum number of rows per Arrow record batch. The writer collects batches into Parquet row groups of about this size.
+ARROW_BATCH_ROWS = 65536
+
+# Files larger than this are read by the main process and handed to the workers in chunks of lines.
+CHUNK_FILE_SIZE = 16 * 1024 * 1024
+CHUNK_LINES = 20000
+
+
+# Only page views are extracted, so the other events are skipped before their columns are decoded.
+PARSER = EnrichedEventParser(TO_EXTRACT + ["contexts"], filters={"event": "page_view"})
 
+METRICS = Metrics("verify_snowplow")
+
+
+def get_hour_deltas(raw_start_date, raw_end_date):
     start_date_format = "%Y%m%d" if len(raw_start_date) == 8 else "%Y%m%d%H"
     end_date_format = "%Y%m%d" if len(raw_end_date) == 8 else "%Y%m%d%H"
 
@@ -47,108 +179,268 @@ def get_hour_deltas():
         yield suffix
 
 
-def print_cli_sync_cmds():
-    base_s3_path = "s3://jpmedier-datalake/snowplow/"
+def print_cli_sync_cmds(raw_start_date, raw_end_date):
+    base_s3_path = "s3://{}/{}".format(S3_BUCKET, S3_PREFIX)
 
-    for s3_suffix in get_hour_deltas():
+    for s3_suffix in get_hour_deltas(raw_start_date, raw_end_date):
         s3_path = base_s3_path + s3_suffix
         cli_cmd = "aws s3 sync {} {}".format(s3_path, s3_suffix)
         print(cli_cmd)
 
 
-def explode_contexts(contexts, contexts_to_extract):
-    res = []
-
-    for context_to_extract in contexts_to_extract:
-        for context in contexts:
-            if context["schema"].startswith("iglu:" + context_to_extract.schema_name):
-                context_data = context["data"]
-                for (expected_property, conv_fn) in context_to_extract.expected_properties:
-                    if expected_property in context_data:
-                        raw_property_val = context_data[expected_property]
-                        try:
-                            # Ensure the column has the correct type by attempting to convert it using the conv_fn.
-                            converted_propery_val = conv_fn(raw_property_val)
-                        except Exception as e:
-                            # If this fails, use the conv_fn's default value as the property value (e.g. int() == 0).
-                            converted_propery_val = conv_fn()
-
-                        res.append(str(converted_propery_val))
-                    else:
-                        res.append("NOTSET")
-
-                break
-    
-    return res
-
-
 def quote(s):
     return "\"" + s.replace("\"", "\\\"") + "\""
 
 
-def extract():
-    sp_columns = ["app_id", "platform", "etl_tstamp", "collector_tstamp", "dvce_created_tstamp", "event", "event_id", "txn_id", "name_tracker", "v_tracker", "v_collector", "v_etl", "user_id", "user_ipaddress", "user_fingerprint", "domain_userid", "domain_sessionidx", "network_userid", "geo_country", "geo_region", "geo_city", "geo_zipcode", "geo_latitude", "geo_longitude", "geo_region_name", "ip_isp", "ip_organization", "ip_domain", "ip_netspeed", "page_url", "page_title", "page_referrer", "page_urlscheme", "page_urlhost", "page_urlport", "page_urlpath", "page_urlquery", "page_urlfragment", "refr_urlscheme", "refr_urlhost", "refr_urlport", "refr_urlpath", "refr_urlquery", "refr_urlfragment", "refr_medium", "refr_source", "refr_term", "mkt_medium", "mkt_source", "mkt_term", "mkt_content", "mkt_campaign", "contexts", "se_category", "se_action", "se_label", "se_property", "se_value", "unstruct_event", "tr_orderid", "tr_affiliation", "tr_total", "tr_tax", "tr_shipping", "tr_city", "tr_state", "tr_country", "ti_orderid", "ti_sku", "ti_name", "ti_category", "ti_price", "ti_quantity", "pp_xoffset_min", "pp_xoffset_max", "pp_yoffset_min", "pp_yoffset_max", "useragent", "br_name", "br_family", "br_version", "br_type", "br_renderengine", "br_lang", "br_features_pdf", "br_features_flash", "br_features_java", "br_features_director", "br_features_quicktime", "br_features_realplayer", "br_features_windowsmedia", "br_features_gears", "br_features_silverlight", "br_cookies", "br_colordepth", "br_viewwidth", "br_viewheight", "os_name", "os_family", "os_manufacturer", "os_timezone", "dvce_type", "dvce_ismobile", "dvce_screenwidth", "dvce_screenheight", "doc_charset", "doc_width", "doc_height", "tr_currency", "tr_total_base", "tr_tax_base", "tr_shipping_base", "ti_currency", "ti_price_base", "base_currency", "geo_timezone", "mkt_clickid", "mkt_network", "etl_tags", "dvce_sent_tstamp", "refr_domain_userid", "refr_device_tstamp", "derived_contexts", "domain_sessionid", "derived_tstamp", "event_vendor", "event_name", "event_format", "event_version", "event_fingerprint", "true_tstamp"]  # nopep8
-    to_extract = [
-        "app_id", "platform", "collector_tstamp",
-        "domain_userid", "network_userid", "user_ipaddress",
-        "domain_sessionid", "dvce_type",
-        "os_name", "os_family", "page_url", "page_referrer",
-        "br_name", "br_family"
-    ]
-
-    contexts_to_extract = [
-        Context("com.google.analytics/cookies/", [("_ga", str)]),
-        Context("dk.jyllands-posten/user/", [("anon_id", str), ("user_id", str), ("user_authenticated", str), ("user_authorized", str), ("ab_group", int)]),  # nopep8
-        Context("dk.jyllands-posten/page_view/", [("section_id", int), ("section_name", str), ("content_id", int), ("content_type", str), ("page_name", str), ("page_type", str), ("page_restricted", str), ("site", str), ("sub_site", str), ("editorial_category", str)])  # nopep8
-    ]
-    contexts_cols_names = [c.schema_name + p for c in contexts_to_extract for (p, _) in c.expected_properties]
-
-    contexts_idx = sp_columns.index("contexts")
-    event_idx = sp_columns.index("event")
-    to_extract_idx = [sp_columns.index(x) for x in to_extract]
+def extract_lines(lines):
+    for event in PARSER.parse_lines(lines):
+        *extracted_cols, contexts = event
 
-    all_col_names = to_extract + contexts_cols_names
-    quoted_col_names = (quote(n) for n in all_col_names)
-    print(",".join(quoted_col_names))
+        contexts = contexts["data"] if contexts is not None else []
+        yield extracted_cols + CONTEXT_EXTRACTOR.extract(contexts)
 
-    # Embarrassingly parallel over the dir_base values. If it takes too long, simply parallelize it.
-    for dir_base in get_hour_deltas():
-        for file_name in iglob(dir_base + "/*.gz"):
-            with gzip.open(file_name, "rb") as f:
-                for line in f:
-                    cols = line.decode("utf-8").split("\t")
 
-                    if cols[event_idx] != "page_view":
-                        continue
-
-                    extracted_cols = [cols[idx] for idx in to_extract_idx]
-
-                    contexts = json.loads(cols[contexts_idx])["data"]
-                    contexts_cols = explode_contexts(contexts, contexts_to_extract)
-
-                    all_cols = extracted_cols + contexts_cols
-                    quoted_cols = (quote(c) for c in all_cols)
-                    print(",".join(quoted_cols))
-
-
-def print_usage_and_exit():
-    print("USAGE: python verify_snowplow.py {sync|extract} START_DATE END_DATE")
-    print("")
-    print("START_DATE and END_DATE must be Europe/Copenhagen dates in the format \"%Y%m%d\" or \"%Y%m%d%H\".")
-    print("START_DATE is inclusive, END_DATE is exclusive to the hour.")
-    print("")
-    print("EXAMPLE: python generate_s3_paths.py 20170906 20170907")
-    print("")
-    print("EXAMPLE: python generate_s3_paths.py 2017090615 2017090710")
-    exit(1)
+def extract_events(task):
+    """
+    Yields the extracted columns of the page views of a task from get_tasks(). Context properties have the type of their
+    conv_fn and are None if they are missing.
+    """
+    file_name, lines = task
+    if lines is None:
+        with gzip.open(file_name, "rb") as f:
+            yield from extract_lines(f)
+    else:
+        yield from extract_lines(lines)
+
+
+def extract_csv_rows(task):
+    """
+    Returns the quoted CSV rows of the page views of a task.
+    """
+    rows = []
+    for all_cols in extract_events(task):
+        quoted_cols = (quote("NOTSET" if c is None else str(c)) for c in all_cols)
+        rows.append(",".join(quoted_cols))
+
+    return rows
+
+
+def get_arrow_schema():
+    import pyarrow as pa
+
+    arrow_types = {str: pa.string(), int: pa.int64(), float: pa.float64(), bool: pa.bool_()}
+    fields = [pa.field(n, pa.string()) for n in TO_EXTRACT]
+    fields += [pa.field(n, arrow_types[t]) for n, t in zip(CONTEXTS_COLS_NAMES, CONTEXT_EXTRACTOR.column_types)]
+    return pa.schema(fields)
+
+
+def extract_record_batches(task):
+    """
+    Returns the page views of a task as Arrow record batches of at most ARROW_BATCH_ROWS rows each.
+    """
+    import pyarrow as pa
+
+    schema = get_arrow_schema()
+    batches = []
+    events = extract_events(task)
+    while True:
+        rows = list(islice(events, ARROW_BATCH_ROWS))
+        if not rows:
+            break
+        columns = zip(*rows)
+        arrays = [pa.array(column, type=field.type) for column, field in zip(columns, schema)]
+        batches.append(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+    return batches
+
+
+class CsvWriter(object):
+    def __init__(self, output):
+        self.output = output
+        self.num_rows = 0
+        all_col_names = TO_EXTRACT + CONTEXTS_COLS_NAMES
+        quoted_col_names = (quote(n) for n in all_col_names)
+        self.output.write(",".join(quoted_col_names) + "\n")
+
+    def write(self, rows):
+        if rows:
+            self.output.write("\n".join(rows) + "\n")
+            self.num_rows += len(rows)
+
+    def close(self):
+        self.output.flush()
+
+
+class ArrowWriter(object):
+    """
+    Writes record batches to a Parquet file or as an Arrow IPC stream. The batches of small files and chunks are
+    collected until there are ARROW_BATCH_ROWS rows, so the Parquet row groups do not get smaller than that.
+    """
+
+    def __init__(self, output, output_format):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.schema = get_arrow_schema()
+        self.num_rows = 0
+        self.pending = []
+        self.pending_rows = 0
+        if output_format == "parquet":
+            self.writer = pq.ParquetWriter(output, self.schema)
+        else:
+            self.writer = pa.RecordBatchStreamWriter(output, self.schema)
+
+    def write(self, batches):
+        for batch in batches:
+            self.pending.append(batch)
+            self.pending_rows += batch.num_rows
+            self.num_rows += batch.num_rows
+            if self.pending_rows >= ARROW_BATCH_ROWS:
+                self.flush()
+
+    def flush(self):
+        import pyarrow as pa
+
+        if self.pending:
+            self.writer.write_table(pa.Table.from_batches(self.pending, schema=self.schema))
+            self.pending = []
+            self.pending_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def map_in_order(executor, fn, items, max_pending):
+    """
+    Like executor.map() but with at most max_pending items in flight, so results never pile up faster than they are
+    written.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+def get_file_names(hours):
+    for dir_base in hours:
+        # Sort the files so the output does not depend on the order the file system lists them in.
+        for file_name in sorted(iglob(dir_base + "/*.gz")):
+            yield file_name
+
+
+def get_tasks(file_names):
+    """
+    Yields (file name, lines) tasks. Small files are read by the worker itself, which is signalled by lines being None.
+    Large files are read here and split into chunks of CHUNK_LINES lines.
+    """
+    for file_name in file_names:
+        if os.path.getsize(file_name) <= CHUNK_FILE_SIZE:
+            yield file_name, None
+            continue
+
+        with gzip.open(file_name, "rb") as f:
+            while True:
+                lines = list(islice(f, CHUNK_LINES))
+                if not lines:
+                    break
+                yield file_name, lines
+
+
+def make_hour_sync(args):
+    # Only import boto3 when syncing, so extracting files that have already been downloaded does not need it.
+    from s3_hour_sync import HourSync
+    return HourSync(args.bucket, args.prefix, args.local_dir, args.endpoint_url, args.fetch_jobs)
+
+
+def extract(hour_dirs, jobs=1, output_format="csv", output=None):
+    """
+    Extracts the page views in the given local hour directories as CSV, Parquet or an Arrow IPC stream. output is a
+    file name or None for stdout, which Parquet does not support.
+    """
+    if output_format == "csv":
+        out_file = open(output, "w") if output is not None else sys.stdout
+        writer = CsvWriter(out_file)
+        extract_fn = extract_csv_rows
+    else:
+        out_file = output if output is not None else sys.stdout.buffer
+        writer = ArrowWriter(out_file, output_format)
+        extract_fn = extract_record_batches
+
+    tasks = get_tasks(get_file_names(hour_dirs))
+
+    # Embarrassingly parallel over the files and chunks. The results are written in file order, so the output does not
+    # depend on the number of processes.
+    try:
+        with METRICS.stage("extract", output_format=output_format, jobs=jobs) as stage:
+            if jobs == 1:
+                for result in map(extract_fn, tasks):
+                    writer.write(result)
+            else:
+                with ProcessPoolExecutor(max_workers=jobs) as executor:
+                    for result in map_in_order(executor, extract_fn, tasks, jobs * 2):
+                        writer.write(result)
+            stage.rows_out = writer.num_rows
+    finally:
+        writer.close()
+        if output is not None and output_format == "csv":
+            out_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="START_DATE and END_DATE must be Europe/Copenhagen dates in the format \"%%Y%%m%%d\" or "
+                    "\"%%Y%%m%%d%%H\". START_DATE is inclusive, END_DATE is exclusive to the hour.",
+        epilog="EXAMPLE: python verify_snowplow.py sync 20170906 20170907    "
+               "EXAMPLE: python verify_snowplow.py sync --download 20170906 20170907    "
+               "EXAMPLE: python verify_snowplow.py extract --jobs 8 2017090615 2017090710    "
+               "EXAMPLE: python verify_snowplow.py extract --fetch --jobs 8 2017090615 2017090710")
+    parser.add_argument("command", choices=["sync", "extract"])
+    parser.add_argument("start_date", metavar="START_DATE")
+    parser.add_argument("end_date", metavar="END_DATE")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes to extract with. Use 0 for one per CPU. Default: 1.")
+    parser.add_argument("--format", dest="output_format", choices=["csv", "parquet", "arrow"], default="csv",
+                        help="Output format of extract. arrow is an Arrow IPC stream. Default: csv.")
+    parser.add_argument("-o", "--output", help="File to write the extracted events to. Default: stdout.")
+    parser.add_argument("--download", action="store_true",
+                        help="Make sync download the hours instead of printing an \"aws s3 sync\" command per hour.")
+    parser.add_argument("--fetch", action="store_true",
+                        help="Sync the hours before extracting them. Extraction starts as soon as the first hour has "
+                             "been synced.")
+    parser.add_argument("--local-dir", default=".", help="Directory the hours are synced to. Default: .")
+    parser.add_argument("--bucket", default=S3_BUCKET, help="Default: " + S3_BUCKET)
+    parser.add_argument("--prefix", default=S3_PREFIX, help="Default: " + S3_PREFIX)
+    parser.add_argument("--endpoint-url", help="S3 endpoint, e.g. of a local S3-compatible server.")
+    parser.add_argument("--fetch-jobs", type=int, default=16,
+                        help="Number of concurrent S3 downloads. Default: 16.")
+    args = parser.parse_args()
+
+    if args.output_format == "parquet" and args.output is None:
+        parser.error("--format parquet requires --output")
+
+    hours = get_hour_deltas(args.start_date, args.end_date)
+
+    with METRICS.profile("{}-{}-{}".format(args.command, args.start_date, args.end_date)):
+        if args.command == "sync" and not args.download:
+            print_cli_sync_cmds(args.start_date, args.end_date)
+        elif args.command == "sync":
+            hour_sync = make_hour_sync(args)
+            for _ in hour_sync.sync_hours(hours):
+                pass
+            hour_sync.close()
+        elif args.fetch:
+            hour_sync = make_hour_sync(args)
+            extract(hour_sync.sync_hours(hours), args.jobs or os.cpu_count(), args.output_format, args.output)
+            hour_sync.close()
+        else:
+            hour_dirs = (os.path.join(args.local_dir, hour) for hour in hours)
+            extract(hour_dirs, args.jobs or os.cpu_count(), args.output_format, args.output)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print_usage_and_exit()
-    elif sys.argv[1] == "sync":
-        print_cli_sync_cmds()
-    elif sys.argv[1] == "extract":
-        extract()
-    else:
-        print_usage_and_exit()
+    main()
@@ -0,0 +1,183 @@
+"""
+Computes the DFP page views with Arrow compute functions instead of pandas, so the data stays in Arrow memory from the
+Parquet read to the Parquet write and string columns are never materialized as Python objects.
+
+The rules are the same as in the pandas path of move_to_dfp.py and assert_same_output() checks that the two agree, see
+tests/test_arrow_engine.py.
+"""
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from s3fs import S3FileSystem
+
+from input import (bot_classifier, get_input_path, metrics, open_dataset, PAGE_PING_COLUMNS, PAGE_VIEW_COLUMNS,
+                   SCROLL_REACH_COLUMNS, SCROLL_REACH_FILTERS)
+
+ROW_NUMBER = '__row_number'
+
+
+def remove_bots(table: pa.Table) -> pa.Table:
+    # Classify each distinct user agent once, like the pandas path.
+    useragents = table.column('useragent')
+    bot_useragents = [useragent for useragent in pc.unique(useragents).to_pylist()
+                      if useragent is not None and bot_classifier.is_bot_useragent(useragent)]
+    is_bot = pc.is_in(useragents, value_set=pa.array(bot_useragents, type=pa.string()))
+    return table.filter(pc.invert(is_bot))
+
+
+def read_table(s3_bucket: str, event: str, date_to_process: date, hour_to_process: int, fs: S3FileSystem,
+               columns: Set[str], filters: Optional[list] = None) -> pa.Table:
+    in_path = get_input_path(s3_bucket, event, date_to_process, hour_to_process)
+    logging.info(f'Reading {event} data from input path {in_path} into Arrow.')
+
+    with metrics.stage('read_table', event=event, date=date_to_process.isoformat(), hour=hour_to_process) as stage:
+        try:
+            # The row-group statistics are used to skip row groups and the filters are applied to the rows as well.
+            table = open_dataset(in_path, fs).to_table(
+                columns=sorted(columns), filter=pq.filters_to_expression(filters) if filters else None)
+        except OSError:
+            raise RuntimeError(f'Unexpected error occurred when reading {event} data.' +
+                               f' Make sure the path {in_path} exists and that you have access to it.')
+
+        without_bots = remove_bots(table)
+        stage.rows_in, stage.rows_out = table.num_rows, without_bots.num_rows
+        return without_bots
+
+
+def read_datasets(s3_bucket: str, date_to_process: date, hour_to_process: int, fs: S3FileSystem)\
+        -> Tuple[pa.Table, pa.Table, pa.Table]:
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        pvs = executor.submit(read_table, s3_bucket, 'page_view', date_to_process, hour_to_process, fs,
+                              PAGE_VIEW_COLUMNS)
+        pps = executor.submit(read_table, s3_bucket, 'page_ping', date_to_process, hour_to_process, fs,
+                              PAGE_PING_COLUMNS)
+        scroll_reach = executor.submit(read_table, s3_bucket, 'struct', date_to_process, hour_to_process, fs,
+                                       SCROLL_REACH_COLUMNS, SCROLL_REACH_FILTERS)
+        return pvs.result(), pps.result(), scroll_reach.result()
+
+
+def drop_columns(table: pa.Table, names: Set[str]) -> pa.Table:
+    return table.select([name for name in table.column_names if name not in names])
+
+
+def with_row_numbers(table: pa.Table) -> pa.Table:
+    return table.append_column(ROW_NUMBER, pa.array(np.arange(len(table), dtype=np.int64)))
+
+
+def drop_duplicate_page_views(pvs: pa.Table) -> pa.Table:
+    """
+    Keeps the first page view of each web_page_id in the original order, like DataFrame.drop_duplicates().
+    """
+    pvs = with_row_numbers(pvs)
+    first_rows = pvs.group_by('web_page_id').aggregate([(ROW_NUMBER, 'min')]).column(ROW_NUMBER + '_min')
+    return drop_columns(pvs.take(np.sort(first_rows.to_numpy())), {ROW_NUMBER})
+
+
+def get_pps_per_pv(pps: pa.Table) -> pa.Table:
+    # Like groupby(), ignore page pings without a web_page_id.
+    pps = pps.filter(pc.is_valid(pps.column('web_page_id')))
+    counts = pps.group_by('web_page_id').aggregate([('web_page_id', 'count')])
+    return counts.rename_columns(['page_pings' if name == 'web_page_id_count' else name
+                                  for name in counts.column_names])
+
+
+def get_max_scroll_reach_values(scroll_reach: pa.Table) -> pa.Table:
+    scroll_reach = scroll_reach.filter(pc.is_valid(scroll_reach.column('web_page_id')))
+
+    # Convert the few distinct se_values with pd.to_numeric() so invalid values become nulls exactly like in the pandas
+    # path, and then look up the converted value of each row.
+    se_values = scroll_reach.column('se_value').combine_chunks().dictionary_encode()
+    converted = pd.to_numeric(pd.Series(se_values.dictionary.to_pylist(), dtype=object), errors='coerce')
+    converted_values = pa.array(converted.astype('float64'), type=pa.float64(), from_pandas=True)
+    values = converted_values.take(se_values.indices)
+
+    table = pa.table({'web_page_id': scroll_reach.column('web_page_id'), 'scroll_reach': values})
+    max_values = table.group_by('web_page_id').aggregate([('scroll_reach', 'max')])
+    return max_values.rename_columns(['scroll_reach' if name == 'scroll_reach_max' else name
+                                      for name in max_values.column_names])
+
+
+def left_join(left: pa.Table, right: pa.Table) -> pa.Table:
+    """
+    Left joins on web_page_id, keeping the order of left like DataFrame.join().
+    """
+    joined = with_row_numbers(left).join(right, keys='web_page_id', join_type='left outer')
+    return drop_columns(joined.sort_by(ROW_NUMBER), {ROW_NUMBER})
+
+
+@metrics.timed('transform', rows_out=len)
+def transform(pvs: pa.Table, pps: pa.Table, scroll_reach: pa.Table, partition_values: Dict[str, str]) -> pa.Table:
+    num_rows = len(pvs)
+
+    # A missing app_id counts as jp like in the pandas path.
+    is_jp = pc.fill_null(pc.ends_with(pvs.column('app_id'), 'jyllands-posten.dk'), True)
+    brand = pc.if_else(is_jp, 'jp', 'erhvervsmedier').dictionary_encode()
+    pvs = pvs.append_column('brand', brand)
+
+    for column, value in partition_values.items():
+        pvs = pvs.append_column(column, pa.repeat(pa.scalar(value, type=pa.string()), num_rows))
+
+    # str.contains() in the pandas path treats the pattern as a regular expression.
+    page_pings_enabled = pc.fill_null(pc.match_substring_regex(pvs.column('contexts'),
+                                                               'iglu:dk.jyllands-posten/heartbeat/jsonschema/'), False)
+
+    pvs = drop_columns(pvs, {'app_id', 'contexts'})
+    pvs = pvs.append_column('page_pings_enabled', page_pings_enabled)
+    pvs = drop_duplicate_page_views(pvs)
+
+    # Page views with pings enabled but without any page pings get 0 pings. For other pvs without pps, the time spent
+    # is null.
+    joined = left_join(pvs, get_pps_per_pv(pps))
+    page_pings = pc.cast(joined.column('page_pings'), pa.float64())
+    should_have_pps_but_has_not = pc.and_(joined.column('page_pings_enabled'), pc.is_null(page_pings))
+    page_pings = pc.if_else(should_have_pps_but_has_not, 0.0, page_pings)
+    joined = drop_columns(joined, {'page_pings_enabled', 'page_pings'})
+    joined = joined.append_column('time_spent', pc.multiply(page_pings, 30.0))
+
+    joined = left_join(joined, get_max_scroll_reach_values(scroll_reach))
+    scroll_reach_values = pc.fill_null(joined.column('scroll_reach'), 0.0)
+    joined = joined.set_column(joined.column_names.index('scroll_reach'), 'scroll_reach', scroll_reach_values)
+
+    # Put web_page_id first like reset_index() does in the pandas path.
+    columns = ['web_page_id'] + [name for name in joined.column_names if name != 'web_page_id']
+    return joined.select(columns)
+
+
+def split_table(table: pa.Table, partition_cols: List[str]) -> Iterator[Tuple[Dict[str, str], pa.Table]]:
+    """
+    Yields the values of the partition columns and a table of the rest of the columns for each partition in table, in
+    sorted order like output.split_dataframe().
+    """
+    keys = pa.table({column: pc.cast(table.column(column), pa.string()) for column in partition_cols})
+    for values in sorted(keys.group_by(partition_cols).aggregate([]).to_pylist(),
+                         key=lambda row: [row[column] for column in partition_cols]):
+        mask = pc.equal(keys.column(partition_cols[0]), values[partition_cols[0]])
+        for column in partition_cols[1:]:
+            mask = pc.and_(mask, pc.equal(keys.column(column), values[column]))
+        yield values, drop_columns(table.filter(mask), set(partition_cols))
+
+
+def assert_same_output(expected: pd.DataFrame, actual: pa.Table) -> None:
+    """
+    Raises an AssertionError if the output of the pandas path and the Arrow path differ in anything but dtypes, e.g.
+    categorical vs. string columns or int vs. float time spent when no page view lacks pings.
+    """
+    actual_df = actual.to_pandas()
+    assert sorted(expected.columns) == sorted(actual_df.columns), \
+        f'Columns differ: {sorted(expected.columns)} != {sorted(actual_df.columns)}'
+
+    def normalize(df: pd.DataFrame) -> pd.DataFrame:
+        df = df[sorted(df.columns)].reset_index(drop=True)
+        for column in df.columns:
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype(object)
+        return df
+
+    pd.testing.assert_frame_equal(normalize(expected), normalize(actual_df), check_dtype=False)
@@ -0,0 +1,55 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_BOT_PATTERNS = ['bot', 'crawl', 'spider']
+
+
+class BotClassifier(object):
+    """
+    Classifies user agents as bots if they match any of a set of regular expressions.
+
+    An hour of data only has a few thousand distinct user agents, so each column is reduced to its distinct values
+    before matching and the results are kept in a bounded LRU cache. The cache is thread safe and meant to be shared by
+    all the reads in a process.
+    """
+
+    def __init__(self, patterns: Sequence[str] = DEFAULT_BOT_PATTERNS, ignore_case: bool = False,
+                 cache_size: int = 100000):
+        self.regex = re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), re.IGNORECASE if ignore_case else 0)
+        self.cache_size = cache_size
+        self.cache: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def is_bot_useragent(self, useragent: str) -> bool:
+        with self.lock:
+            is_bot = self.cache.get(useragent)
+            if is_bot is not None:
+                self.cache.move_to_end(useragent)
+                self.hits += 1
+                return is_bot
+
+        is_bot = self.regex.search(useragent) is not None
+
+        with self.lock:
+            self.misses += 1
+            self.cache[useragent] = is_bot
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return is_bot
+
+    def is_bot(self, useragents: pd.Series) -> pd.Series:
+        """
+        Returns a boolean Series telling which rows have a bot user agent. Missing user agents are not bots.
+        """
+        codes, uniques = pd.factorize(useragents)
+        is_bot_per_unique = np.array([self.is_bot_useragent(useragent) for useragent in uniques], dtype=bool)
+        # Code -1 marks missing values. Append a False for it to pick with.
+        is_bot = np.append(is_bot_per_unique, False)[codes]
+        return pd.Series(is_bot, index=useragents.index)
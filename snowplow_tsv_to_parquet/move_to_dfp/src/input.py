@@ -1,32 +1,43 @@
 import logging
+import operator
+import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from typing import Set, Optional
+from typing import Any, Iterator, List, Optional, Set, Tuple
 
 import pandas as pd
+import pyarrow.dataset as ds
 import pyarrow.parquet as pq
 from s3fs import S3FileSystem
 
+from bots import BotClassifier, DEFAULT_BOT_PATTERNS
+from instrumentation import Metrics
 
-def read_table(s3_bucket: str, event: str, date_to_process: date, hour_to_process: int, read_nthreads: int,
-               fs: S3FileSystem, col_whitelist: Optional[Set[str]]) -> pd.DataFrame:
-    in_path = f's3://{s3_bucket}/snowplow/event={event}/date={date_to_process}/hour={hour_to_process:02d}'
-    logging.info(f'Reading {event} data from input path {in_path}.')
+# A filter is a (column, op, value) tuple, e.g. ('se_action', '==', 'article_scroll_reach'). A row is kept if it matches
+# all the filters. For 'in', value is a collection of accepted values.
+Filter = Tuple[str, str, Any]
 
-    try:
-        ds = pq.ParquetDataset(in_path, filesystem=fs, metadata_nthreads=read_nthreads)
-        df = ds.read(columns=col_whitelist).to_pandas(use_threads=read_nthreads > 1)
-        # Remove bots here because that makes it easier to remove bots from all event types.
-        is_bot = df['useragent'].str.contains('bot|crawl|spider', regex=True)
-        return df[~is_bot]
-    except OSError:
-        raise RuntimeError(f'Unexpected error occurred when reading {event} data.' +
-                           f' Make sure the path {in_path} exists and that you have access to it.')
+# Comma separated regular expressions matching bot user agents, e.g. 'bot,crawl,spider,HeadlessChrome'.
+BOT_USERAGENT_PATTERNS = os.environ.get('BOT_USERAGENT_PATTERNS', ','.join(DEFAULT_BOT_PATTERNS)).split(',')
 
+# Shared by all datasets and hours read in the process, so each distinct user agent is only matched once.
+bot_classifier = BotClassifier(BOT_USERAGENT_PATTERNS)
 
-def read_page_views(s3_bucket: str, date_to_process: date, hour_to_process: int, read_nthreads: int,
-                    fs: S3FileSystem) -> pd.DataFrame:
-    # Only keep whitelisted columns that DFP are not interested in to keep the output as simple as possible.
-    col_whitelist = {'collector_tstamp', 'event_type', 'user_ipaddress', 'network_id', 'geo_country', 'geo_city',
+metrics = Metrics('move_to_dfp')
+
+FILTER_OPS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda series, values: series.isin(values),
+}
+
+
+# Only keep whitelisted columns that DFP are not interested in to keep the output as simple as possible.
+PAGE_VIEW_COLUMNS = {'collector_tstamp', 'event_type', 'user_ipaddress', 'network_id', 'geo_country', 'geo_city',
                      'geo_region_name', 'geo_zipcode', 'page_url', 'page_title', 'page_referrer', 'page_urlscheme',
                      'page_urlhost', 'page_urlpath', 'page_urlquery', 'page_urlfragment', 'refr_urlscheme',
                      'refr_urlhost', 'refr_urlpath', 'refr_urlquery', 'refr_urlfragment', 'refr_medium', 'refr_source',
@@ -35,20 +46,194 @@ def read_page_views(s3_bucket: str, date_to_process: date, hour_to_process: int,
                      'dvce_type', 'domain_sessionid', 'derived_tstamp', 'anon_id', 'user_id', 'user_authorized',
                      'grp_authorized', 'user_authenticated', 'grp_authenticated', 'site', 'content_id', 'section_id',
                      'section_name', 'section_path_id', 'page_restricted', 'web_page_id', 'contexts', 'app_id'}
-    return read_table(s3_bucket, 'page_view', date_to_process, hour_to_process, read_nthreads, fs, col_whitelist)
+PAGE_PING_COLUMNS = {'useragent', 'web_page_id'}
+SCROLL_REACH_COLUMNS = {'useragent', 'se_value', 'web_page_id'}
+SCROLL_REACH_FILTERS = [('se_category', '==', 'user_activity'), ('se_action', '==', 'article_scroll_reach')]
+
+
+def get_input_path(s3_bucket: str, event: str, date_to_process: date, hour_to_process: int) -> str:
+    # Without the s3:// scheme, because fs lists the files of the hour without it and pyarrow expects the files of a
+    # dataset to be under the path it was given. It also lets the data be read from a local directory in the tests.
+    return f'{s3_bucket}/snowplow/event={event}/date={date_to_process}/hour={hour_to_process:02d}'
+
+
+def open_dataset(in_path: str, fs: S3FileSystem, read_dictionary: Optional[Set[str]] = None) -> ds.Dataset:
+    """
+    Opens the Parquet files under in_path. Columns in read_dictionary are read as dictionaries, which become
+    categoricals in pandas.
+    """
+    return ds.dataset(in_path, filesystem=fs,
+                      format=ds.ParquetFileFormat(dictionary_columns=sorted(read_dictionary or [])))
+
+
+def _stat_value(value: Any) -> Any:
+    # Statistics of string columns may be returned as bytes.
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _row_group_may_match(row_group: pq.RowGroupMetaData, column_indices: dict, filters: List[Filter]) -> bool:
+    """
+    Uses the min/max statistics of a row group to tell whether any of its rows can match the filters.
+    """
+    for column, op, value in filters:
+        statistics = row_group.column(column_indices[column]).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+
+        min_value, max_value = _stat_value(statistics.min), _stat_value(statistics.max)
+        try:
+            if op == '==' and not min_value <= value <= max_value:
+                return False
+            if op == 'in' and not any(min_value <= v <= max_value for v in value):
+                return False
+            if op in ('<', '<=') and not FILTER_OPS[op](min_value, value):
+                return False
+            if op in ('>', '>=') and not FILTER_OPS[op](max_value, value):
+                return False
+        except TypeError:
+            # The statistics have another type than the filter value, so they cannot be used.
+            continue
+    return True
+
+
+def _filter_mask(df: pd.DataFrame, filters: List[Filter]) -> pd.Series:
+    mask = pd.Series(True, index=df.index)
+    for column, op, value in filters:
+        mask &= FILTER_OPS[op](df[column], value)
+    return mask
+
+
+def _iter_row_groups(path: str, fs: S3FileSystem, columns: Set[str], filters: List[Filter],
+                     read_dictionary: Optional[Set[str]]) -> Iterator[pd.DataFrame]:
+    """
+    Yields the rows of each row group of a Parquet file that match the filters. Row groups whose statistics rule out a
+    match are skipped and the filter columns of the other row groups are read first, so the remaining columns are only
+    read for row groups with matching rows.
+    """
+    filter_columns = sorted({column for column, _, _ in filters})
+    other_columns = sorted(columns - set(filter_columns))
+
+    with fs.open(path, 'rb') as f:
+        parquet_file = pq.ParquetFile(f, read_dictionary=list(read_dictionary or []))
+        metadata = parquet_file.metadata
+        column_indices = {metadata.row_group(0).column(i).path_in_schema: i for i in range(metadata.num_columns)} \
+            if metadata.num_row_groups > 0 else {}
+
+        for i in range(metadata.num_row_groups):
+            if not filters:
+                yield parquet_file.read_row_group(i, columns=sorted(columns), use_threads=False).to_pandas()
+                continue
+
+            if not _row_group_may_match(metadata.row_group(i), column_indices, filters):
+                continue
+
+            filter_df = parquet_file.read_row_group(i, columns=filter_columns, use_threads=False).to_pandas()
+            mask = _filter_mask(filter_df, filters)
+            if not mask.any():
+                continue
+
+            df = filter_df[mask.values]
+            if other_columns:
+                other_df = parquet_file.read_row_group(i, columns=other_columns, use_threads=False).to_pandas()
+                other_df = other_df[mask.values]
+                other_df.index = df.index
+                df = pd.concat([df, other_df], axis=1)
+            yield df[[column for column in df.columns if column in columns]]
+
+
+def _read_file_filtered(path: str, fs: S3FileSystem, columns: Set[str], filters: List[Filter],
+                        read_dictionary: Optional[Set[str]]) -> List[pd.DataFrame]:
+    return list(_iter_row_groups(path, fs, columns, filters, read_dictionary))
+
+
+def remove_bots(df: pd.DataFrame) -> pd.DataFrame:
+    return df[~bot_classifier.is_bot(df['useragent']).values]
+
+
+def iter_table_chunks(s3_bucket: str, event: str, date_to_process: date, hour_to_process: int, fs: S3FileSystem,
+                      col_whitelist: Set[str], filters: Optional[List[Filter]] = None,
+                      read_dictionary: Optional[Set[str]] = None) -> Iterator[pd.DataFrame]:
+    """
+    Like read_table() but yields the rows one row group at a time, so only a row group has to fit in memory.
+    """
+    in_path = get_input_path(s3_bucket, event, date_to_process, hour_to_process)
+    logging.info(f'Reading {event} data from input path {in_path} one row group at a time.')
+
+    try:
+        for path in open_dataset(in_path, fs).files:
+            for df in _iter_row_groups(path, fs, set(col_whitelist) | {'useragent'}, filters or [], read_dictionary):
+                yield remove_bots(df)
+    except OSError:
+        raise RuntimeError(f'Unexpected error occurred when reading {event} data.' +
+                           f' Make sure the path {in_path} exists and that you have access to it.')
+
+
+def get_input_size(s3_bucket: str, event: str, date_to_process: date, hour_to_process: int, fs: S3FileSystem) -> int:
+    """
+    Returns the number of bytes of (compressed) Parquet data of an hour of an event.
+    """
+    return fs.du(get_input_path(s3_bucket, event, date_to_process, hour_to_process), total=True)
+
+
+def _read_table(in_path: str, event: str, read_nthreads: int, fs: S3FileSystem, col_whitelist: Optional[Set[str]],
+                filters: Optional[List[Filter]], read_dictionary: Optional[Set[str]]) -> pd.DataFrame:
+    if not filters:
+        dataset = open_dataset(in_path, fs, read_dictionary)
+        table = dataset.to_table(columns=sorted(col_whitelist) if col_whitelist is not None else None,
+                                 use_threads=read_nthreads > 1)
+        return table.to_pandas(use_threads=read_nthreads > 1)
+
+    dataset = open_dataset(in_path, fs)
+    columns = set(col_whitelist) if col_whitelist is not None else set(dataset.schema.names)
+    columns |= {'useragent'}
+    with ThreadPoolExecutor(max_workers=read_nthreads) as executor:
+        files_dfs = executor.map(lambda path: _read_file_filtered(path, fs, columns, filters, read_dictionary),
+                                 dataset.files)
+        dfs = [df for file_dfs in files_dfs for df in file_dfs]
+    df = pd.concat(dfs, ignore_index=True, sort=False) if dfs else pd.DataFrame(columns=sorted(columns))
+    logging.info(f'Read {len(df)} {event} rows matching {filters}.')
+    return df
+
+
+def read_table(s3_bucket: str, event: str, date_to_process: date, hour_to_process: int, read_nthreads: int,
+               fs: S3FileSystem, col_whitelist: Optional[Set[str]], filters: Optional[List[Filter]] = None,
+               read_dictionary: Optional[Set[str]] = None) -> pd.DataFrame:
+    """
+    Reads an hour of an event's data, skipping bots. Only rows matching all the filters are read, see
+    _read_file_filtered(). Columns in read_dictionary are read as categoricals, which saves memory for columns with few
+    distinct values.
+    """
+    in_path = get_input_path(s3_bucket, event, date_to_process, hour_to_process)
+    logging.info(f'Reading {event} data from input path {in_path}.')
+
+    with metrics.stage('read_table', event=event, date=date_to_process.isoformat(), hour=hour_to_process) as stage:
+        try:
+            df = _read_table(in_path, event, read_nthreads, fs, col_whitelist, filters, read_dictionary)
+        except OSError:
+            raise RuntimeError(f'Unexpected error occurred when reading {event} data.' +
+                               f' Make sure the path {in_path} exists and that you have access to it.')
+
+        # Remove bots here because that makes it easier to remove bots from all event types.
+        without_bots = remove_bots(df)
+        logging.info(f'Removed {len(df) - len(without_bots)} bot {event} rows. {len(bot_classifier.cache)} user '
+                     f'agents are cached ({bot_classifier.hits} hits, {bot_classifier.misses} misses so far).')
+        stage.rows_in, stage.rows_out = len(df), len(without_bots)
+        return without_bots
+
+
+def read_page_views(s3_bucket: str, date_to_process: date, hour_to_process: int, read_nthreads: int,
+                    fs: S3FileSystem) -> pd.DataFrame:
+    return read_table(s3_bucket, 'page_view', date_to_process, hour_to_process, read_nthreads, fs, PAGE_VIEW_COLUMNS)
 
 
 def read_page_pings(s3_bucket: str, date_to_process: date, hour_to_process: int, read_nthreads: int,
                     fs: S3FileSystem) -> pd.DataFrame:
-    col_whitelist = {'useragent', 'web_page_id'}
-    return read_table(s3_bucket, 'page_ping', date_to_process, hour_to_process, read_nthreads, fs, 
-                      col_whitelist)[['web_page_id']]
+    return read_table(s3_bucket, 'page_ping', date_to_process, hour_to_process, read_nthreads, fs, PAGE_PING_COLUMNS,
+                      read_dictionary={'useragent'})[['web_page_id']]
 
 
 def read_scroll_reach(s3_bucket: str, date_to_process: date, hour_to_process: int, read_nthreads: int,
                       fs: S3FileSystem) -> pd.DataFrame:
-    col_whitelist = {'useragent', 'se_category', 'se_action', 'se_value', 'web_page_id'}
-    df = read_table(s3_bucket, 'struct', date_to_process, hour_to_process, read_nthreads, fs, col_whitelist)
-
-    filter_mask = (df['se_category'] == 'user_activity') & (df['se_action'] == 'article_scroll_reach')
-    return df[filter_mask][['web_page_id', 'se_value']]
+    df = read_table(s3_bucket, 'struct', date_to_process, hour_to_process, read_nthreads, fs, SCROLL_REACH_COLUMNS,
+                    filters=SCROLL_REACH_FILTERS, read_dictionary={'useragent', 'se_category', 'se_action'})
+    return df[['web_page_id', 'se_value']]
@@ -1,48 +1,73 @@
 import logging
 import os
 import sys
-from datetime import date, datetime, time
-from time import gmtime
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from time import gmtime, monotonic
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import pandas as pd
 import pyarrow as pa
-import pyarrow.parquet as pq
 import pytz
 from s3fs import S3FileSystem
 
-from input import read_page_views, read_page_pings, read_scroll_reach
+import arrow_engine
+import output
+import streaming
+from input import (get_input_size, iter_table_chunks, metrics, read_page_views, read_page_pings, read_scroll_reach,
+                   PAGE_PING_COLUMNS, PAGE_VIEW_COLUMNS, SCROLL_REACH_COLUMNS, SCROLL_REACH_FILTERS)
 
 S3_INPUT_BUCKET = os.environ['S3_INPUT_BUCKET']  # 'behavior-datalake' on prod.
 S3_OUTPUT_BUCKET = os.environ['S3_OUTPUT_BUCKET']  # 'jyllandsposten-upload-prod' on prod
 S3_OUTPUT_PREFIX = os.environ['S3_OUTPUT_PREFIX']  # 'snowplow_pageviews' on prod
-
-
-def add_dt_cols(date_to_process: date, hour_to_process: int, df: pd.DataFrame) -> None:
-    def str_zfill(val: int, zfill: int):
-        return pd.Series(str(val), index=range(len(df))).str.zfill(zfill)
-
+# 'pandas', 'arrow' (see arrow_engine.py) or 'streaming', which is the pandas engine in bounded memory, see
+# run_streaming().
+ENGINE = os.environ.get('ENGINE', 'pandas')
+# Memory the streaming engine may use for the data of an hour and the local directory it spills the data to. The output
+# files are also written there before they are uploaded.
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', '1024'))
+SPILL_DIR = os.environ.get('SPILL_DIR')
+# Size at which an output file of a partition is closed and the next part started.
+TARGET_FILE_MB = int(os.environ.get('TARGET_FILE_MB', '128'))
+
+
+def get_partition_values(date_to_process: date, hour_to_process: int) -> Dict[str, str]:
+    """
+    Returns the values of the date columns of an hour given in UTC. The output is partitioned by the date in
+    Europe/Copenhagen.
+    """
     utc_dt = datetime.combine(date_to_process, time(hour_to_process), tzinfo=pytz.utc)
     cph_dt = utc_dt.astimezone(pytz.timezone('Europe/Copenhagen'))
 
     logging.info(f'Converted {date_to_process.isoformat()} {hour_to_process} UTC to {cph_dt.date().isoformat()}'
                  f' {cph_dt.time().hour} Europe/Copenhagen.')
 
-    year = str_zfill(cph_dt.year, 4)
-    month = str_zfill(cph_dt.month, 2)
-    day = str_zfill(cph_dt.day, 2)
-    hour = str_zfill(cph_dt.hour, 2)
-    dt = pd.Series(cph_dt.date().isoformat(), index=range(len(df)))
+    return {
+        'year': str(cph_dt.year).zfill(4),
+        'month': str(cph_dt.month).zfill(2),
+        'day': str(cph_dt.day).zfill(2),
+        'hour': str(cph_dt.hour).zfill(2),
+        'dt': cph_dt.date().isoformat(),
+    }
+
+
+def get_stage_properties(date_to_process: date, hour_to_process: int) -> Dict[str, object]:
+    return {'date': date_to_process.isoformat(), 'hour': hour_to_process, 'engine': ENGINE}
+
 
-    df['year'] = year
-    df['month'] = month
-    df['day'] = day
-    df['hour'] = hour
-    df['dt'] = dt
+def add_dt_cols(date_to_process: date, hour_to_process: int, df: pd.DataFrame) -> None:
+    for column, value in get_partition_values(date_to_process, hour_to_process).items():
+        # Use the index of df rather than a new range index, which would not line up with the rows left after removing
+        # bots.
+        df[column] = pd.Series(value, index=df.index)
 
 
 def add_brand(df: pd.DataFrame) -> None:
-    is_jp = df['app_id'].str.endswith('jyllands-posten.dk')
+    # A missing app_id has always ended up as jp because np.where() treats NaN as true. Say so explicitly so the rule
+    # does not depend on the pandas version and matches the Arrow engine.
+    is_jp = df['app_id'].str.endswith('jyllands-posten.dk', na=True)
     brand = pd.Categorical(np.where(is_jp,
                                     'jp',
                                     'erhvervsmedier'))
@@ -54,30 +79,32 @@ def add_page_pings_enabled_col(df: pd.DataFrame) -> None:
     # Page views with page pings enabled have the 'heartbeat' context added. The context also tells us how many seconds
     # there are between each page ping. For now, we just hard code that value to 30s but it can be extracted from the
     # heartbeat context if needed.
-    page_pings_enabled = df['contexts'].str.contains('iglu:dk.jyllands-posten/heartbeat/jsonschema/')
+    page_pings_enabled = df['contexts'].str.contains('iglu:dk.jyllands-posten/heartbeat/jsonschema/', na=False)
     # noinspection PyCallByClass,PyTypeChecker
     df['page_pings_enabled'] = page_pings_enabled
 
 
-def write_dataset(df: pd.DataFrame, fs: S3FileSystem, threads: int) -> None:
-    logging.info('Converting output to an Arrow table...')
-    # noinspection PyArgumentList,PyUnresolvedReferences
-    table = pa.Table.from_pandas(df=df, schema=pa.Schema.from_pandas(df), nthreads=threads)
+def open_writer(date_to_process: date, hour_to_process: int, fs: S3FileSystem) -> output.HourWriter:
+    partition_values = get_partition_values(date_to_process, hour_to_process)
+    logging.info(f'Writing data to s3://{S3_OUTPUT_BUCKET}/{S3_OUTPUT_PREFIX}...')
+    return output.HourWriter(fs, f'{S3_OUTPUT_BUCKET}/{S3_OUTPUT_PREFIX}',
+                             output.get_file_prefix(date_to_process, hour_to_process),
+                             {column: partition_values[column] for column in output.PARTITION_COLS[1:]},
+                             TARGET_FILE_MB * 1024 * 1024, SPILL_DIR)
 
-    partitions = ['brand', 'year', 'month', 'dt']
-    out_path = f's3://{S3_OUTPUT_BUCKET}/{S3_OUTPUT_PREFIX}'
 
-    logging.info(f'Writing data to {out_path}...')
+def write_dataset(df: pd.DataFrame, writer: output.HourWriter, threads: int) -> None:
+    logging.info('Converting output to Arrow tables...')
+    for partition_values, table in output.split_dataframe(df, threads):
+        writer.write(partition_values, table)
 
-    # Note that PyArrow does not support overwriting data so if you run this multiple times, it will create multiple
-    # files for the same partitions.
-    pq.write_to_dataset(table, root_path=out_path, filesystem=fs, partition_cols=partitions)
 
+def write_table(table: pa.Table, writer: output.HourWriter) -> None:
+    for partition_values, partition in arrow_engine.split_table(table, output.PARTITION_COLS):
+        writer.write(partition_values, partition)
 
-def get_and_preprocess_pvs(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int) -> pd.DataFrame:
-    logging.info(f'Reading page view data for {date_to_process.isoformat()} {hour_to_process:02d}...')
-    pvs: pd.DataFrame = read_page_views(S3_INPUT_BUCKET, date_to_process, hour_to_process, threads, fs)
 
+def preprocess_pvs(pvs: pd.DataFrame, date_to_process: date, hour_to_process: int) -> pd.DataFrame:
     logging.info('Adding brand...')
     add_brand(pvs)
 
@@ -96,17 +123,32 @@ def get_and_preprocess_pvs(date_to_process: date, hour_to_process: int, fs: S3Fi
     return pvs.drop_duplicates('web_page_id')
 
 
-def get_pps_per_pv(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int) -> pd.Series:
-    logging.info(f'Reading page ping data for {date_to_process.isoformat()} {hour_to_process:02d}...')
+def get_and_preprocess_pvs(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int) -> pd.DataFrame:
+    logging.info(f'Reading page view data for {date_to_process.isoformat()} {hour_to_process:02d}...')
+    pvs: pd.DataFrame = read_page_views(S3_INPUT_BUCKET, date_to_process, hour_to_process, threads, fs)
+    return preprocess_pvs(pvs, date_to_process, hour_to_process)
 
-    pps: pd.DataFrame = read_page_pings(S3_INPUT_BUCKET, date_to_process, hour_to_process, threads, fs)
 
+def count_pps_per_pv(pps: pd.DataFrame) -> pd.Series:
     logging.info('Finding page pings per page view...')
     pps_per_pv = pps.groupby('web_page_id').size()
 
     return pps_per_pv.rename('page_pings')
 
 
+def get_pps_per_pv(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int) -> pd.Series:
+    logging.info(f'Reading page ping data for {date_to_process.isoformat()} {hour_to_process:02d}...')
+
+    pps: pd.DataFrame = read_page_pings(S3_INPUT_BUCKET, date_to_process, hour_to_process, threads, fs)
+    return count_pps_per_pv(pps)
+
+
+def compute_max_scroll_reach_values(scroll_reach: pd.DataFrame) -> pd.Series:
+    # Convert the values from string to int and return only that.
+    scroll_reach['scroll_reach'] = pd.to_numeric(scroll_reach['se_value'], errors='coerce')
+    return scroll_reach.groupby('web_page_id')['scroll_reach'].max()
+
+
 def get_max_scroll_reach_values(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int)\
         -> pd.Series:
     """
@@ -115,81 +157,247 @@ def get_max_scroll_reach_values(date_to_process: date, hour_to_process: int, fs:
     logging.info(f'Reading scroll reach data for {date_to_process.isoformat()} {hour_to_process:02d}...')
 
     scroll_reach: pd.DataFrame = read_scroll_reach(S3_INPUT_BUCKET, date_to_process, hour_to_process, threads, fs)
+    return compute_max_scroll_reach_values(scroll_reach)
 
-    # Convert the values from string to int and return only that.
-    scroll_reach['scroll_reach'] = pd.to_numeric(scroll_reach['se_value'], errors='coerce')
-    return scroll_reach.groupby('web_page_id')['scroll_reach'].max()
-
-
-def add_timespent(pvs: pd.DataFrame, date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int)\
-        -> pd.DataFrame:
-    pps_per_pv = get_pps_per_pv(date_to_process, hour_to_process, fs, threads)
 
+def add_timespent(pvs: pd.DataFrame, pps_per_pv: pd.Series) -> pd.DataFrame:
     pvs_with_pps_per_pv = pvs.join(pps_per_pv, how='left')
 
     # Pvs with pings enabled but without any page pings will be NaN in the joined DF. Set their number of pings to 0.
     should_have_pps_but_has_not: pd.Series = pvs['page_pings_enabled'] & pvs_with_pps_per_pv['page_pings'].isna()
     pvs_with_pps_per_pv['page_pings'] = np.where(should_have_pps_but_has_not, 0, pvs_with_pps_per_pv['page_pings'])
 
-    # Finally, calculate time spent. For pvs without pps, the result will be NaN.
-    pvs_with_pps_per_pv['time_spent'] = pvs_with_pps_per_pv['page_pings'] * 30
+    # Finally, calculate time spent. For pvs without pps, the result will be NaN. Always use floats, also when no pv
+    # lacks pps, so the output schema does not change between hours or between the buckets of the streaming engine.
+    pvs_with_pps_per_pv['time_spent'] = pvs_with_pps_per_pv['page_pings'].astype('float64') * 30
 
     return pvs_with_pps_per_pv.drop(columns=['page_pings_enabled', 'page_pings'])
 
 
-def add_scroll_reach(pvs: pd.DataFrame, date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int)\
-        -> pd.DataFrame:
-    max_scroll_reach_per_pv = get_max_scroll_reach_values(date_to_process, hour_to_process, fs, threads)
+def add_scroll_reach(pvs: pd.DataFrame, max_scroll_reach_per_pv: pd.Series) -> pd.DataFrame:
     joined = pvs.join(max_scroll_reach_per_pv, how='left')
-    joined['scroll_reach'] = joined['scroll_reach'].fillna(0.)
+    # Like time spent, always use floats, also when there are no scroll reach events to join.
+    joined['scroll_reach'] = joined['scroll_reach'].fillna(0.).astype('float64')
     return joined
 
 
-def run(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int):
-    pvs = get_and_preprocess_pvs(date_to_process, hour_to_process, fs, threads)
+def read_datasets(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int)\
+        -> Tuple[pd.DataFrame, pd.Series, pd.Series]:
+    """
+    Reads and aggregates the page views, page pings and scroll reach events of an hour. The three reads are
+    independent, so they run concurrently and share the S3 connection. Most of the time is spent waiting for S3 and in
+    Arrow, which releases the GIL, so the hour takes about as long as the largest of the reads.
+    """
+    start_time = monotonic()
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        pvs = executor.submit(get_and_preprocess_pvs, date_to_process, hour_to_process, fs, threads)
+        pps_per_pv = executor.submit(get_pps_per_pv, date_to_process, hour_to_process, fs, threads)
+        max_scroll_reach_per_pv = executor.submit(get_max_scroll_reach_values, date_to_process, hour_to_process, fs,
+                                                  threads)
+        result = pvs.result(), pps_per_pv.result(), max_scroll_reach_per_pv.result()
+
+    logging.info(f'Read all input data in {monotonic() - start_time:.1f}s.')
+    return result
+
 
+@metrics.timed('combine', rows_out=len)
+def combine(pvs: pd.DataFrame, pps_per_pv: pd.Series, max_scroll_reach_per_pv: pd.Series) -> pd.DataFrame:
     pvs = pvs.set_index('web_page_id')
 
     logging.info('Adding time spent to each page view...')
-    pvs = add_timespent(pvs, date_to_process, hour_to_process, fs, threads)
+    pvs = add_timespent(pvs, pps_per_pv)
 
     logging.info('Adding max scroll reach to each page view...')
-    pvs = add_scroll_reach(pvs, date_to_process, hour_to_process, fs, threads)
+    pvs = add_scroll_reach(pvs, max_scroll_reach_per_pv)
+
+    return pvs.reset_index()
+
+
+def run_streaming(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int) -> None:
+    """
+    Processes an hour in memory bounded by MEMORY_BUDGET_MB rather than by the volume of the hour. The input is read a
+    row group at a time and spilled to local disk in buckets by web_page_id, so all the rows of a page view end up in
+    the same bucket. The buckets are then combined and written one at a time.
+    """
+    input_bytes = sum(get_input_size(S3_INPUT_BUCKET, event, date_to_process, hour_to_process, fs)
+                      for event in ('page_view', 'page_ping', 'struct'))
+    num_buckets = streaming.get_num_buckets(input_bytes, MEMORY_BUDGET_MB * 1024 * 1024)
+    logging.info(f'Processing {input_bytes / 1024 / 1024:.1f} MB of input in {num_buckets} buckets.')
+
+    with tempfile.TemporaryDirectory(dir=SPILL_DIR) as spill_dir, \
+            open_writer(date_to_process, hour_to_process, fs) as writer:
+        buckets = streaming.SpillBuckets(spill_dir, num_buckets)
+
+        for chunk in iter_table_chunks(S3_INPUT_BUCKET, 'page_view', date_to_process, hour_to_process, fs,
+                                       PAGE_VIEW_COLUMNS):
+            buckets.add('page_view', chunk)
+        for chunk in iter_table_chunks(S3_INPUT_BUCKET, 'page_ping', date_to_process, hour_to_process, fs,
+                                       PAGE_PING_COLUMNS, read_dictionary={'useragent'}):
+            buckets.add('page_ping', chunk[['web_page_id']])
+        for chunk in iter_table_chunks(S3_INPUT_BUCKET, 'struct', date_to_process, hour_to_process, fs,
+                                       SCROLL_REACH_COLUMNS, SCROLL_REACH_FILTERS,
+                                       read_dictionary={'useragent', 'se_category', 'se_action'}):
+            buckets.add('struct', chunk[['web_page_id', 'se_value']])
+
+        for bucket in range(num_buckets):
+            pvs = buckets.read('page_view', bucket)
+            if pvs.empty:
+                continue
+
+            logging.info(f'Processing bucket {bucket + 1} of {num_buckets} with {len(pvs)} page views...')
+            pvs = preprocess_pvs(pvs, date_to_process, hour_to_process)
+            pps_per_pv = count_pps_per_pv(buckets.read('page_ping', bucket, ['web_page_id']))
+            max_scroll_reach_per_pv = compute_max_scroll_reach_values(
+                buckets.read('struct', bucket, ['web_page_id', 'se_value']))
+            write_dataset(combine(pvs, pps_per_pv, max_scroll_reach_per_pv), writer, threads)
+
+
+def read_hour(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int) -> tuple:
+    """
+    Reads the input of an hour for the pandas or the Arrow engine. Together with process_hour() this splits an hour
+    into a read stage and a transform and write stage that can overlap with the read of the next hour.
+    """
+    with metrics.stage('read', **get_stage_properties(date_to_process, hour_to_process)) as stage:
+        if ENGINE == 'arrow':
+            start_time = monotonic()
+            data = arrow_engine.read_datasets(S3_INPUT_BUCKET, date_to_process, hour_to_process, fs)
+            logging.info(f'Read all input data in {monotonic() - start_time:.1f}s.')
+        else:
+            data = read_datasets(date_to_process, hour_to_process, fs, threads)
+        stage.rows_out = len(data[0])
+        return data
+
+
+def process_hour(date_to_process: date, hour_to_process: int, data: tuple, fs: S3FileSystem, threads: int) -> None:
+    with metrics.stage('process', **get_stage_properties(date_to_process, hour_to_process)) as stage:
+        stage.rows_in = len(data[0])
+        if ENGINE == 'arrow':
+            logging.info('Adding brand, date columns, time spent and max scroll reach to each page view...')
+            table = arrow_engine.transform(*data, get_partition_values(date_to_process, hour_to_process))
+            logging.info('Writing output...')
+            with open_writer(date_to_process, hour_to_process, fs) as writer:
+                write_table(table, writer)
+        else:
+            pvs = combine(*data)
+            logging.info('Writing output...')
+            with open_writer(date_to_process, hour_to_process, fs) as writer:
+                write_dataset(pvs, writer, threads)
+        stage.rows_out = writer.num_rows
 
-    pvs = pvs.reset_index()
 
-    logging.info('Writing output...')
-    write_dataset(pvs, fs, threads)
+def run(date_to_process: date, hour_to_process: int, fs: S3FileSystem, threads: int):
+    with metrics.stage('run', **get_stage_properties(date_to_process, hour_to_process)):
+        if ENGINE == 'streaming':
+            run_streaming(date_to_process, hour_to_process, fs, threads)
+        else:
+            process_hour(date_to_process, hour_to_process, read_hour(date_to_process, hour_to_process, fs, threads),
+                         fs, threads)
 
     logging.info('Done.')
 
 
-def main():
-    logging.Formatter.converter = gmtime
-    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+def run_range(hours: List[Tuple[date, int]], fs: S3FileSystem, threads: int) -> Dict[Tuple[date, int], Optional[str]]:
+    """
+    Processes several hours in this process, reusing the S3 connections and the bot cache. With the pandas and Arrow
+    engines, the next hour is read while the current one is transformed and written. A failed hour does not stop the
+    others. Returns the error of each hour, or None for the hours that succeeded.
+    """
+    errors: Dict[Tuple[date, int], Optional[str]] = {}
+
+    if ENGINE == 'streaming':
+        # The streaming engine reads and processes an hour in one go and must not hold two hours at once.
+        for date_to_process, hour_to_process in hours:
+            logging.info(f'Processing {date_to_process.isoformat()} {hour_to_process:02d}...')
+            try:
+                run(date_to_process, hour_to_process, fs, threads)
+                errors[(date_to_process, hour_to_process)] = None
+            except Exception as ex:
+                logging.exception(ex)
+                errors[(date_to_process, hour_to_process)] = str(ex)
+        return errors
+
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        next_read = reader.submit(read_hour, hours[0][0], hours[0][1], fs, threads) if hours else None
+        for i, (date_to_process, hour_to_process) in enumerate(hours):
+            current_read = next_read
+            if i + 1 < len(hours):
+                next_read = reader.submit(read_hour, hours[i + 1][0], hours[i + 1][1], fs, threads)
+
+            logging.info(f'Processing {date_to_process.isoformat()} {hour_to_process:02d}...')
+            try:
+                process_hour(date_to_process, hour_to_process, current_read.result(), fs, threads)
+                errors[(date_to_process, hour_to_process)] = None
+                logging.info(f'Done with {date_to_process.isoformat()} {hour_to_process:02d}.')
+            except Exception as ex:
+                logging.exception(ex)
+                errors[(date_to_process, hour_to_process)] = str(ex)
+            # Let go of the hour's data before the next hour is processed.
+            current_read = None
+
+    return errors
+
+
+def get_hours(start: datetime, end: datetime) -> List[Tuple[date, int]]:
+    """
+    Returns the UTC (date, hour) pairs from start up to but not including end.
+    """
+    hours = []
+    current = start
+    while current < end:
+        hours.append((current.date(), current.hour))
+        current += timedelta(hours=1)
+    return hours
 
-    if len(sys.argv) < 3:
-        logging.error('Need two arguments: 1) a date in format YYYY-mm-dd, 2) hour in the format HH.')
-        exit(1)
 
-    date_to_process_str = sys.argv[1]
+def parse_date_hour(date_str: str, hour_str: str) -> datetime:
     try:
-        date_to_process = datetime.strptime(date_to_process_str, "%Y-%m-%d").date()
+        parsed_date = datetime.strptime(date_str, "%Y-%m-%d").date()
     except ValueError:
-        raise RuntimeError(f'Could not parse input date {date_to_process_str} with format YYYY-mm-dd.')
+        raise RuntimeError(f'Could not parse input date {date_str} with format YYYY-mm-dd.')
 
-    hour_to_process_str = sys.argv[2]
     try:
-        hour_to_process = int(hour_to_process_str)
-        if 0 < hour_to_process > 23:
+        parsed_hour = int(hour_str)
+        if not 0 <= parsed_hour <= 23:
             raise ValueError()
     except ValueError:
-        raise RuntimeError(f'Could not parse input hour {hour_to_process_str} with format HH.')
+        raise RuntimeError(f'Could not parse input hour {hour_str} with format HH.')
+
+    return datetime.combine(parsed_date, time(parsed_hour))
+
+
+def main():
+    logging.Formatter.converter = gmtime
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    if len(sys.argv) not in (3, 5):
+        logging.error('Need two arguments: 1) a date in format YYYY-mm-dd, 2) hour in the format HH. Optionally add an '
+                      'end date and hour in the same formats to process all hours up to but not including that hour.')
+        exit(1)
+
+    start = parse_date_hour(sys.argv[1], sys.argv[2])
 
     # Construct a S3 connection using the default credentials provider chain from boto3. The ACL is required for DFP to
     # own the files when uploading them.
     fs = S3FileSystem(s3_additional_kwargs={'ACL': 'bucket-owner-full-control'})
-    run(date_to_process, hour_to_process, fs, threads=8)
+
+    if len(sys.argv) == 3:
+        with metrics.profile(f'{start:%Y-%m-%dT%H}'):
+            run(start.date(), start.hour, fs, threads=8)
+        return
+
+    end = parse_date_hour(sys.argv[3], sys.argv[4])
+    with metrics.profile(f'{start:%Y-%m-%dT%H}-{end:%Y-%m-%dT%H}'):
+        errors = run_range(get_hours(start, end), fs, threads=8)
+
+    for (date_to_process, hour_to_process), error in errors.items():
+        status = 'OK' if error is None else f'FAILED: {error}'
+        logging.info(f'{date_to_process.isoformat()} {hour_to_process:02d}: {status}')
+
+    failed = [hour for hour, error in errors.items() if error is not None]
+    if failed:
+        logging.error(f'{len(failed)} of {len(errors)} hours failed. Retry them with: ' +
+                      '; '.join(f'python3 move_to_dfp.py {d.isoformat()} {h:02d}' for d, h in failed))
+        exit(1)
 
 
 if __name__ == '__main__':
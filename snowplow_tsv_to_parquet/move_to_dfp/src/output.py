@@ -0,0 +1,173 @@
+"""
+Writes the output of move_to_dfp.py with file names that only depend on the source hour and the partition, so running an
+hour again replaces its files instead of adding files with duplicate data.
+
+The output of an hour goes to root/brand=.../year=.../month=.../dt=.../<source hour>-<part>.parquet. The source hour is
+the UTC hour that was processed, e.g. 2018-08-22T10, so the two hours that share a local hour when daylight saving time
+ends do not overwrite each other. A part is rolled over when it reaches a target size, so an hour has one file per
+partition unless it is very large, also when the streaming engine writes it in many small pieces. All the files of an
+hour have the schema of the first piece written, see HourWriter.conform().
+"""
+import logging
+import os
+import tempfile
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from s3fs import S3FileSystem
+
+PARTITION_COLS = ['brand', 'year', 'month', 'dt']
+
+
+def get_file_prefix(date_to_process: date, hour_to_process: int) -> str:
+    return f'{date_to_process.isoformat()}T{hour_to_process:02d}'
+
+
+def split_dataframe(df: pd.DataFrame, threads: int) -> Iterator[Tuple[Dict[str, str], pa.Table]]:
+    """
+    Yields the values of the partition columns and an Arrow table of the rest of the columns for each partition in df,
+    in sorted order.
+    """
+    data_columns = [column for column in df.columns if column not in PARTITION_COLS]
+    # Use one schema for all the partitions so their tables can go to the same file.
+    schema = pa.Schema.from_pandas(df[data_columns], preserve_index=False)
+    for values, partition in df.groupby(PARTITION_COLS, sort=True, observed=True):
+        # noinspection PyArgumentList
+        table = pa.Table.from_pandas(df=partition[data_columns], schema=schema, preserve_index=False, nthreads=threads)
+        yield dict(zip(PARTITION_COLS, values)), table
+
+
+def is_string_type(data_type: pa.DataType) -> bool:
+    return pa.types.is_string(data_type) or pa.types.is_large_string(data_type)
+
+
+class PartFile(object):
+    def __init__(self, local_path: str, remote_path: str, schema: pa.Schema):
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.writer = pq.ParquetWriter(local_path, schema)
+
+
+class HourWriter(object):
+    """
+    Writes the output of one source hour under root_path, which is given as bucket/prefix.
+
+    Parts are written to local_dir and uploaded when they are complete, so each S3 object appears whole or not at all
+    and a failed run uploads nothing for the parts it had not finished. When all parts have been uploaded, close()
+    removes the files of the same hour that an earlier run wrote but this run did not, e.g. the parts of a brand that no
+    longer has any page views. An hour always maps to a single year, month and dt, given as hour_partition, so only the
+    brand directories have to be listed to find them.
+
+    Use it as a context manager. If the block raises, the open parts are thrown away and nothing is removed.
+    """
+
+    def __init__(self, fs: S3FileSystem, root_path: str, file_prefix: str, hour_partition: Dict[str, str],
+                 target_file_bytes: int, local_dir: str = None):
+        self.fs = fs
+        self.root_path = root_path.rstrip('/')
+        self.file_prefix = file_prefix
+        self.hour_partition = hour_partition
+        self.target_file_bytes = target_file_bytes
+        self.tmp_dir = tempfile.TemporaryDirectory(dir=local_dir)
+        self.open_parts: Dict[str, PartFile] = {}
+        self.num_parts: Dict[str, int] = {}
+        self.written: Set[str] = set()
+        self.schema: Optional[pa.Schema] = None
+        self.num_rows = 0
+
+    def __enter__(self) -> 'HourWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        try:
+            if exc_type is None:
+                self.close()
+            else:
+                for part in self.open_parts.values():
+                    part.writer.close()
+                self.open_parts.clear()
+        finally:
+            self.tmp_dir.cleanup()
+
+    def get_partition_dir(self, partition_values: Dict[str, str]) -> str:
+        return '/'.join([self.root_path] + [f'{column}={partition_values[column]}' for column in PARTITION_COLS])
+
+    def conform(self, table: pa.Table) -> pa.Table:
+        """
+        Casts a piece to the schema of the hour, which is taken from the first piece. pa.Table.from_pandas() gives
+        columns that are all None the null type, which is common in the small buckets of the streaming engine. Such
+        columns come from object columns, which hold strings in this job, so they are written as strings. Raises a
+        ValueError if a piece has other columns or a column of another type than the first piece. String and large
+        string columns are cast to each other.
+        """
+        if self.schema is None:
+            self.schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                                     for field in table.schema], metadata=table.schema.metadata)
+
+        if table.schema.names != self.schema.names:
+            raise ValueError(f'Expected the columns {self.schema.names} in the output of {self.file_prefix}, got '
+                             f'{table.schema.names}.')
+        for field, expected in zip(table.schema, self.schema):
+            if not (pa.types.is_null(field.type) or field.type == expected.type or
+                    is_string_type(field.type) and is_string_type(expected.type)):
+                raise ValueError(f'Column {field.name} of the output of {self.file_prefix} is {field.type} in one '
+                                 f'piece and {expected.type} in another.')
+        return table.cast(self.schema)
+
+    def write(self, partition_values: Dict[str, str], table: pa.Table) -> None:
+        if table.num_rows == 0:
+            return
+
+        table = self.conform(table)
+        partition_dir = self.get_partition_dir(partition_values)
+        part = self.open_parts.get(partition_dir)
+        if part is None:
+            part = self.start_part(partition_dir, self.schema)
+
+        part.writer.write_table(table)
+        self.num_rows += table.num_rows
+        if os.path.getsize(part.local_path) >= self.target_file_bytes:
+            self.finish_part(partition_dir)
+
+    def start_part(self, partition_dir: str, schema: pa.Schema) -> PartFile:
+        part_number = self.num_parts.get(partition_dir, 0)
+        self.num_parts[partition_dir] = part_number + 1
+
+        file_name = f'{self.file_prefix}-{part_number:05d}.parquet'
+        local_path = os.path.join(self.tmp_dir.name, f'{sum(self.num_parts.values()):05d}.parquet')
+        part = PartFile(local_path, f'{partition_dir}/{file_name}', schema)
+        self.open_parts[partition_dir] = part
+        return part
+
+    def finish_part(self, partition_dir: str) -> None:
+        part = self.open_parts.pop(partition_dir)
+        part.writer.close()
+        logging.info(f'Uploading s3://{part.remote_path} ({os.path.getsize(part.local_path) / 1024 / 1024:.1f} MB)...')
+        self.fs.put(part.local_path, part.remote_path)
+        os.remove(part.local_path)
+        self.written.add(part.remote_path)
+
+    def ls(self, path: str) -> List[str]:
+        try:
+            return self.fs.ls(path, refresh=True)
+        except FileNotFoundError:
+            return []
+
+    def remove_stale_files(self) -> None:
+        hour_partition_path = '/'.join(f'{column}={self.hour_partition[column]}' for column in PARTITION_COLS[1:])
+        for brand_dir in self.ls(self.root_path):
+            if not brand_dir.rstrip('/').rsplit('/', 1)[-1].startswith('brand='):
+                continue
+            for path in self.ls(f'{brand_dir.rstrip("/")}/{hour_partition_path}'):
+                if path.rsplit('/', 1)[-1].startswith(self.file_prefix + '-') and path not in self.written:
+                    logging.info(f'Removing s3://{path}, which an earlier run of the hour wrote.')
+                    self.fs.rm(path)
+
+    def close(self) -> None:
+        for partition_dir in list(self.open_parts):
+            self.finish_part(partition_dir)
+        self.remove_stale_files()
+        logging.info(f'Wrote {len(self.written)} files for {self.file_prefix}.')
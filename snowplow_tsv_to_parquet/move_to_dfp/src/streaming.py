@@ -0,0 +1,49 @@
+import math
+import os
+from typing import List, Optional
+
+import pandas as pd
+
+# How many times larger a pandas DataFrame of the input is than its compressed Parquet files, estimated on the page view
+# data. Used to decide how many buckets are needed to stay within a memory budget.
+IN_MEMORY_EXPANSION = 8
+
+
+def get_num_buckets(input_bytes: int, memory_budget_bytes: int) -> int:
+    return max(1, math.ceil(input_bytes * IN_MEMORY_EXPANSION / memory_budget_bytes))
+
+
+class SpillBuckets(object):
+    """
+    Spills DataFrames to local Parquet files, hash partitioned on web_page_id into num_buckets buckets per dataset.
+    Reading a bucket returns its rows in the order they were added.
+    """
+
+    def __init__(self, directory: str, num_buckets: int):
+        self.directory = directory
+        self.num_buckets = num_buckets
+        self.num_chunks = 0
+
+    def bucket_dir(self, dataset: str, bucket: int) -> str:
+        return os.path.join(self.directory, dataset, f'{bucket:05d}')
+
+    def add(self, dataset: str, df: pd.DataFrame) -> None:
+        if df.empty:
+            return
+
+        buckets = pd.util.hash_pandas_object(df['web_page_id'], index=False).values % self.num_buckets
+        for bucket, bucket_df in df.groupby(buckets, sort=False):
+            bucket_dir = self.bucket_dir(dataset, bucket)
+            os.makedirs(bucket_dir, exist_ok=True)
+            # Chunks are numbered across all buckets so the file names of a bucket sort in the order they were added.
+            bucket_df.to_parquet(os.path.join(bucket_dir, f'{self.num_chunks:08d}.parquet'), index=False)
+            self.num_chunks += 1
+
+    def read(self, dataset: str, bucket: int, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        bucket_dir = self.bucket_dir(dataset, bucket)
+        file_names = sorted(os.listdir(bucket_dir)) if os.path.isdir(bucket_dir) else []
+        if not file_names:
+            return pd.DataFrame(columns=columns or [])
+
+        dfs = [pd.read_parquet(os.path.join(bucket_dir, file_name), columns=columns) for file_name in file_names]
+        return pd.concat(dfs, ignore_index=True, sort=False)
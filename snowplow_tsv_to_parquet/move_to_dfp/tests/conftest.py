@@ -0,0 +1,11 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'src'))
+# instrumentation.py is shared with the scripts, see the README.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, os.pardir, 'scripts'))
+
+# move_to_dfp.py reads these when it is imported. The tests read from a local directory and do not write any output.
+os.environ.setdefault('S3_INPUT_BUCKET', 'test-input')
+os.environ.setdefault('S3_OUTPUT_BUCKET', 'test-output')
+os.environ.setdefault('S3_OUTPUT_PREFIX', 'snowplow_pageviews')
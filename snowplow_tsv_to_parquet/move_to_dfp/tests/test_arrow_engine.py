@@ -0,0 +1,114 @@
+"""
+Checks that the Arrow engine gives the same page views as the pandas engine. The input is a small hour of Parquet files
+in a local directory, read with the same functions as the data in S3.
+"""
+import os
+from datetime import date
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+import arrow_engine
+import move_to_dfp
+from input import get_input_path, PAGE_PING_COLUMNS, PAGE_VIEW_COLUMNS, SCROLL_REACH_COLUMNS
+
+DATE = date(2018, 8, 22)
+HOUR = 10
+
+BROWSER = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:61.0) Gecko/20100101 Firefox/61.0'
+BOT = 'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)'
+HEARTBEAT = '{"schema":"iglu:com.snowplowanalytics.snowplow/contexts/jsonschema/1-0-0","data":[' \
+            '{"schema":"iglu:dk.jyllands-posten/heartbeat/jsonschema/1-0-0","data":{"interval":30}}]}'
+
+# (web_page_id, app_id, contexts, useragent). The other columns get a value per row, so rows that end up with another
+# row's values are noticed.
+PAGE_VIEWS: List[Tuple[Optional[str], ...]] = [
+    ('pv-1', 'jyllands-posten.dk', HEARTBEAT, BROWSER),
+    ('pv-2', 'jyllands-posten.dk', HEARTBEAT, BOT),
+    ('pv-3', 'finans.dk', HEARTBEAT, BROWSER),
+    ('pv-4', None, None, BROWSER),
+    ('pv-1', 'jyllands-posten.dk', None, BROWSER),
+    ('pv-5', 'jyllands-posten.dk', '{}', BROWSER),
+    ('pv-6', 'watchmedier.dk', '{}', BROWSER),
+]
+# (web_page_id, useragent)
+PAGE_PINGS: List[Tuple[Optional[str], ...]] = [
+    ('pv-1', BROWSER), ('pv-1', BROWSER), ('pv-3', BOT), ('pv-6', BROWSER), ('pv-6', BROWSER), ('pv-6', BROWSER),
+    (None, BROWSER),
+]
+# (web_page_id, se_category, se_action, se_value, useragent)
+STRUCT_EVENTS: List[Tuple[Optional[str], ...]] = [
+    ('pv-5', 'user_activity', 'article_scroll_reach', '50', BROWSER),
+    ('pv-5', 'user_activity', 'article_scroll_reach', '80', BROWSER),
+    ('pv-5', 'user_activity', 'article_scroll_reach', 'abc', BROWSER),
+    ('pv-6', 'user_activity', 'article_read', '99', BROWSER),
+    ('pv-1', 'user_activity', 'article_scroll_reach', '100', BOT),
+    ('pv-3', 'user_activity', 'article_scroll_reach', None, BROWSER),
+    (None, 'user_activity', 'article_scroll_reach', '10', BROWSER),
+]
+
+
+def write_hour(bucket: str, event: str, columns: List[str], rows: List[dict]) -> None:
+    """
+    Writes the rows of an event as two files with several row groups each.
+    """
+    hour_dir = get_input_path(bucket, event, DATE, HOUR)
+    os.makedirs(hour_dir)
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    half = (len(rows) + 1) // 2
+    for part, part_rows in enumerate([rows[:half], rows[half:]]):
+        pq.write_table(pa.Table.from_pylist(part_rows, schema=schema), os.path.join(hour_dir, f'part-{part}.parquet'),
+                       row_group_size=2)
+
+
+@pytest.fixture
+def input_bucket(tmp_path, monkeypatch) -> str:
+    bucket = str(tmp_path)
+    page_view_columns = sorted(PAGE_VIEW_COLUMNS)
+    page_views = []
+    for i, (web_page_id, app_id, contexts, useragent) in enumerate(PAGE_VIEWS):
+        row = {column: f'{column} {i}' for column in page_view_columns}
+        row.update(web_page_id=web_page_id, app_id=app_id, contexts=contexts, useragent=useragent)
+        page_views.append(row)
+    write_hour(bucket, 'page_view', page_view_columns, page_views)
+
+    write_hour(bucket, 'page_ping', sorted(PAGE_PING_COLUMNS),
+               [{'web_page_id': web_page_id, 'useragent': useragent} for web_page_id, useragent in PAGE_PINGS])
+
+    struct_columns = ['web_page_id', 'se_category', 'se_action', 'se_value', 'useragent']
+    assert SCROLL_REACH_COLUMNS <= set(struct_columns)
+    write_hour(bucket, 'struct', struct_columns, [dict(zip(struct_columns, event)) for event in STRUCT_EVENTS])
+
+    monkeypatch.setattr(move_to_dfp, 'S3_INPUT_BUCKET', bucket)
+    return bucket
+
+
+def run_pandas() -> pd.DataFrame:
+    return move_to_dfp.combine(*move_to_dfp.read_datasets(DATE, HOUR, LocalFileSystem(), threads=2))
+
+
+def run_arrow(bucket: str) -> pa.Table:
+    pvs, pps, scroll_reach = arrow_engine.read_datasets(bucket, DATE, HOUR, LocalFileSystem())
+    return arrow_engine.transform(pvs, pps, scroll_reach, move_to_dfp.get_partition_values(DATE, HOUR))
+
+
+def test_pandas_engine(input_bucket):
+    df = run_pandas().sort_values('web_page_id').set_index('web_page_id')
+
+    assert list(df.index) == ['pv-1', 'pv-3', 'pv-4', 'pv-5', 'pv-6']
+    assert list(df['page_title']) == ['page_title 0', 'page_title 2', 'page_title 3', 'page_title 5', 'page_title 6']
+    assert list(df['brand']) == ['jp', 'erhvervsmedier', 'jp', 'jp', 'erhvervsmedier']
+    np.testing.assert_array_equal(df['time_spent'], [60., 0., np.nan, np.nan, 90.])
+    np.testing.assert_array_equal(df['scroll_reach'], [0., 0., 0., 80., 0.])
+    # 10 UTC is 12 in Copenhagen in the summer.
+    assert set(zip(df['year'], df['month'], df['day'], df['hour'], df['dt'])) == {('2018', '08', '22', '12',
+                                                                                   '2018-08-22')}
+
+
+def test_arrow_engine_matches_pandas_engine(input_bucket):
+    arrow_engine.assert_same_output(run_pandas(), run_arrow(input_bucket))
@@ -0,0 +1,61 @@
+"""
+Checks the files HourWriter writes, with a local directory in place of S3.
+"""
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+
+import output
+
+HOUR_PARTITION = {'year': '2018', 'month': '08', 'dt': '2018-08-22'}
+PARTITION = dict(brand='jp', **HOUR_PARTITION)
+
+
+def open_writer(root: str) -> output.HourWriter:
+    return output.HourWriter(LocalFileSystem(auto_mkdir=True), root, '2018-08-22T10', HOUR_PARTITION, 1024 * 1024)
+
+
+def to_table(df: pd.DataFrame) -> pa.Table:
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def test_all_null_piece_goes_to_the_same_file(tmp_path):
+    root = str(tmp_path)
+    populated = to_table(pd.DataFrame({'web_page_id': ['pv-1', 'pv-2'], 'page_title': ['a', None],
+                                       'time_spent': [30., None]}))
+    all_null = to_table(pd.DataFrame({'web_page_id': ['pv-3'], 'page_title': [None], 'time_spent': [None]},
+                                     columns=['web_page_id', 'page_title', 'time_spent']).astype({'time_spent': float}))
+    assert pa.types.is_null(all_null.schema.field('page_title').type)
+
+    with open_writer(root) as writer:
+        writer.write(PARTITION, populated)
+        writer.write(PARTITION, all_null)
+
+    partition_dir = writer.get_partition_dir(PARTITION)
+    assert os.listdir(partition_dir) == ['2018-08-22T10-00000.parquet']
+    table = pq.read_table(os.path.join(partition_dir, '2018-08-22T10-00000.parquet'))
+    assert output.is_string_type(table.schema.field('page_title').type)
+    assert table.column('web_page_id').to_pylist() == ['pv-1', 'pv-2', 'pv-3']
+    assert table.column('page_title').to_pylist() == ['a', None, None]
+
+
+def test_all_null_first_piece_is_written_as_strings(tmp_path):
+    with open_writer(str(tmp_path)) as writer:
+        writer.write(PARTITION, to_table(pd.DataFrame({'web_page_id': ['pv-1'], 'page_title': [None]})))
+        writer.write(PARTITION, to_table(pd.DataFrame({'web_page_id': ['pv-2'], 'page_title': ['b']})))
+
+    assert writer.num_parts == {writer.get_partition_dir(PARTITION): 1}
+
+
+def test_type_conflict_raises(tmp_path):
+    with pytest.raises(ValueError, match='time_spent'):
+        with open_writer(str(tmp_path)) as writer:
+            writer.write(PARTITION, to_table(pd.DataFrame({'web_page_id': ['pv-1'], 'time_spent': [30.]})))
+            writer.write(PARTITION, to_table(pd.DataFrame({'web_page_id': ['pv-2'], 'time_spent': ['30']})))
+
+    # Nothing is uploaded when the block raises.
+    assert os.listdir(str(tmp_path)) == []
@@ -51,6 +51,10 @@ object Main {
     logger.info("Updating AWS Glue catalog partitions...")
     partitionCatalog.addPartitions(partsWritten, outBucket)
 
+    // Only mark the hour as done when all of the above has succeeded, so a backfill processes failed hours again.
+    logger.info("Writing success marker...")
+    objStorage.putMarker(outBucket, OutputPathPartitions.getSuccessMarkerKey(dtToProcess))
+
     logger.info("Done.")
   }
 
@@ -88,15 +92,27 @@ object Main {
     s"snowplow/$dtPrefix/"
   }
 
+  /**
+    * Returns the hours a job should process. A job processes `hours` consecutive hours from `start`. The children of an
+    * AWS Batch array job get the same parameters and their array index, so child i processes the i'th block of `hours`
+    * hours after `start`. This lets a backfill submit a long range of hours as a single array job.
+    */
+  def getHoursToProcess(start: LocalDateTime, hours: Int, arrayIndex: Option[Int]): Seq[LocalDateTime] = {
+    val first = start.plusHours(arrayIndex.getOrElse(0).toLong * hours)
+    (0 until hours).map(i => first.plusHours(i.toLong))
+  }
+
   def main(args: Array[String]): Unit = {
-    assert(args.length == 4, "Run with parameters {year} {month} {day} {hour}.")
+    assert(args.length == 4 || args.length == 5, "Run with parameters {year} {month} {day} {hour} [{hours}].")
 
     val year = args(0).toInt
     val month = args(1).toInt
     val day = args(2).toInt
     val hour = args(3).toInt
-    val dt = LocalDateTime.of(year, month, day, hour, 0)
-    logger.info(s"Working with date $dt.")
+    val hours = if (args.length == 5) args(4).toInt else 1
+    val arrayIndex = sys.env.get("AWS_BATCH_JOB_ARRAY_INDEX").map(_.toInt)
+    val dts = getHoursToProcess(LocalDateTime.of(year, month, day, hour, 0), hours, arrayIndex)
+    logger.info(s"Working with dates ${dts.head} to ${dts.last}.")
 
     val inBucket = sys.env.getOrElse("IN_BUCKET", throw new IllegalArgumentException("IN_BUCKET environment variable not set."))
     logger.info(s"Working with input bucket $inBucket.")
@@ -112,7 +128,7 @@ object Main {
 
     val objStorage = new S3ObjectStorage(s3)
     val partitionCatalog = new AthenaPartitionCatalog(partitionDatabase, athenaOutputLocation, athena)
-    run(inBucket, outBucket, dt, objStorage, partitionCatalog)
+    dts.foreach(run(inBucket, outBucket, _, objStorage, partitionCatalog))
   }
 
 }
@@ -14,6 +14,8 @@ trait ObjectStorage {
   def getContent(bucket: String, prefix: String, batchSize: Int): Iterator[Seq[InputStream]]
 
   def putObject(bucket: String, parts: OutputPathPartitions): Unit
+
+  def putMarker(bucket: String, key: String): Unit
 }
 
 class S3ObjectStorage(s3: AmazonS3) extends ObjectStorage {
@@ -58,4 +60,8 @@ class S3ObjectStorage(s3: AmazonS3) extends ObjectStorage {
     s3.putObject(bucket, parts.getRemoteSavePath, new File(parts.getLocalSavePath))
   }
 
+  def putMarker(bucket: String, key: String): Unit = {
+    s3.putObject(bucket, key, "")
+  }
+
 }
@@ -21,3 +21,13 @@ case class OutputPathPartitions(event: String, dt: LocalDateTime) {
   def getRemoteSaveDirectory: String = s"snowplow/$getSaveDirectory"
   def getRemoteSavePath: String = s"$getRemoteSaveDirectory/$getSaveFileName"
 }
+
+object OutputPathPartitions {
+  /**
+    * The key of the empty object that marks an hour as done. It is written after all the files of the hour have been
+    * uploaded and their partitions added, so an hour without it has to be processed again.
+    */
+  def getSuccessMarkerKey(dt: LocalDateTime): String = {
+    dt.format(DateTimeFormatter.ofPattern("'snowplow/_SUCCESS/date='yyyy-MM-dd/'hour'=HH"))
+  }
+}
@@ -1,9 +1,25 @@
-import sys
+import argparse
+import threading
+import time
 import traceback
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from multiprocessing import Pool
 
 import boto3
+from botocore.config import Config
+
+REGION_NAME = 'eu-west-1'
+INPUT_PREFIX = 'snowplow/'
+# The job writes an empty object per hour under this prefix once all the files and partitions of the hour are done, see
+# OutputPathPartitions.getSuccessMarkerKey().
+COMPLETED_PREFIX = 'snowplow/_SUCCESS/'
+# AWS Batch array jobs have between 2 and 10000 children.
+MAX_ARRAY_SIZE = 10000
+
+# A job processes hours from start to start + hours. An array job of array_size children processes array_size times as
+# many consecutive hours, see Main.getHoursToProcess().
+Job = namedtuple('Job', ['start', 'hours', 'array_size'])
 
 
 # Method for retrieving list with every hour for every day for a period of time.
@@ -22,52 +38,186 @@ def get_list_of_dates_and_hours_between(period_start_date, period_end_date):
     return dates_and_hours_list
 
 
-def tsv_to_parquet(execution_date):
-    add_batch_job(str(execution_date.year),
-                  str(execution_date.month),
-                  str(execution_date.day),
-                  str(execution_date.hour))
+def list_objects(s3, bucket, prefix, start_after=''):
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, StartAfter=start_after):
+        yield from page.get('Contents', [])
+
+
+# Returns the hours between period_start_date and period_end_date that have a success marker. Keys are listed in order
+# from the start date, so a period costs one request per 1000 hours.
+def get_completed_hours(s3, out_bucket, period_start_date, period_end_date):
+    completed = set()
+    start_after = f'{COMPLETED_PREFIX}date={period_start_date:%Y-%m-%d}'
+    for obj in list_objects(s3, out_bucket, COMPLETED_PREFIX, start_after):
+        # E.g. snowplow/_SUCCESS/date=2018-11-20/hour=05
+        date_part, hour_part = obj['Key'][len(COMPLETED_PREFIX):].split('/')[:2]
+        date_and_hour = datetime.strptime(f'{date_part} {hour_part}', 'date=%Y-%m-%d hour=%H')
+        if date_and_hour >= period_end_date:
+            break
+        completed.add(date_and_hour)
+    return completed
+
+
+# Returns the number of input bytes of each of the given hours that has input. Each day is listed separately so the days
+# can be listed concurrently.
+def get_input_bytes(s3, in_bucket, dates_and_hours, jobs):
+    def list_day(day):
+        day_bytes = defaultdict(int)
+        for obj in list_objects(s3, in_bucket, f'{INPUT_PREFIX}{day:%Y/%m/%d}/'):
+            # E.g. snowplow/2018/11/20/05/<file>
+            hour = int(obj['Key'][len(INPUT_PREFIX):].split('/')[3])
+            day_bytes[day + timedelta(hours=hour)] += obj['Size']
+        return day_bytes
+
+    days = sorted({datetime(dt.year, dt.month, dt.day) for dt in dates_and_hours})
+    input_bytes = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for day_bytes in executor.map(list_day, days):
+            input_bytes.update(day_bytes)
+    return {dt: input_bytes[dt] for dt in dates_and_hours if dt in input_bytes}
+
+
+# Splits sorted hours into runs of consecutive hours.
+def get_runs(dates_and_hours):
+    runs = []
+    for date_and_hour in dates_and_hours:
+        if runs and date_and_hour - runs[-1][-1] == timedelta(hours=1):
+            runs[-1].append(date_and_hour)
+        else:
+            runs.append([date_and_hour])
+    return runs
+
+
+# Plans as few jobs as possible for the hours to process. Each run of consecutive hours becomes an array job where every
+# child processes the same number of hours, chosen so the largest hour of the run times that number stays within
+# target_bytes of input, and a job for the hours that are left over.
+def plan_jobs(dates_and_hours, input_bytes, target_bytes, max_hours_per_job):
+    jobs = []
+    for run in get_runs(sorted(dates_and_hours)):
+        largest = max(input_bytes[date_and_hour] for date_and_hour in run)
+        hours_per_job = max(1, min(max_hours_per_job, target_bytes // max(largest, 1)))
+        num_full_jobs, rest = divmod(len(run), hours_per_job)
+
+        for first_job in range(0, num_full_jobs, MAX_ARRAY_SIZE):
+            array_size = min(MAX_ARRAY_SIZE, num_full_jobs - first_job)
+            jobs.append(Job(run[first_job * hours_per_job], hours_per_job, array_size))
+        if rest:
+            jobs.append(Job(run[num_full_jobs * hours_per_job], rest, 1))
+    return jobs
+
+
+# Allows rate calls per second on average and bursts of up to burst calls.
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.updated_at = time.monotonic()
+                self.tokens = 1
+            self.tokens -= 1
+
+
+def get_command(job):
+    command = [str(job.start.year), f'{job.start.month:02d}', f'{job.start.day:02d}', f'{job.start.hour:02d}']
+    if job.hours > 1:
+        command.append(str(job.hours))
+    return command
 
 
 # noinspection PyBroadException
-def add_batch_job(year, month, day, hour):
-    command = f'{year} {int(month):02d} {int(day):02d} {int(hour):02d}'
+def add_batch_job(batch, limiter, env_name, job):
+    command = get_command(job)
 
     try:
-        batch = boto3.client('batch', region_name='eu-west-1')
-
-        job_name = f'snowplow-tsv-to-parquet-{command.replace(" ","-")}'
+        job_name = f'snowplow-tsv-to-parquet-{"-".join(command[:4])}-{job.hours * job.array_size}h'
         job_queue = f'{env_name}-snowplow-tsv-to-parquet-queue'
         job_definition = f'{env_name}-snowplow-tsv-to-parquet-definition'
-        command = command.split()
+        array_properties = {'arrayProperties': {'size': job.array_size}} if job.array_size > 1 else {}
 
+        limiter.acquire()
         submit_job_response = batch.submit_job(
             jobName=job_name,
             jobQueue=job_queue,
             jobDefinition=job_definition,
-            containerOverrides={'command': command}
+            containerOverrides={'command': command},
+            **array_properties
         )
 
         job_id = submit_job_response['jobId']
         print(f'Submitted job {job_name} {job_id} to the job queue {job_queue}')
+        return True
     except Exception:
-        print(f"Failed to add job for command '{command}' to the job queue")
+        print(f"Failed to add job for command '{' '.join(command)}' to the job queue")
         traceback.print_exc()
+        return False
+
+
+def get_bucket_name(name, env_name):
+    return name if env_name == 'prod' else f'{name}-{env_name}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfills the hours from start date (inclusive) to end date '
+                                                 '(exclusive) on AWS Batch, skipping the hours that have been '
+                                                 'completed or have no input.')
+    parser.add_argument('env_name')
+    parser.add_argument('start_date', type=lambda s: datetime.strptime(s, '%Y-%m-%d'))
+    parser.add_argument('end_date', type=lambda s: datetime.strptime(s, '%Y-%m-%d'))
+    parser.add_argument('--in-bucket', help='Defaults to jpmedier-datalake-<env_name>, or without suffix on prod.')
+    parser.add_argument('--out-bucket', help='Defaults to behavior-datalake-<env_name>, or without suffix on prod.')
+    parser.add_argument('--include-completed', action='store_true',
+                        help='Also process the hours that have been completed.')
+    parser.add_argument('--target-mb', type=int, default=1024, help='Input to aim for per job. Default: %(default)s.')
+    parser.add_argument('--max-hours-per-job', type=int, default=24, help='Default: %(default)s.')
+    # Usually AWS Api request limits are maximum 5 request pr sec.
+    parser.add_argument('--rate', type=float, default=5, help='Submissions per second. Default: %(default)s.')
+    parser.add_argument('--list-jobs', type=int, default=16, help='Concurrent S3 listings. Default: %(default)s.')
+    parser.add_argument('--dry-run', action='store_true', help='Print the jobs instead of submitting them.')
+    args = parser.parse_args()
+
+    in_bucket = args.in_bucket or get_bucket_name('jpmedier-datalake', args.env_name)
+    out_bucket = args.out_bucket or get_bucket_name('behavior-datalake', args.env_name)
+
+    print(f'BACKFILLING FOR PERIOD {args.start_date:%Y-%m-%d} to {args.end_date:%Y-%m-%d}')
+    config = Config(retries={'max_attempts': 10})
+    s3 = boto3.client('s3', region_name=REGION_NAME, config=config)
+
+    dates_and_hours = get_list_of_dates_and_hours_between(args.start_date, args.end_date)
+    completed = set()
+    if not args.include_completed:
+        completed = get_completed_hours(s3, out_bucket, args.start_date, args.end_date)
+    pending = [date_and_hour for date_and_hour in dates_and_hours if date_and_hour not in completed]
+    input_bytes = get_input_bytes(s3, in_bucket, pending, args.list_jobs)
+    to_process = [date_and_hour for date_and_hour in pending if date_and_hour in input_bytes]
+    jobs = plan_jobs(to_process, input_bytes, args.target_mb * 1024 * 1024, args.max_hours_per_job)
+
+    print(f'{len(dates_and_hours)} hours in the period: {len(completed)} have been completed, '
+          f'{len(pending) - len(to_process)} have no input and {len(to_process)} '
+          f'({sum(input_bytes.values()) / 1024 / 1024 / 1024:.1f} GB) will be processed by {len(jobs)} submissions.')
+
+    if args.dry_run:
+        for job in jobs:
+            print(f"{' '.join(get_command(job))}" + (f' x {job.array_size}' if job.array_size > 1 else ''))
+        return
+
+    batch = boto3.client('batch', region_name=REGION_NAME, config=config)
+    limiter = TokenBucket(args.rate, burst=args.rate)
+    failed = [job for job in jobs if not add_batch_job(batch, limiter, args.env_name, job)]
+    if failed:
+        print(f'{len(failed)} of {len(jobs)} submissions failed. Run the script again to retry the hours that have '
+              f'not been completed.')
 
 
-# Method for retrieving list with every hour for every day for a period of time.
-# period_start_date is inclusive
-# period_end_date is exclusive
 if __name__ == '__main__':
-    env_name = sys.argv[1]
-    start_date_str = sys.argv[2]
-    end_date_str = sys.argv[3]
-
-    start_date = datetime.strptime(start_date_str, '%Y-%m-%d')  # start date
-    end_date = datetime.strptime(end_date_str, '%Y-%m-%d')  # end date
-
-    print("BACKFILLING FOR PERIOD {} to {}".format(start_date_str, end_date_str))
-    # Pool is 5 to avoid overflow of aws api request limits. Usually AWS Api request
-    # limits are maximum 5 request pr sec. This might be able to run at a higher pool if needed.
-    with Pool(5) as p:
-        p.map(tsv_to_parquet, get_list_of_dates_and_hours_between(start_date, end_date))
+    main()
@@ -35,6 +35,7 @@ class MainSpec extends WordSpec with MockFactory with MustMatchers {
       .returns(Seq(Seq(events)).iterator)
 
     (objStorage.putObject _).expects(*, *).anyNumberOfTimes()
+    (objStorage.putMarker _).expects(*, *).anyNumberOfTimes()
 
     val partitionCatalog = mock[PartitionCatalog]
     (partitionCatalog.addPartitions _).expects(*, *).anyNumberOfTimes()
@@ -66,6 +67,10 @@ class MainSpec extends WordSpec with MockFactory with MustMatchers {
         .returns(Seq(Seq()).iterator)
         .once()
 
+      (objStorage.putMarker _)
+        .expects("out bucket", "snowplow/_SUCCESS/date=2019-11-27/hour=16")
+        .once()
+
       val partitionCatalog = mock[PartitionCatalog]
       (partitionCatalog.addPartitions _)
         .expects(Seq(), "out bucket")
@@ -92,13 +97,21 @@ class MainSpec extends WordSpec with MockFactory with MustMatchers {
         .expects("in bucket", "snowplow/2019/11/27/16/", 12 /* Batch size hardcoded in Main. */)
         .returns(Seq(Seq(events)).iterator)
 
-      (objStorage.putObject _).expects("out bucket", expectedPartition1).once()
-      (objStorage.putObject _).expects("out bucket", expectedPartition2).once()
-
       val partitionCatalog = mock[PartitionCatalog]
-      (partitionCatalog.addPartitions _)
-        .expects(Seq(expectedPartition1, expectedPartition2), "out bucket")
-        .once()
+
+      // The success marker must come last, so an hour is only marked as done when everything has been written.
+      inSequence {
+        inAnyOrder {
+          (objStorage.putObject _).expects("out bucket", expectedPartition1).once()
+          (objStorage.putObject _).expects("out bucket", expectedPartition2).once()
+        }
+        (partitionCatalog.addPartitions _)
+          .expects(Seq(expectedPartition1, expectedPartition2), "out bucket")
+          .once()
+        (objStorage.putMarker _)
+          .expects("out bucket", "snowplow/_SUCCESS/date=2019-11-27/hour=16")
+          .once()
+      }
 
       Main.run("in bucket", "out bucket", dtToProcess, objStorage, partitionCatalog)
       // In this test we only verify the mocks and not the actual Parquet output. There's other tests for that part.
@@ -191,6 +204,23 @@ class MainSpec extends WordSpec with MockFactory with MustMatchers {
     }
   }
 
+  "Main.getHoursToProcess" should {
+    "return the start hour by default" in {
+      Main.getHoursToProcess(LocalDateTime.of(2019, 11, 27, 16, 0), 1, None) mustBe
+        Seq(LocalDateTime.of(2019, 11, 27, 16, 0))
+    }
+
+    "return consecutive hours across days" in {
+      Main.getHoursToProcess(LocalDateTime.of(2019, 11, 27, 22, 0), 3, None) mustBe
+        Seq(LocalDateTime.of(2019, 11, 27, 22, 0), LocalDateTime.of(2019, 11, 27, 23, 0), LocalDateTime.of(2019, 11, 28, 0, 0))
+    }
+
+    "offset the hours by the array index" in {
+      Main.getHoursToProcess(LocalDateTime.of(2019, 11, 27, 16, 0), 2, Some(3)) mustBe
+        Seq(LocalDateTime.of(2019, 11, 27, 22, 0), LocalDateTime.of(2019, 11, 27, 23, 0))
+    }
+  }
+
   private def timestampToEpochMilli(s: String) = {
     val formatter = DateTimeFormatter.ofPattern("yyyy-MM-dd HH:mm:ss.SSS")
     val parsedDate = LocalDateTime.parse(s, formatter)
@@ -20,5 +20,10 @@ class OutputPathPartitionsSpec extends WordSpec with MustMatchers {
       val p = OutputPathPartitions("an event", LocalDateTime.of(2020, 5, 27, 12, 34, 56))
       p.getRemoteSavePath mustBe "snowplow/event=an event/date=2020-05-27/hour=12/2020-05-27_12.pq"
     }
+
+    "have correct success marker key" in {
+      OutputPathPartitions.getSuccessMarkerKey(LocalDateTime.of(2020, 5, 27, 8, 34, 56)) mustBe
+        "snowplow/_SUCCESS/date=2020-05-27/hour=08"
+    }
   }
 }
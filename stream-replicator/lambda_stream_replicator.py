@@ -1,46 +1,319 @@
 """
-Takes an input stream and replicates a fraction of Snowplow records to an output stream, changing the records' app_id in the process.
+Takes an input stream and replicates a fraction of Snowplow records to one or more output streams, changing the records'
+app_id in the process.
+
+Records are sampled with a stable hash so the same records are kept on every run. By default each record is sampled on
+its sequence number. Set the sample key to a column such as domain_userid or domain_sessionid to keep or drop whole
+users or sessions instead.
+
+The targets are configured as a JSON list in ENV_TARGETS, e.g.
+    [{"stream_name": "Dev-enriched_good", "assume_role_arn": "arn:aws:iam::...", "keep_one_in_X_events": 100},
+     {"stream_name": "Test-enriched_good", "assume_role_arn": "arn:aws:iam::...", "keep_one_in_X_events": 10,
+      "sample_key": "domain_sessionid", "events": ["page_view", "page_ping"], "app_id_tag": "test.replicated"}]
+Each target may also filter on "app_ids". Settings left out fall back to ENV_KEEP_ONE_IN_X_EVENTS, ENV_SAMPLE_KEY and
+ENV_APP_ID_TAG. Without ENV_TARGETS, a single target is built from ENV_OUTPUT_STREAM_NAME and ENV_ASSUME_ROLE_ARN.
+
+The function is deployed as a zip of this file and scripts/instrumentation.py, e.g.
+    zip -j lambda_stream_replicator.zip stream-replicator/lambda_stream_replicator.py scripts/instrumentation.py
 """
-import base64, boto3, sys, os
+import base64, boto3, json, random, sys, os, threading, time, zlib
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from instrumentation import Metrics
+
+default_keep_one_in_X_events = int(os.environ.get("ENV_KEEP_ONE_IN_X_EVENTS", "100"))
+default_sample_key = os.environ.get("ENV_SAMPLE_KEY", "sequence_number")
+default_app_id_tag = os.environ.get("ENV_APP_ID_TAG", "test.lambda_replicate_from_prod")
 
-keep_one_in_X_events = 100
-out_stream_name = os.environ["ENV_OUTPUT_STREAM_NAME"]
+# Indices of the enriched event columns that can be used as sample keys or filters.
+app_id_column = 0
+event_column = 5
+sample_key_columns = {"app_id": app_id_column, "event": event_column, "user_id": 12, "user_ipaddress": 13,
+                      "domain_userid": 15, "network_userid": 17, "domain_sessionid": 123}
+
+# Number of base64 characters to decode when first looking for a column. Most keys sit in the first few hundred bytes
+# of an event so dropped events are rarely decoded in full.
+column_prefix_len = 1024
 
-assume_role_arn = os.environ["ENV_ASSUME_ROLE_ARN"]
 assume_role_session_name = "snowplow-stream-replicator"
+assume_role_duration_seconds = int(os.environ.get("ENV_ASSUME_ROLE_DURATION_SECONDS", "900"))
+# Refresh the assumed role's credentials this long before they expire so they never expire during an invocation.
+credentials_refresh_margin = timedelta(seconds=int(os.environ.get("ENV_CREDENTIALS_REFRESH_MARGIN_SECONDS", "120")))
 
-def handler(event, context):
-    records = []
-    for record in event["Records"]:
-        seq_number = record["kinesis"]["sequenceNumber"]
-        # With X% propbability, write a Snowplow event from prod to test. Use the unique seq number to determine which records to keep.
-        if (hash(seq_number) % keep_one_in_X_events) != 0:
-            continue
+# PutRecords limits, see https://docs.aws.amazon.com/kinesis/latest/APIReference/API_PutRecords.html
+max_records_per_request = 500
+max_bytes_per_request = 5 * 1024 * 1024
+max_bytes_per_record = 1024 * 1024
+
+# Failed entries are retried with exponential backoff and full jitter. If entries still fail after the last attempt,
+# the invocation fails and Lambda retries the whole batch rather than silently dropping records.
+max_put_attempts = int(os.environ.get("ENV_MAX_PUT_ATTEMPTS", "8"))
+backoff_base_seconds = 0.1
+backoff_max_seconds = 5.0
+send_concurrency = int(os.environ.get("ENV_SEND_CONCURRENCY", "4"))
+
+# With ENV_METRICS=1, each invocation logs the time, rows and memory of its sample and send stages as CloudWatch Embedded
+# Metric Format, like the other tools. Deploy the function with scripts/instrumentation.py next to this file.
+metrics = Metrics("stream_replicator", enabled=os.environ.get("ENV_METRICS", "0") == "1",
+                  namespace=os.environ.get("ENV_METRICS_NAMESPACE", "Snowplow"))
+
+# Clients are kept at module scope so warm invocations of the same Lambda container can reuse them. There is one
+# Kinesis client per assumed role and it is rebuilt whenever the role's credentials are about to expire.
+sts_client = boto3.client("sts")
+kinesis_clients = {}
+kinesis_clients_lock = threading.Lock()
+send_pool = ThreadPoolExecutor(max_workers=send_concurrency)
+
+
+def get_kinesis_client(role_arn):
+    # Records are sent from several threads, so make sure only one of them assumes the role when the credentials expire.
+    with kinesis_clients_lock:
+        now = datetime.now(timezone.utc)
+        if role_arn in kinesis_clients:
+            kinesis_client, expiration = kinesis_clients[role_arn]
+            if now < expiration - credentials_refresh_margin:
+                return kinesis_client
+
+        sts_response = sts_client.assume_role(RoleArn=role_arn, RoleSessionName=assume_role_session_name,
+                                              DurationSeconds=assume_role_duration_seconds)
+        credentials = sts_response["Credentials"]
+
+        kinesis_client = boto3.client("kinesis",
+            aws_access_key_id=credentials["AccessKeyId"],
+            aws_secret_access_key=credentials["SecretAccessKey"],
+            aws_session_token=credentials["SessionToken"]
+        )
+        kinesis_clients[role_arn] = (kinesis_client, credentials["Expiration"])
+        print("Assumed role {}. Credentials expire at {}.".format(role_arn, credentials["Expiration"].isoformat()))
+
+        return kinesis_client
+
+
+def invalidate_kinesis_client(role_arn):
+    with kinesis_clients_lock:
+        kinesis_clients.pop(role_arn, None)
+
+
+def is_sampled(key, keep_one_in_X_events):
+    # Python's hash() is salted per process, so use a checksum to keep the sample the same across containers and runs.
+    return zlib.crc32(key) % keep_one_in_X_events == 0
+
+
+def record_size(record):
+    return len(record["Data"]) + len(record["PartitionKey"].encode("UTF-8"))
+
+
+def chunk_records(records):
+    """
+    Splits records into chunks that each fit in a single PutRecords request.
+    """
+    chunk = []
+    chunk_bytes = 0
+    for record in records:
+        size = record_size(record)
+        if chunk and (len(chunk) == max_records_per_request or chunk_bytes + size > max_bytes_per_request):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(record)
+        chunk_bytes += size
+
+    if chunk:
+        yield chunk
+
+
+class InputRecord(object):
+    """
+    A record from the input stream. The record is base64 decoded lazily and at most once, no matter how many targets
+    look at it.
+    """
+    __slots__ = ("seq_number", "data", "decoded", "decoded_len")
+
+    def __init__(self, kinesis_record):
+        self.seq_number = kinesis_record["sequenceNumber"]
+        self.data = kinesis_record["data"]
+        self.decoded = b""
+        # The number of base64 characters decoded so far.
+        self.decoded_len = 0
+
+    def decode_up_to(self, prefix_len):
+        # Prefix lengths are always multiples of 4 so each newly decoded part is valid base64 on its own.
+        if prefix_len > self.decoded_len:
+            self.decoded += base64.b64decode(self.data[self.decoded_len:prefix_len])
+            self.decoded_len = min(prefix_len, len(self.data))
+
+    def column(self, column_idx):
+        """
+        Returns the given column of the enriched event as bytes or None if the event has fewer columns. Only as much of
+        the event as is needed to find the column is decoded.
+        """
+        while True:
+            fields = self.decoded.split(b"\t", column_idx + 1)
+            if len(fields) > column_idx + 1:
+                return fields[column_idx]
+            if self.decoded_len >= len(self.data):
+                return fields[column_idx] if len(fields) == column_idx + 1 else None
+            self.decode_up_to(max(column_prefix_len, self.decoded_len * 4))
 
+    def payload(self):
+        self.decode_up_to(len(self.data))
+        return self.decoded
+
+
+class Target(object):
+    """
+    An output stream with its own sample rate, filters and app_id tag.
+    """
+    def __init__(self, stream_name, assume_role_arn, keep_one_in_X_events=None, sample_key=None, events=None,
+                 app_ids=None, app_id_tag=None):
+        self.stream_name = stream_name
+        self.assume_role_arn = assume_role_arn
+        self.keep_one_in_X_events = int(keep_one_in_X_events or default_keep_one_in_X_events)
+        self.sample_key = sample_key or default_sample_key
+        self.events = set(e.encode("UTF-8") for e in events) if events else None
+        self.app_ids = set(a.encode("UTF-8") for a in app_ids) if app_ids else None
+        self.app_id_tag = (app_id_tag or default_app_id_tag).encode("UTF-8")
+
+        if self.sample_key != "sequence_number" and self.sample_key not in sample_key_columns:
+            raise ValueError("Unsupported sample key {} for stream {}. Use sequence_number or one of {}.".format(
+                self.sample_key, stream_name, ", ".join(sorted(sample_key_columns))))
+
+    def to_output_record(self, record):
+        """
+        Returns the record to put on the target stream or None if the target does not want the record.
+        """
+        if self.sample_key == "sequence_number":
+            key = record.seq_number.encode("UTF-8")
+        else:
+            # Events without the key would otherwise all hash to the same value, so sample them individually.
+            key = record.column(sample_key_columns[self.sample_key]) or record.seq_number.encode("UTF-8")
+        if not is_sampled(key, self.keep_one_in_X_events):
+            return None
+
+        if self.events is not None and record.column(event_column) not in self.events:
+            return None
+        if self.app_ids is not None and record.column(app_id_column) not in self.app_ids:
+            return None
+
+        # Keep the events of a user or session in order on the output stream by partitioning on the sample key.
+        output_record = {"Data": self.tag_app_id(record.payload()), "PartitionKey": key.decode("UTF-8", errors="replace")[:256]}
+        if record_size(output_record) > max_bytes_per_record:
+            raise ValueError("Record of {} bytes exceeds the Kinesis record size limit.".format(record_size(output_record)))
+        return output_record
+
+    def tag_app_id(self, payload):
+        """
+        Replaces the app_id with a string containing the old app_id as well, e.g. "test.lambda_replicate_from_prod (web)".
+        """
+        index_of_first_tab = payload.find(b"\t")
+        if index_of_first_tab == -1:
+            raise ValueError("Payload is not an enriched event.")
+
+        # To easily support filtering of Kinesis events, we write the target environment first as part of the app_id.
+        return b"".join((self.app_id_tag, b" (", payload[:index_of_first_tab], b")", payload[index_of_first_tab:]))
+
+    def put_records(self, records):
         try:
-            payload = base64.b64decode(record["kinesis"]["data"]).decode("UTF-8")
-
-            # Replace the app_id with a string containing the old app_id as well.
-            index_of_first_tab = payload.find("\t")
-            orig_app_id = payload[:index_of_first_tab]
-            payload_excl_app_id = payload[index_of_first_tab:]
-            # To easily support filtering of Kinesis events, we write the target environment first as part of the app_id.
-            new_app_id = "test.lambda_replicate_from_prod ({})".format(orig_app_id)
-            new_payload = new_app_id + payload_excl_app_id
-            records.append({"Data": bytes(new_payload, "UTF-8"), "PartitionKey": seq_number})
-        except Exception as e:
-            print("ERROR: {}\nInput: {}".format(str(e), record["kinesis"]["data"]), file=sys.stderr)
-
-    if len(records) == 0:
-        return
+            return get_kinesis_client(self.assume_role_arn).put_records(Records=records, StreamName=self.stream_name)
+        except ClientError as e:
+            # The cached credentials may have been revoked or the container's clock may be off. Assume the role again
+            # and retry once before giving up.
+            if e.response["Error"]["Code"] not in ("ExpiredTokenException", "UnrecognizedClientException"):
+                raise
+            print("Credentials were rejected ({}). Assuming role again.".format(e.response["Error"]["Code"]), file=sys.stderr)
+            invalidate_kinesis_client(self.assume_role_arn)
+            return get_kinesis_client(self.assume_role_arn).put_records(Records=records, StreamName=self.stream_name)
+
+    def put_chunk(self, records):
+        """
+        Puts a chunk of records, retrying only the entries Kinesis reports as failed. Returns the number of retried
+        entries.
+        """
+        retried = 0
+        for attempt in range(max_put_attempts):
+            response = self.put_records(records)
+            if response["FailedRecordCount"] == 0:
+                return retried
+
+            results = response["Records"]
+            records = [record for record, result in zip(records, results) if "ErrorCode" in result]
+            error_codes = sorted(set(result["ErrorCode"] for result in results if "ErrorCode" in result))
+            print("{} records failed on stream {} ({}). Attempt {}/{}.".format(
+                len(records), self.stream_name, ", ".join(error_codes), attempt + 1, max_put_attempts), file=sys.stderr)
+
+            if attempt + 1 < max_put_attempts:
+                retried += len(records)
+                time.sleep(random.uniform(0, min(backoff_max_seconds, backoff_base_seconds * 2 ** attempt)))
+
+        raise RuntimeError("Could not put {} records on stream {} after {} attempts.".format(
+            len(records), self.stream_name, max_put_attempts))
+
 
-    sts_client = boto3.client("sts")
-    sts_response = sts_client.assume_role(RoleArn=assume_role_arn, RoleSessionName=assume_role_session_name, DurationSeconds=900)
+def load_targets():
+    if "ENV_TARGETS" in os.environ:
+        return [Target(**target) for target in json.loads(os.environ["ENV_TARGETS"])]
+
+    return [Target(os.environ["ENV_OUTPUT_STREAM_NAME"], os.environ["ENV_ASSUME_ROLE_ARN"])]
+
+
+targets = load_targets()
+
+
+def put_all_records(records_per_target):
+    """
+    Puts the records of all targets in as many concurrent PutRecords requests as needed and reports each target's
+    throughput.
+    """
+    start_time = time.monotonic()
+    futures = [(target, send_pool.submit(target.put_chunk, chunk))
+               for target, records in records_per_target
+               for chunk in chunk_records(records)]
+
+    # Wait for every request before raising so one failing target does not leave the others' requests unaccounted for.
+    failures = []
+    for target, records in records_per_target:
+        target_futures = [future for future_target, future in futures if future_target is target]
+        retried = 0
+        for future in target_futures:
+            try:
+                retried += future.result()
+            except Exception as e:
+                failures.append(e)
+        elapsed_seconds = time.monotonic() - start_time
+
+        print("Sent {} records ({} bytes) in {} requests to stream {} in {:.3f}s ({:.0f} records/s). Retried {} records.".format(
+            len(records), sum(record_size(record) for record in records), len(target_futures), target.stream_name,
+            elapsed_seconds, len(records) / elapsed_seconds if elapsed_seconds > 0 else 0, retried))
+
+    if failures:
+        raise failures[0]
+
+
+def handler(event, context):
+    with metrics.stage("sample") as stage:
+        stage.rows_in = len(event["Records"])
+        records_per_target = [(target, []) for target in targets]
+        for kinesis_record in event["Records"]:
+            record = InputRecord(kinesis_record["kinesis"])
+
+            for target, records in records_per_target:
+                try:
+                    output_record = target.to_output_record(record)
+                    if output_record is not None:
+                        records.append(output_record)
+                except Exception as e:
+                    print("ERROR: {}\nInput: {}".format(str(e), record.data), file=sys.stderr)
+
+        records_per_target = [(target, records) for target, records in records_per_target if len(records) > 0]
+        num_sampled = sum(len(records) for _, records in records_per_target)
+        stage.rows_out = num_sampled
+    if len(records_per_target) == 0:
+        return
 
-    kinesis_client = boto3.client("kinesis",
-        aws_access_key_id=sts_response["Credentials"]["AccessKeyId"],
-        aws_secret_access_key=sts_response["Credentials"]["SecretAccessKey"],
-        aws_session_token=sts_response["Credentials"]["SessionToken"]
-    )    
-    kinesis_client.put_records(Records=records, StreamName=out_stream_name)
-    print("Put {}/{} events on stream {}.".format(len(records), len(event["Records"]), out_stream_name))
+    with metrics.stage("send") as stage:
+        stage.rows_in = stage.rows_out = num_sampled
+        put_all_records(records_per_target)
+    for target, records in records_per_target:
+        print("Put {}/{} events on stream {}.".format(len(records), len(event["Records"]), target.stream_name))